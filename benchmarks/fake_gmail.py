@@ -0,0 +1,212 @@
+# fake_gmail.py
+import json
+import random
+import threading
+import time
+import httplib2
+from googleapiclient.errors import HttpError
+
+
+def _http_error(status, reason):
+    resp = httplib2.Response({"status": status})
+    resp.reason = reason
+    content = json.dumps({"error": {"code": status, "message": reason,
+                                    "errors": [{"reason": reason}]}}).encode("utf-8")
+    return HttpError(resp, content)
+
+
+class FakeRequest(object):
+
+    def __init__(self, service, method, handler):
+        self.service = service
+        self.method = method
+        self.handler = handler
+
+    def execute(self, http=None, num_retries=0):
+        self.service.wait()
+        return self.service.call(self.method, self.handler)
+
+
+class FakeBatch(object):
+    # like BatchHttpRequest: one round trip, and every part succeeds or fails on its own
+
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.parts = []
+
+    def add(self, request, request_id=None, callback=None):
+        if len(self.parts) >= 100:
+            raise ValueError("Gmail batches hold at most 100 calls")
+        self.parts.append((request_id, request, callback or self.callback))
+
+    def execute(self, http=None):
+        self.service.wait()
+        self.service.count("batch")
+        for request_id, request, callback in self.parts:
+            try:
+                response = self.service.call(request.method, request.handler)
+            except HttpError as err:
+                callback(request_id, None, err)
+            else:
+                callback(request_id, response, None)
+
+
+class _Resource(object):
+    # users(), messages(), labels() and history() all hand back the service's own methods
+
+    def __init__(self, methods):
+        self._methods = methods
+
+    def __getattr__(self, name):
+        try:
+            return self._methods[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeGmailService(object):
+    # An in-process stand-in for the googleapiclient Gmail resource, backed by a SyntheticMailbox.
+    # latency is added to every round trip (a batch counts once); error_rate and throttle_rate
+    # are the chances that a call fails with 500 or 429.
+
+    def __init__(self, mailbox, latency=0.0, error_rate=0.0, throttle_rate=0.0, seed=1):
+        self.mailbox = mailbox
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rng = random.Random(f"faults:{seed}")
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.labels = {"INBOX": "INBOX", "UNREAD": "UNREAD"}  # id -> name
+        self.history = []  # (historyId, record)
+        self.history_id = 1000
+        self._listing = None  # ((labelIds, historyId, count), ids) of the last messages.list walk
+
+    def count(self, method):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def call(self, method, handler):
+        self.count(method)
+        with self.lock:
+            roll = self.rng.random()
+        if roll < self.throttle_rate:
+            raise _http_error(429, "rateLimitExceeded")
+        if roll < self.throttle_rate + self.error_rate:
+            raise _http_error(500, "backendError")
+        return handler()
+
+    def _record(self, record):
+        with self.lock:
+            self.history_id += 1
+            self.history.append((self.history_id, dict(record, id=str(self.history_id))))
+
+    # resource tree
+    def users(self):
+        return _Resource({"messages": self._messages, "labels": self._labels, "history": self._history,
+                          "getProfile": self._get_profile})
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def _messages(self):
+        return _Resource({"list": self._list, "get": self._get, "modify": self._modify,
+                          "batchModify": self._batch_modify})
+
+    def _labels(self):
+        return _Resource({"list": self._list_labels, "create": self._create_label})
+
+    def _history(self):
+        return _Resource({"list": self._list_history})
+
+    # users.getProfile / messages.*
+    def _get_profile(self, userId="me"):
+        return FakeRequest(self, "getProfile", lambda: {"emailAddress": "me@example.com",
+                                                        "historyId": str(self.history_id),
+                                                        "messagesTotal": self.mailbox.count})
+
+    def _list(self, userId="me", labelIds=None, maxResults=100, pageToken=None, q=None):
+        def handler():
+            key = (tuple(labelIds or ()), self.history_id, self.mailbox.count)
+            if self._listing is None or self._listing[0] != key:
+                ids = self.mailbox.ids()
+                if labelIds:
+                    ids = [i for i in ids if all(label in self.mailbox.label_ids(i) for label in labelIds)]
+                self._listing = (key, ids)
+            ids = self._listing[1]
+            start = int(pageToken or 0)
+            page = ids[start:start + min(maxResults, 500)]
+            result = {"messages": [{"id": i, "threadId": ""} for i in page], "resultSizeEstimate": len(ids)}
+            if start + len(page) < len(ids):
+                result["nextPageToken"] = str(start + len(page))
+            return result
+        return FakeRequest(self, "messages.list", handler)
+
+    def _get(self, userId="me", id=None, format="full", metadataHeaders=None):
+        def handler():
+            if id in self.mailbox.deleted or int(id, 16) >= self.mailbox.count:
+                raise _http_error(404, "notFound")
+            return self.mailbox.message(id, format, metadataHeaders)
+        return FakeRequest(self, "messages.get", handler)
+
+    def _apply(self, ids, add, remove):
+        for message_id in ids:
+            labels = [l for l in self.mailbox.label_ids(message_id) if l not in remove]
+            labels += [l for l in add if l not in labels]
+            self.mailbox.labels[message_id] = labels
+            if add:
+                self._record({"labelsAdded": [{"message": {"id": message_id}, "labelIds": list(add)}]})
+            if remove:
+                self._record({"labelsRemoved": [{"message": {"id": message_id}, "labelIds": list(remove)}]})
+
+    def _modify(self, userId="me", id=None, body=None):
+        body = body or {}
+        return FakeRequest(self, "messages.modify", lambda: self._apply(
+            [id], body.get("addLabelIds", []), body.get("removeLabelIds", [])) or {"id": id})
+
+    def _batch_modify(self, userId="me", body=None):
+        body = body or {}
+        if len(body.get("ids", [])) > 1000:
+            raise ValueError("batchModify takes at most 1000 ids")
+        return FakeRequest(self, "messages.batchModify", lambda: self._apply(
+            body["ids"], body.get("addLabelIds", []), body.get("removeLabelIds", [])) or {})
+
+    # labels.*
+    def _list_labels(self, userId="me"):
+        return FakeRequest(self, "labels.list", lambda: {
+            "labels": [{"id": label_id, "name": name} for label_id, name in self.labels.items()]
+        })
+
+    def _create_label(self, userId="me", body=None):
+        def handler():
+            with self.lock:
+                label_id = f"Label_{len(self.labels)}"
+                self.labels[label_id] = body["name"]
+            return {"id": label_id, "name": body["name"]}
+        return FakeRequest(self, "labels.create", handler)
+
+    # history.list
+    def deliver(self, count):
+        # new mail arrives: extends the mailbox and records messagesAdded history
+        for message_id in self.mailbox.add(count):
+            self._record({"messagesAdded": [{"message": {"id": message_id,
+                                                         "labelIds": self.mailbox.label_ids(message_id)}}]})
+
+    def _list_history(self, userId="me", startHistoryId=None, historyTypes=None, pageToken=None, maxResults=500):
+        def handler():
+            start = int(startHistoryId)
+            if self.history and start < self.history[0][0] - 1:
+                raise _http_error(404, "notFound")
+            records = [record for history_id, record in self.history if history_id > start]
+            offset = int(pageToken or 0)
+            page = records[offset:offset + maxResults]
+            result = {"history": page, "historyId": str(self.history_id)}
+            if offset + len(page) < len(records):
+                result["nextPageToken"] = str(offset + len(page))
+            return result
+        return FakeRequest(self, "history.list", handler)
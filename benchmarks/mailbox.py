@@ -0,0 +1,121 @@
+# mailbox.py
+import base64
+import random
+
+DOMAINS = ["groww.in", "github.com", "amazon.in", "linkedin.com", "swiggy.in", "hdfcbank.net", "zomato.com",
+           "medium.com", "google.com", "notion.so", "slack.com", "irctc.co.in", "flipkart.com", "uber.com"]
+LOCAL_PARTS = ["noreply", "alerts", "notifications", "team", "support", "billing", "digest", "updates"]
+PEOPLE = ["Asha", "Ravi", "Meera", "Arjun", "Kavya", "Rohan", "Divya", "Karthik", "Nisha", "Vikram"]
+SUBJECTS = [
+    "Your order #{n} has shipped", "Invoice {n} for your subscription", "SIP instalment of Rs {n} processed",
+    "[GitHub] Pull request #{n} review requested", "Weekly digest: {n} new stories", "Re: meeting notes {n}",
+    "Payment reminder: statement {n}", "Your OTP is {n}", "{n} people viewed your profile",
+    "Build #{n} failed on main", "Offer: {n}% off this weekend", "Ticket {n} confirmed",
+]
+WORDS = ["please", "find", "attached", "details", "account", "update", "team", "report", "schedule",
+         "payment", "review", "summary", "thanks", "regards", "deadline", "project", "delivery", "refund"]
+SYSTEM_LABELS = ["INBOX", "UNREAD", "IMPORTANT", "CATEGORY_UPDATES", "CATEGORY_PROMOTIONS"]
+EPOCH_MS = 1_700_000_000_000  # Nov 2023; generated mail spans the year after it
+YEAR_MS = 365 * 24 * 3600 * 1000
+
+
+def _zipf_weights(n, s=1.1):
+    return [1.0 / (rank ** s) for rank in range(1, n + 1)]
+
+
+SENDERS = [f"{local}@{domain}" for domain in DOMAINS for local in LOCAL_PARTS]
+SENDERS += [f"{name} <{name.lower()}@example.com>" for name in PEOPLE]
+SENDER_WEIGHTS = _zipf_weights(len(SENDERS))  # a few senders send most of the mail
+
+
+def _b64(text):
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+class SyntheticMailbox(object):
+    # Deterministic mailbox of `count` messages. Message i is rebuilt from (seed, i) whenever it is
+    # asked for, so a million-message mailbox only keeps label changes in memory.
+
+    def __init__(self, count, seed=1):
+        self.count = count
+        self.seed = seed
+        self.labels = {}  # message id -> label ids, for messages whose labels changed
+        self.deleted = set()
+
+    def message_id(self, i):
+        return f"{i:012x}"
+
+    def ids(self):
+        return [self.message_id(i) for i in range(self.count) if self.message_id(i) not in self.deleted]
+
+    def _rng(self, message_id):
+        return random.Random(f"{self.seed}:{message_id}")
+
+    def _fields(self, message_id):
+        rng = self._rng(message_id)
+        sender = rng.choices(SENDERS, weights=SENDER_WEIGHTS)[0]
+        subject = rng.choice(SUBJECTS).format(n=rng.randint(1, 99999))
+        body = " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 400)))
+        return {
+            "sender": sender,
+            "subject": subject,
+            "body": body,
+            "internal_date": EPOCH_MS + rng.randint(0, YEAR_MS),
+            "thread": f"t{rng.randint(0, max(1, self.count // 3)):x}",
+        }
+
+    def label_ids(self, message_id):
+        if message_id in self.labels:
+            return self.labels[message_id]
+        # a separate stream, so listing by label never has to build message bodies
+        rng = random.Random(f"{self.seed}:{message_id}:labels")
+        return ["INBOX"] + [label for label in SYSTEM_LABELS[1:] if rng.random() < 0.3]
+
+    def add(self, extra):
+        # new mail arriving; returns the new ids
+        start = self.count
+        self.count += extra
+        return [self.message_id(i) for i in range(start, self.count)]
+
+    def message(self, message_id, fmt="full", metadata_headers=None):
+        f = self._fields(message_id)
+        headers = [{"name": "From", "value": f["sender"]}, {"name": "To", "value": "me@example.com"},
+                   {"name": "Subject", "value": f["subject"]}, {"name": "Date", "value": str(f["internal_date"])},
+                   {"name": "Message-ID", "value": f"<{message_id}@mail.example.com>"}]
+        msg = {"id": message_id, "threadId": f["thread"], "labelIds": list(self.label_ids(message_id)),
+               "snippet": f["body"][:120], "internalDate": str(f["internal_date"]), "sizeEstimate": len(f["body"])}
+        if fmt == "minimal":
+            return msg
+        if fmt == "metadata":
+            if metadata_headers:
+                wanted = {h.lower() for h in metadata_headers}
+                headers = [h for h in headers if h["name"].lower() in wanted]
+            msg["payload"] = {"mimeType": "multipart/alternative", "headers": headers}
+            return msg
+        msg["payload"] = {"mimeType": "multipart/alternative", "headers": headers, "parts": [
+            {"partId": "0", "mimeType": "text/plain", "body": {"size": len(f["body"]), "data": _b64(f["body"])}},
+            {"partId": "1", "mimeType": "text/html",
+             "body": {"size": len(f["body"]) + 13, "data": _b64(f"<p>{f['body']}</p>")}},
+        ]}
+        return msg
+
+
+def generate_rules(count, seed=1):
+    # rule sets that look like real ones: sender and subject filters, a few date conditions
+    rng = random.Random(f"rules:{seed}")
+    keywords = ["invoice", "order", "sip", "pull request", "digest", "otp", "build", "offer", "ticket", "payment"]
+    rules = []
+    for i in range(count):
+        conditions = [{"field": "From", "predicate": "contains", "value": rng.choice(DOMAINS)}]
+        if rng.random() < 0.6:
+            conditions.append({"field": "Subject", "predicate": rng.choice(["contains", "does not contain"]),
+                               "value": rng.choice(keywords)})
+        if rng.random() < 0.2:
+            conditions.append({"field": "internal_date", "predicate": "greater_than_days",
+                               "value": str(rng.randint(1, 180))})
+        actions = [{"action": "move_to_label", "label": f"Bench/{conditions[0]['value']}"}]
+        if rng.random() < 0.5:
+            actions.append({"action": "mark_as_read"})
+        rules.append({"name": f"rule-{i}", "predicate": rng.choice(["All", "All", "Any"]),
+                      "conditions": conditions, "actions": actions})
+    return rules
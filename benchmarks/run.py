@@ -0,0 +1,191 @@
+# run.py
+import argparse
+import contextlib
+import datetime
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+from sqlalchemy import event
+from benchmarks.fake_gmail import FakeGmailService
+from benchmarks.mailbox import SyntheticMailbox, generate_rules
+from core.gmail_service import GmailProcessor
+from core.metrics import add_cli_arguments, cli_run
+from core.model import dispose_engines, get_engine
+from core.process_rules import RuleProcessor, peak_memory_mb
+from core.scheduler import RequestScheduler
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+REGRESSION_THRESHOLD = 0.10  # slower by more than this fraction is flagged
+
+
+class QueryTimer(object):
+    # wall time spent inside the database driver, from SQLAlchemy's cursor events
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.seconds = 0.0
+        self.statements = 0
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("bench_started", []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        self.seconds += time.perf_counter() - conn.info["bench_started"].pop()
+        self.statements += 1
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._before)
+        event.listen(self.engine, "after_cursor_execute", self._after)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, "before_cursor_execute", self._before)
+        event.remove(self.engine, "after_cursor_execute", self._after)
+
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _phase(fake, timer, messages, step):
+    calls_before = dict(fake.calls)
+    db_seconds, statements = timer.seconds, timer.statements
+    started = time.perf_counter()
+    step()
+    elapsed = time.perf_counter() - started
+    calls = {m: n - calls_before.get(m, 0) for m, n in fake.calls.items() if n != calls_before.get(m, 0)}
+    return {
+        "seconds": round(elapsed, 4),
+        "messages": messages,
+        "messages_per_second": round(messages / elapsed, 1) if elapsed > 0 else None,
+        "api_calls": calls,
+        "db_seconds": round(timer.seconds - db_seconds, 4),
+        "db_statements": timer.statements - statements,
+    }
+
+
+@contextlib.contextmanager
+def _quiet_logs(level=logging.WARNING):
+    core = logging.getLogger("core")
+    previous = core.level
+    core.setLevel(level)
+    try:
+        yield
+    finally:
+        core.setLevel(previous)
+
+
+def run_benchmark(messages=10000, rules=50, seed=1, latency=0.0, error_rate=0.0, throttle_rate=0.0,
+                  batch_size=50, workers=4, backend="sql", single_pass=False, deliver=0, base_delay=0.05,
+                  msg_format="metadata", workdir=None, quiet=True, fake=None):
+    # full sync + rule run (and, with deliver, an incremental sync + rule run) against the fake;
+    # pass fake to keep using its mailbox after the run
+    config = {k: v for k, v in locals().items() if k not in ("workdir", "quiet", "fake")}
+    with contextlib.ExitStack() as stack:
+        if workdir is None:
+            workdir = stack.enter_context(tempfile.TemporaryDirectory())
+        if quiet:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+            stack.enter_context(_quiet_logs())
+        db_url = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+        rules_path = os.path.join(workdir, "rules.json")
+        with open(rules_path, "w") as f:
+            json.dump({"rules": generate_rules(rules, seed)}, f)
+
+        if fake is None:
+            fake = FakeGmailService(SyntheticMailbox(messages, seed), latency=latency, error_rate=error_rate,
+                                    throttle_rate=throttle_rate, seed=seed)
+        scheduler = RequestScheduler(quota_per_second=1e9, base_delay=base_delay, max_delay=1.0)
+        gmail = GmailProcessor(scheduler=scheduler)
+        rp = RuleProcessor(gmail)
+        phases = {}
+        try:
+            with QueryTimer(get_engine(db_url)) as timer:
+                phases["full_sync"] = _phase(fake, timer, messages, lambda: gmail.fetch_and_store(
+                    db_url, None, batch_size, workers, full=True, service=fake, msg_format=msg_format))
+                phases["rules"] = _phase(fake, timer, messages, lambda: rp.run_rules(
+                    db_url, rules_path, single_pass=single_pass, service=fake, incremental=True, backend=backend,
+                    snapshot_dir=os.path.join(workdir, "snapshots")))
+                if deliver:
+                    fake.deliver(deliver)
+                    phases["incremental_sync"] = _phase(fake, timer, deliver, lambda: gmail.fetch_and_store(
+                        db_url, None, batch_size, workers, service=fake, msg_format=msg_format))
+                    phases["incremental_rules"] = _phase(fake, timer, deliver, lambda: rp.run_rules(
+                        db_url, rules_path, single_pass=single_pass, service=fake, incremental=True,
+                        backend=backend, snapshot_dir=os.path.join(workdir, "snapshots")))
+        finally:
+            dispose_engines()
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "config": config,
+        "phases": phases,
+        "scheduler": dict(scheduler.stats),
+        "peak_rss_mb": peak_memory_mb(),
+    }
+
+
+def compare(result, baseline, threshold=REGRESSION_THRESHOLD):
+    # lines describing each phase against a saved run; regressions are marked
+    lines = []
+    for name, phase in result["phases"].items():
+        old = baseline.get("phases", {}).get(name)
+        if not old or not old.get("seconds"):
+            continue
+        change = phase["seconds"] / old["seconds"] - 1
+        mark = "  REGRESSION" if change > threshold else ""
+        lines.append(f"{name:<18} {old['seconds']:>9.3f}s -> {phase['seconds']:>9.3f}s ({change:+.1%}){mark}")
+    return lines
+
+
+def report(result):
+    lines = [f"commit {result['commit']}  peak RSS {result['peak_rss_mb'] or 0:.1f} MB"]
+    for name, phase in result["phases"].items():
+        calls = sum(phase["api_calls"].values())
+        lines.append(f"{name:<18} {phase['seconds']:>9.3f}s {phase['messages_per_second'] or 0:>10.1f} msg/s "
+                     f"{calls:>7} API calls  DB {phase['db_seconds']:.3f}s / {phase['db_statements']} statements")
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="end-to-end benchmark against a fake Gmail service")
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--rules", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every round trip")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls failing with 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of calls failing with 429")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--backend", choices=("sql", "columnar"), default="sql")
+    parser.add_argument("--single-pass", action="store_true")
+    parser.add_argument("--format", dest="msg_format", choices=("metadata", "full"), default="metadata")
+    parser.add_argument("--deliver", type=int, default=0, help="new messages for an incremental sync afterwards")
+    parser.add_argument("--out", help="results file (default: benchmarks/results/<time>-<commit>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--verbose", action="store_true", help="keep the sync and rule output")
+    add_cli_arguments(parser)
+    args = parser.parse_args()
+    with cli_run(args):
+        result = run_benchmark(args.messages, args.rules, args.seed, args.latency, args.error_rate,
+                               args.throttle_rate, args.batch_size, args.workers, args.backend, args.single_pass,
+                               args.deliver, msg_format=args.msg_format, quiet=not args.verbose)
+    print("\n".join(report(result)))
+    if args.compare:
+        with open(args.compare) as f:
+            print("\n".join(compare(result, json.load(f))))
+    out = args.out
+    if out is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        out = os.path.join(RESULTS_DIR, f"{stamp}-{result['commit'] or 'nogit'}.json")
+    with open(out, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"Saved {out}")
@@ -0,0 +1,102 @@
+# actions.py
+import logging
+from googleapiclient.errors import HttpError
+from core.metrics import metrics
+from core.model import Email, SQL_IN_CHUNK, apply_label_changes, load_message_labels
+
+BATCH_MODIFY_LIMIT = 1000  # most ids users.messages.batchModify accepts per call
+
+logger = logging.getLogger(__name__)
+
+
+class ActionPlanner(object):
+
+    def __init__(self):
+        self.deltas = {}  # message_id -> (labels to add, labels to remove)
+        self.failed_deltas = {}  # deltas of the last execute() that Gmail rejected
+        self.calls_avoided = 0  # batchModify calls the label mirror showed to be no-ops
+
+    def add(self, message_id, add_labels=(), remove_labels=()):
+        add, remove = self.deltas.setdefault(message_id, (set(), set()))
+        # a later action on the same label overrides an earlier one
+        for label in add_labels:
+            add.add(label)
+            remove.discard(label)
+        for label in remove_labels:
+            remove.add(label)
+            add.discard(label)
+
+    def set_read(self, message_id, stored_is_read, is_read):
+        # only send an UNREAD change when the final state differs from what is stored
+        add, remove = self.deltas.setdefault(message_id, (set(), set()))
+        add.discard("UNREAD")
+        remove.discard("UNREAD")
+        if is_read != bool(stored_is_read):
+            (remove if is_read else add).add("UNREAD")
+
+    def groups(self):
+        grouped = {}
+        for message_id, (add, remove) in self.deltas.items():
+            if add or remove:
+                grouped.setdefault((frozenset(add), frozenset(remove)), []).append(message_id)
+        return grouped
+
+    def call_count(self):
+        return sum(-(-len(ids) // BATCH_MODIFY_LIMIT) for ids in self.groups().values())
+
+    def prune(self, session):
+        # drop label changes the mirror says are already in place; returns the mirrored labels
+        mirror = load_message_labels(session, self.deltas)
+        before = self.call_count()
+        for message_id, labels in mirror.items():
+            add, remove = self.deltas[message_id]
+            add -= labels
+            remove &= labels
+        self.calls_avoided += before - self.call_count()
+        return mirror
+
+    def execute(self, processor, service, session=None):
+        # returns (number of batchModify calls, ids Gmail confirmed, {id: error} for failed calls)
+        calls, confirmed, failed = 0, [], {}
+        read, unread = [], []
+        mirror = self.prune(session) if session is not None else {}
+        for (add, remove), ids in self.groups().items():
+            for i in range(0, len(ids), BATCH_MODIFY_LIMIT):
+                chunk = ids[i:i + BATCH_MODIFY_LIMIT]
+                calls += 1
+                try:
+                    processor.batch_modify(service, chunk, add_labels=sorted(add), remove_labels=sorted(remove))
+                except HttpError as err:
+                    logger.warning("batchModify of %d messages failed: %s", len(chunk), err)
+                    failed.update((message_id, err) for message_id in chunk)
+                    continue
+                confirmed.extend(chunk)
+                logger.debug("Modified %d messages (add=%s, remove=%s)", len(chunk), sorted(add), sorted(remove))
+                if session is not None:
+                    # messages the mirror has never seen stay out of it until a sync fetches them
+                    apply_label_changes(session, [i for i in chunk if i in mirror], add, remove)
+                if "UNREAD" in remove:
+                    read.extend(chunk)
+                elif "UNREAD" in add:
+                    unread.extend(chunk)
+        if session is not None:
+            with metrics.timer("db_write_seconds", op="action_state"):
+                self._store_read_state(session, read, True)
+                self._store_read_state(session, unread, False)
+                session.commit()
+        self.failed_deltas = {message_id: self.deltas[message_id] for message_id in failed}
+        self.deltas = {}
+        return calls, confirmed, failed
+
+    def requeue_failed(self, label_map=None):
+        # plan the rejected deltas again, optionally swapping stale label ids for fresh ones
+        label_map = label_map or {}
+        for message_id, (add, remove) in self.failed_deltas.items():
+            self.add(message_id, [label_map.get(l, l) for l in add], [label_map.get(l, l) for l in remove])
+        self.failed_deltas = {}
+
+    def _store_read_state(self, session, ids, is_read):
+        for i in range(0, len(ids), SQL_IN_CHUNK):
+            session.query(Email).filter(Email.message_id.in_(ids[i:i + SQL_IN_CHUNK])).update(
+                {"is_read": is_read}, synchronize_session=False
+            )
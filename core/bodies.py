@@ -0,0 +1,143 @@
+# bodies.py
+import base64
+import datetime
+import json
+import logging
+import re
+import zlib
+from core.fetcher import BatchFetcher
+from core.metrics import metrics
+from core.model import EmailBody, SQL_IN_CHUNK
+
+try:
+    import zstandard
+except ImportError:  # optional; zlib is always available
+    zstandard = None
+
+BODY_ATTR = "full_body"  # rule field attribute that needs the full message body
+METADATA_HEADERS = ("Subject", "From", "To")  # the headers the emails table keeps
+
+logger = logging.getLogger(__name__)
+
+_TAG_RE = re.compile(r"<[^>]+>")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def response_size(msg):
+    # size of the JSON Gmail sent for a message (before transport compression)
+    return len(json.dumps(msg, separators=(",", ":")))
+
+
+def compress(text, codec=None):
+    codec = codec or ("zstd" if zstandard is not None else "zlib")
+    data = text.encode("utf-8")
+    if codec == "zstd":
+        return codec, zstandard.ZstdCompressor(level=10).compress(data)
+    return "zlib", zlib.compress(data, 9)
+
+
+def decompress(codec, data):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("body was stored with zstd; install the zstandard package to read it")
+        return zstandard.ZstdDecompressor().decompress(data).decode("utf-8")
+    return zlib.decompress(data).decode("utf-8")
+
+
+def _decode(data):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4)).decode("utf-8", errors="replace")
+
+
+def _walk(part):
+    yield part
+    for child in part.get("parts", []) or []:
+        yield from _walk(child)
+
+
+def extract_body(msg):
+    # text/plain parts of a format="full" message; HTML with the tags stripped if there are none
+    plain, html = [], []
+    for part in _walk(msg.get("payload", {})):
+        data = (part.get("body") or {}).get("data")
+        if not data or part.get("filename"):
+            continue
+        mime = part.get("mimeType", "")
+        if mime == "text/plain":
+            plain.append(_decode(data))
+        elif mime == "text/html":
+            html.append(_decode(data))
+    if plain:
+        return "\n".join(plain)
+    return _SPACE_RE.sub(" ", _TAG_RE.sub(" ", "\n".join(html))).strip()
+
+
+def save_bodies(session, bodies):
+    # bodies maps message_id -> text; Gmail bodies never change, so a stored body is final
+    now = datetime.datetime.utcnow()
+    for message_id, text in bodies.items():
+        codec, data = compress(text)
+        session.merge(EmailBody(message_id=message_id, codec=codec, body=data,
+                                size=len(text.encode("utf-8")), fetched_at=now))
+
+
+def delete_bodies(session, message_ids):
+    ids = list(message_ids)
+    for i in range(0, len(ids), SQL_IN_CHUNK):
+        session.query(EmailBody).filter(EmailBody.message_id.in_(ids[i:i + SQL_IN_CHUNK])).delete(
+            synchronize_session=False
+        )
+
+
+class BodyStore(object):
+    # Full message bodies for rules that read them. Bodies are looked up in email_bodies
+    # first and fetched with format="full" only when missing; only the bodies of the chunk
+    # being evaluated are kept in memory. Ids whose fetch failed are kept in unavailable for
+    # the rest of the run: their bodies are unknown, not empty, and callers skip them.
+
+    def __init__(self, processor, service, session, batch_size=50, workers=4):
+        self.processor = processor
+        self.service = service
+        self.session = session
+        self.batch_size = batch_size
+        self.workers = workers
+        self.fetched = 0
+        self.bytes_downloaded = 0
+        self.unavailable = set()
+        self._cache = {}
+
+    def _load(self, ids):
+        for i in range(0, len(ids), SQL_IN_CHUNK):
+            query = self.session.query(EmailBody).filter(EmailBody.message_id.in_(ids[i:i + SQL_IN_CHUNK]))
+            for row in query:
+                self._cache[row.message_id] = decompress(row.codec, row.body)
+
+    def _fill(self, ids):
+        self._load(ids)
+        missing = [i for i in ids if i not in self._cache and i not in self.unavailable]
+        if not missing:
+            return
+        fetcher = BatchFetcher(self.service, http_pool=self.processor.http_pool, batch_size=self.batch_size,
+                               workers=self.workers, msg_format="full", scheduler=self.processor.scheduler)
+        fetched = {}
+        for msg in fetcher.fetch(missing):
+            size = response_size(msg)
+            self.bytes_downloaded += size
+            metrics.inc("gmail_bytes_downloaded_total", size, format="full")
+            fetched[msg["id"]] = extract_body(msg)
+        for msg_id, err in fetcher.failed.items():
+            logger.warning("Failed to fetch body of %s: %s", msg_id, err)
+            self.unavailable.add(msg_id)  # not refetched for every rule that reads it
+        save_bodies(self.session, fetched)
+        self.session.commit()
+        self._cache.update(fetched)
+        self.fetched += len(fetched)
+
+    def prefetch(self, message_ids):
+        # make the bodies of message_ids available, dropping those of the previous chunk
+        self._cache = {}
+        self._fill(list(dict.fromkeys(message_ids)))
+
+    def get(self, message_id):
+        if message_id not in self._cache and message_id not in self.unavailable:
+            self._fill([message_id])
+        return self._cache.get(message_id, "")
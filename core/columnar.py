@@ -0,0 +1,287 @@
+# columnar.py
+import datetime
+import hashlib
+import json
+import os
+from dateutil import parser as dateparser
+from sqlalchemy import func
+from core.model import Email
+from core.bodies import BODY_ATTR
+
+try:
+    import numpy as np
+except ImportError:  # optional; only the columnar backend needs it
+    np = None
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MISSING_DATE = -(2 ** 63)  # int64 stand-in for a NULL internal_date
+DEFAULT_SNAPSHOT_DIR = ".snapshots"
+NUMERIC_COLUMNS = ("id", "internal_date")  # int64 arrays; every other column is a StringColumn
+
+
+def to_micros(value):
+    # naive datetime -> int64 microseconds since the (naive) epoch
+    return (value - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def state_key(session):
+    # changes whenever rows are added, removed or rewritten by a sync
+    count, max_id, id_sum, updated = session.query(
+        func.count(Email.id), func.max(Email.id), func.sum(Email.id), func.max(Email.updated_at)
+    ).one()
+    payload = json.dumps([count, max_id, id_sum, str(updated)])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+class StringColumn(object):
+    # Lowercased strings as one UTF-8 buffer plus row offsets. A fixed-width <U array is as
+    # wide as its longest value in every row, so one 5,000 character subject would cost 20 KB
+    # per email. Each value is followed by a NUL byte, so a needle without NUL never matches
+    # across two rows; UTF-8 keeps byte matches aligned on characters.
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets  # int64, one per row plus one; row i ends with the NUL at offsets[i + 1] - 1
+        self.data = data  # uint8
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @classmethod
+    def from_values(cls, values):
+        encoded = [(v or "").lower().encode("utf-8") + b"\0" for v in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(v) for v in encoded], out=offsets[1:])
+        return cls(offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+    @classmethod
+    def concatenate(cls, parts):
+        if not parts:
+            return cls.from_values([])
+        shifts = np.cumsum([0] + [int(part.offsets[-1]) for part in parts[:-1]])
+        offsets = np.concatenate([parts[0].offsets[:1]] + [part.offsets[1:] + shift
+                                                           for part, shift in zip(parts, shifts)])
+        return cls(offsets, np.concatenate([part.data for part in parts]))
+
+    def tolist(self):
+        text = self.data.tobytes()
+        return [text[start:end - 1].decode("utf-8") for start, end in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def contains(self, needle, block=65536):
+        # needle is lowercased UTF-8 without NUL, so a match never crosses a row's NUL and
+        # lies in the row it starts in. Per block of rows, mark the bytes where the needle
+        # starts (whole-array compares for its first bytes, then filtering the few survivors)
+        # and OR them per row with reduceat.
+        target = np.frombuffer(needle, dtype=np.uint8)
+        mask = np.zeros(len(self), dtype=bool)
+        if not needle:
+            mask[:] = True
+            return mask
+        dense = min(len(target), 3)
+        for first in range(0, len(self), block):
+            starts = self.offsets[first:first + block + 1]
+            data = self.data[starts[0]:starts[-1]]
+            found = np.zeros(len(data), dtype=bool)
+            n = max(0, len(data) - len(target) + 1)
+            at = found[:n]
+            np.equal(data[:n], target[0], out=at)
+            for j in range(1, dense):
+                at &= data[j:j + n] == target[j]
+            if len(target) > dense:
+                hits = np.flatnonzero(at)
+                for j in range(dense, len(target)):
+                    hits = hits[data[hits + j] == target[j]]
+                at[:] = False
+                at[hits] = True
+            mask[first:first + len(starts) - 1] = np.logical_or.reduceat(found, starts[:-1] - starts[0])
+        return mask
+
+    def equals(self, needle, block=65536):
+        lengths = np.diff(self.offsets) - 1
+        candidates = np.flatnonzero(lengths == len(needle))
+        mask = np.zeros(len(self), dtype=bool)
+        if not needle:
+            mask[candidates] = True
+            return mask
+        target = np.frombuffer(needle, dtype=np.uint8)
+        for i in range(0, len(candidates), block):
+            rows = candidates[i:i + block]
+            index = self.offsets[rows][:, None] + np.arange(len(needle))
+            mask[rows] = (self.data[index] == target).all(axis=1)
+        return mask
+
+
+class ColumnarSnapshot(object):
+    # The emails columns rules read: lowercased strings as StringColumns and int64 dates.
+    # Arrays are saved as .npy files under snapshot_dir and memory-mapped by later runs until
+    # the database state key changes.
+
+    def __init__(self, columns, key):
+        self.columns = columns  # name -> array or StringColumn, all aligned with columns["id"]
+        self.key = key
+
+    def __len__(self):
+        return len(self.columns["id"])
+
+    @property
+    def ids(self):
+        return self.columns["id"]
+
+    @classmethod
+    def _directory(cls, db_url, snapshot_dir):
+        return os.path.join(snapshot_dir, hashlib.sha256(db_url.encode("utf-8")).hexdigest()[:12])
+
+    @classmethod
+    def load(cls, session, db_url, attrs, snapshot_dir=DEFAULT_SNAPSHOT_DIR, chunk_size=50000):
+        if np is None:
+            raise RuntimeError("the columnar backend needs numpy; install it or use the sql backend")
+        names = ["id"] + [attr for attr in attrs if attr != "id"]
+        key = state_key(session)
+        directory = cls._directory(db_url, snapshot_dir)
+        paths = {name: cls._paths(directory, key, name) for name in names}
+        if all(os.path.exists(path) for name in names for path in paths[name]):
+            return cls({name: cls._load_column(name, paths[name]) for name in names}, key)
+        snapshot = cls.build(session, names, key, chunk_size)
+        snapshot.save(directory, paths)
+        return snapshot
+
+    @staticmethod
+    def _paths(directory, key, name):
+        if name in NUMERIC_COLUMNS:
+            return [os.path.join(directory, f"{key}.{name}.npy")]
+        return [os.path.join(directory, f"{key}.{name}.{part}.npy") for part in ("offsets", "data")]
+
+    @staticmethod
+    def _load_column(name, paths):
+        arrays = [np.load(path, mmap_mode="r") for path in paths]
+        return arrays[0] if name in NUMERIC_COLUMNS else StringColumn(*arrays)
+
+    @classmethod
+    def build(cls, session, names, key, chunk_size=50000):
+        parts = {name: [] for name in names}
+        last_id = 0
+        while True:
+            # keyset pagination, so building never holds more than one chunk of ORM rows
+            query = session.query(*[getattr(Email, name) for name in names]).filter(Email.id > last_id)
+            rows = query.order_by(Email.id).limit(chunk_size).all()
+            if not rows:
+                break
+            for i, name in enumerate(names):
+                values = [row[i] for row in rows]
+                if name == "id":
+                    parts[name].append(np.array(values, dtype=np.int64))
+                elif name == "internal_date":
+                    parts[name].append(np.array([MISSING_DATE if v is None else to_micros(v) for v in values],
+                                                dtype=np.int64))
+                else:
+                    # str.lower(), not numpy's, so folding matches RuleProcessor exactly
+                    parts[name].append(StringColumn.from_values(values))
+            last_id = rows[-1][0]
+        columns = {}
+        for name in names:
+            if name not in NUMERIC_COLUMNS:
+                columns[name] = StringColumn.concatenate(parts[name])
+            elif parts[name]:
+                columns[name] = np.concatenate(parts[name])
+            else:
+                columns[name] = np.array([], dtype=np.int64)
+        return cls(columns, key)
+
+    def save(self, directory, paths):
+        os.makedirs(directory, exist_ok=True)
+        for name, column_paths in paths.items():
+            column = self.columns[name]
+            arrays = [column] if name in NUMERIC_COLUMNS else [column.offsets, column.data]
+            for array, path in zip(arrays, column_paths):
+                tmp = path + ".tmp.npy"
+                np.save(tmp, array)
+                os.replace(tmp, path)
+        # snapshots of older database states are never read again
+        for entry in os.listdir(directory):
+            if entry.endswith(".npy") and not entry.startswith(self.key + "."):
+                os.remove(os.path.join(directory, entry))
+
+
+class ColumnarEvaluator(object):
+    # Evaluates rules as boolean masks over a ColumnarSnapshot. A mask selects exactly the rows
+    # RuleProcessor.evaluate_condition accepts; conditions it cannot vectorize are returned as
+    # residuals, the same split RuleCompiler makes for SQL.
+
+    def __init__(self, rule_processor, snapshot):
+        self.rp = rule_processor
+        self.snapshot = snapshot
+
+    def _const(self, value):
+        return np.full(len(self.snapshot), value, dtype=bool)
+
+    def string_mask(self, field, pred, val):
+        if val is not None and not isinstance(val, str):
+            return None
+        pred_key = self.rp.predicate_aliases.get(pred)
+        if not pred_key:
+            return self._const(False)
+        target = self.snapshot.columns[self.rp.field_attr(field)]
+        val_s = (val or "").lower()
+        if "\0" in val_s:
+            return None  # NUL separates the rows of a StringColumn
+        needle = val_s.encode("utf-8")
+        if pred_key == "contains":
+            return target.contains(needle)
+        if pred_key == "does not contain":
+            return ~target.contains(needle)
+        if pred_key == "equals":
+            return target.equals(needle)
+        if pred_key == "does not equal":
+            return ~target.equals(needle)
+        return None
+
+    def date_mask(self, pred, val):
+        pred_key = self.rp.date_predicate_aliases.get(pred)
+        if not pred_key:
+            return self._const(False)
+        try:
+            if pred_key in ("less_than_days", "greater_than_days"):
+                boundary = datetime.datetime.now() - datetime.timedelta(days=int(val))
+            else:
+                boundary = dateparser.parse(val)
+            if boundary.tzinfo is not None:
+                return None  # stored dates are naive; Python decides what an aware boundary means
+            boundary = to_micros(boundary)
+        except (TypeError, ValueError, OverflowError, AttributeError):
+            return None
+        dates = self.snapshot.columns["internal_date"]
+        present = dates != MISSING_DATE
+        if pred_key in ("less_than_days", "greater_than"):
+            return present & (dates > boundary)
+        return present & (dates < boundary)
+
+    def condition_mask(self, cond):
+        try:
+            field = cond["field"].lower()
+            pred = cond["predicate"].lower()
+        except (KeyError, TypeError, AttributeError):
+            return None
+        val = cond.get("value")
+        if self.rp.field_attr(field) == BODY_ATTR:
+            return None
+        if field in self.rp.string_fields:
+            return self.string_mask(field, pred, val)
+        if field == "internal_date":
+            return self.date_mask(pred, val)
+        return self._const(False)
+
+    def rule_mask(self, rule):
+        # returns (candidate mask, conditions still to be checked in Python)
+        conditions = rule.get("conditions", [])
+        predicate = rule.get("predicate", "All").lower()
+        masks, residual = [], []
+        for cond in conditions:
+            mask = self.condition_mask(cond)
+            if mask is None:
+                residual.append(cond)
+            else:
+                masks.append(mask)
+        if predicate == "all":
+            return np.logical_and.reduce(masks + [self._const(True)]), residual
+        if residual:
+            return self._const(True), conditions
+        return np.logical_or.reduce(masks + [self._const(False)]), []
@@ -0,0 +1,167 @@
+# daemon.py
+import argparse
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from core.gmail_service import GmailProcessor
+from core.metrics import add_cli_arguments, cli_run, metrics
+from core.model import init_db
+from core.process_rules import RuleProcessor
+from core.scheduler import RequestScheduler
+
+logger = logging.getLogger(__name__)
+
+
+class TriggerHandler(BaseHTTPRequestHandler):
+    # POST /sync (or /push, standing in for a Pub/Sub push subscription) starts a cycle now;
+    # GET /status returns the timings of the last cycle, GET /metrics the Prometheus text export
+
+    def _reply(self, status, payload, content_type="application/json"):
+        body = (json.dumps(payload) if content_type == "application/json" else payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)  # push payloads only say "something changed"; history tells us what
+        if self.path in ("/sync", "/push"):
+            self.server.gmail_daemon.trigger()
+            self._reply(202, {"queued": True})
+        else:
+            self._reply(404, {"error": "unknown endpoint"})
+
+    def do_GET(self):
+        if self.path == "/status":
+            self._reply(200, self.server.gmail_daemon.status())
+        elif self.path == "/metrics":
+            self._reply(200, metrics.to_prometheus(), "text/plain; version=0.0.4")
+        else:
+            self._reply(404, {"error": "unknown endpoint"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GmailDaemon(object):
+    # Keeps the authorized Gmail client, its connection pool, the DB engine and the compiled
+    # rules alive between cycles, so a cycle only pays for the sync and the rule run itself.
+
+    def __init__(self, db_url, rules_path, interval=300, port=None, single_pass=False, max_results=None,
+                 batch_size=50, workers=4, fts=False, gmail_processor=None, metrics_out=None):
+        self.db_url = db_url
+        self.rules_path = rules_path
+        self.interval = interval
+        self.port = port
+        self.single_pass = single_pass
+        self.max_results = max_results
+        self.batch_size = batch_size
+        self.workers = workers
+        self.fts = fts
+        self.metrics_out = metrics_out
+        self.gmail = gmail_processor or GmailProcessor()
+        self.rules = RuleProcessor(self.gmail)
+        self.service = None
+        self.server = None
+        self.cycles = 0
+        self.last_cycle = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._loaded_rules = None
+
+    def trigger(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def status(self):
+        return {"cycles": self.cycles, "last_cycle": self.last_cycle}
+
+    def start(self):
+        started = time.monotonic()
+        self.service = self.gmail.get_gmail_service()
+        init_db(self.db_url, fts=self.fts)
+        self._loaded_rules = self.rules.load_rules(self.rules_path)
+        logger.info("Daemon ready in %.2fs (%d rules)", time.monotonic() - started, len(self._loaded_rules))
+        if self.port is not None:
+            self.server = ThreadingHTTPServer(("127.0.0.1", self.port), TriggerHandler)
+            self.server.gmail_daemon = self
+            self.port = self.server.server_address[1]
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            logger.info("Listening for triggers on http://127.0.0.1:%d/sync", self.port)
+
+    def run_cycle(self):
+        started = time.monotonic()
+        rules = self.rules.load_rules(self.rules_path)
+        if rules is not self._loaded_rules:
+            logger.info("Reloaded %s (%d rules)", self.rules_path, len(rules))
+            self._loaded_rules = rules
+        self.gmail.fetch_and_store(self.db_url, self.max_results, self.batch_size, self.workers,
+                                   fts=self.fts, service=self.service)
+        synced = time.monotonic()
+        self.rules.run_rules(self.db_url, self.rules_path, single_pass=self.single_pass, service=self.service,
+                             incremental=True)
+        finished = time.monotonic()
+        self.cycles += 1
+        self.last_cycle = {
+            "finished_at": datetime.now().isoformat(timespec="seconds"),
+            "sync_seconds": round(synced - started, 3),
+            "rules_seconds": round(finished - synced, 3),
+            "total_seconds": round(finished - started, 3),
+        }
+        metrics.observe("daemon_cycle_seconds", finished - started)
+        logger.info("Cycle %d: sync %.2fs, rules %.2fs, total %.2fs",
+                    self.cycles, synced - started, finished - synced, finished - started)
+        if self.metrics_out:
+            # rewritten every cycle so a scraper or tail sees a long-running daemon's numbers
+            metrics.write(self.metrics_out)
+        return self.last_cycle
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while not self._stop.is_set():
+                self._wake.clear()
+                try:
+                    self.run_cycle()
+                except Exception as err:
+                    # keep the daemon alive; the next cycle retries from the stored historyId
+                    logger.exception("Cycle failed: %s", err)
+                self._wake.wait(self.interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default="sqlite:///emails.db")
+    parser.add_argument("--rules", default="core/rules.json")
+    parser.add_argument("--interval", type=float, default=300, help="seconds between cycles when not triggered")
+    parser.add_argument("--port", type=int, help="serve POST /sync and GET /status on this localhost port")
+    parser.add_argument("--max", dest="max_results", type=int, default=0, help="cap for a full sync (0 = whole inbox)")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--single-pass", action="store_true")
+    parser.add_argument("--fts", action="store_true")
+    parser.add_argument("--quota", type=float, default=250, help="Gmail quota units to spend per second")
+    add_cli_arguments(parser)
+    args = parser.parse_args()
+    with cli_run(args):
+        GmailDaemon(args.db, args.rules, interval=args.interval, port=args.port, single_pass=args.single_pass,
+                    max_results=args.max_results or None, batch_size=args.batch_size, workers=args.workers,
+                    fts=args.fts, metrics_out=args.metrics_out,
+                    gmail_processor=GmailProcessor(scheduler=RequestScheduler(quota_per_second=args.quota))
+                    ).serve_forever()
@@ -0,0 +1,135 @@
+# fetcher.py
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from core.scheduler import QUOTA_UNITS, RequestScheduler, is_retryable, is_throttle
+
+GMAIL_BATCH_LIMIT = 100  # Gmail rejects batch requests with more than 100 calls
+
+
+class HttpPool(object):
+    # Idle connections made by factory. httplib2 connections are not thread safe, so each is
+    # checked out by one worker at a time; a pool that outlives its fetchers lets the next
+    # sync reuse open TLS connections instead of handshaking again.
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return self.factory()
+
+    def put(self, http):
+        if http is None:
+            return  # the factory had no credentials yet; ask again next time
+        with self.lock:
+            self.idle.append(http)
+
+
+class BatchFetcher(object):
+
+    def __init__(self, service, http_factory=None, batch_size=50, workers=4,
+                 max_retries=3, msg_format="full", scheduler=None, metadata_headers=None, http_pool=None):
+        if not 1 <= batch_size <= GMAIL_BATCH_LIMIT:
+            raise ValueError(f"batch_size must be between 1 and {GMAIL_BATCH_LIMIT}")
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self.service = service
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_retries = max_retries
+        self.msg_format = msg_format
+        self.metadata_headers = list(metadata_headers or [])  # only used with msg_format="metadata"
+        self.scheduler = scheduler or RequestScheduler()
+        if http_pool is None and http_factory is not None:
+            http_pool = HttpPool(http_factory)
+        self.http_pool = http_pool  # None sends batches over the service's own connection
+        self.failed = {}
+
+    def _get_request(self, msg_id):
+        if self.msg_format == "metadata" and self.metadata_headers:
+            return self.service.users().messages().get(userId="me", id=msg_id, format="metadata",
+                                                        metadataHeaders=self.metadata_headers)
+        return self.service.users().messages().get(userId="me", id=msg_id, format=self.msg_format)
+
+    def _execute_batch(self, ids, http=None):
+        results, errors = {}, {}
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                errors[request_id] = exception
+            else:
+                results[request_id] = response
+
+        batch = self.service.new_batch_http_request(callback=callback)
+        for msg_id in ids:
+            batch.add(self._get_request(msg_id), request_id=msg_id)
+        # a batch costs the quota of every call inside it
+        self.scheduler.execute(batch, "batch", units=QUOTA_UNITS["messages.get"] * len(ids), http=http)
+        return results, errors
+
+    def _fetch_chunk(self, ids):
+        if self.http_pool is None:
+            return self._fetch_with(ids, None)
+        http = self.http_pool.get()
+        try:
+            return self._fetch_with(ids, http)
+        finally:
+            self.http_pool.put(http)
+
+    def _fetch_with(self, ids, http):
+        messages, failed = [], {}
+        pending = list(ids)
+        attempt = 0
+        while pending:
+            results, errors = self._execute_batch(pending, http)
+            messages.extend(results.values())
+            retry, delay = [], 0.0
+            for msg_id, err in errors.items():
+                if is_retryable(err) and attempt < self.max_retries:
+                    retry.append(msg_id)
+                    delay = max(delay, self.scheduler.backoff_delay(attempt, err))
+                else:
+                    failed[msg_id] = err
+            if not retry:
+                break
+            if any(is_throttle(errors[msg_id]) for msg_id in retry):
+                self.scheduler.on_throttle()
+            # only the calls that failed go into the next batch
+            time.sleep(delay)
+            attempt += 1
+            pending = retry
+        return messages, failed
+
+    def fetch(self, ids):
+        ids = list(ids)
+        chunks = [ids[i:i + self.batch_size] for i in range(0, len(ids), self.batch_size)]
+        self.failed = {}
+        if self.workers == 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                messages, failed = self._fetch_chunk(chunk)
+                self.failed.update(failed)
+                yield from messages
+            return
+
+        # keep a bounded number of batches in flight so memory does not grow with the mailbox
+        pending_chunks = iter(chunks)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            in_flight = set()
+            for chunk in pending_chunks:
+                in_flight.add(pool.submit(self._fetch_chunk, chunk))
+                if len(in_flight) >= self.workers * 2:
+                    break
+            while in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    messages, failed = fut.result()
+                    self.failed.update(failed)
+                    yield from messages
+                    nxt = next(pending_chunks, None)
+                    if nxt is not None:
+                        in_flight.add(pool.submit(self._fetch_chunk, nxt))
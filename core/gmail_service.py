@@ -2,26 +2,44 @@
 import os
 import pickle
 import argparse
+import logging
+import time
+import httplib2
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from core.model import Email, init_db, get_session
-from sqlalchemy.exc import IntegrityError
+from googleapiclient.errors import HttpError
+from core.model import (
+    SQL_IN_CHUNK, Email, PendingFetch, SyncState, init_db, get_session, upsert_emails, delete_message_labels
+)
+from core.bodies import METADATA_HEADERS, delete_bodies, extract_body, response_size, save_bodies
+from core.fetcher import BatchFetcher, HttpPool
+from core.labels import LabelRegistry
+from core.scheduler import RequestScheduler
+from core.metrics import add_cli_arguments, cli_run, metrics
 from datetime import datetime
 from dateutil import tz
 
 SCOPES = ["https://www.googleapis.com/auth/gmail.modify"]  # need modify to mark/move later
+HISTORY_TYPES = ["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"]
+LIST_PAGE_LIMIT = 500  # largest maxResults messages.list accepts
+
+logger = logging.getLogger(__name__)
 
 
 
 class GmailProcessor(object):
 
-    def __init__(self, credentials_file="core/credentials.json", token_file="core/token.pickle"):
+    def __init__(self, credentials_file="core/credentials.json", token_file="core/token.pickle", scheduler=None):
         self.CREDENTIALS_FILE = credentials_file
         self.TOKEN_FILE = token_file
+        self.creds = None
+        self.scheduler = scheduler or RequestScheduler()
+        self.http_pool = HttpPool(self.new_http)  # fetch connections stay open from one sync to the next
 
-
-    def get_gmail_service(self,):
+    def get_gmail_service(self, interactive=True):
+        # interactive=False raises instead of opening the browser flow, for headless workers
         creds = None
         if os.path.exists(self.TOKEN_FILE):
             with open(self.TOKEN_FILE, "rb") as f:
@@ -29,21 +47,44 @@ class GmailProcessor(object):
         if not creds or not creds.valid:
             if creds and creds.expired and creds.refresh_token:
                 creds.refresh(Request())
+            elif not interactive:
+                raise RuntimeError(f"{self.TOKEN_FILE} has no usable credentials; authorize it once with "
+                                   "core.gmail_service")
             else:
                 flow = InstalledAppFlow.from_client_secrets_file(self.CREDENTIALS_FILE, SCOPES)
                 creds = flow.run_local_server(port=0)
             with open(self.TOKEN_FILE, "wb") as f:
                 pickle.dump(creds, f)
-        service = build("gmail", "v1", credentials=creds)
+        self.creds = creds
+        # the discovery document shipped with googleapiclient; no discovery fetch on startup
+        service = build("gmail", "v1", credentials=creds, static_discovery=True, cache_discovery=False)
         return service
     
+    def execute(self, request, method):
+        # every Gmail call is paced, throttled and retried by the shared scheduler
+        return self.scheduler.execute(request, method)
+
+    def new_http(self):
+        # a fresh authorized connection for fetch workers; None falls back to the service's own
+        if self.creds is None:
+            return None
+        return AuthorizedHttp(self.creds, http=httplib2.Http())
+
     def msg_mark_modify(self, service, msg_id, add_labels=None, remove_labels=None):
         body = {}
         if add_labels:
             body["addLabelIds"] = add_labels
         if remove_labels:
             body["removeLabelIds"] = remove_labels
-        return service.users().messages().modify(userId="me", id=msg_id, body=body).execute()
+        return self.execute(service.users().messages().modify(userId="me", id=msg_id, body=body), "messages.modify")
+
+    def batch_modify(self, service, msg_ids, add_labels=None, remove_labels=None):
+        body = {"ids": list(msg_ids)}
+        if add_labels:
+            body["addLabelIds"] = add_labels
+        if remove_labels:
+            body["removeLabelIds"] = remove_labels
+        return self.execute(service.users().messages().batchModify(userId="me", body=body), "messages.batchModify")
 
     def iso_from_internal_date(self, ms):
         # Gmail internalDate is milliseconds since epoch in string
@@ -53,56 +94,225 @@ class GmailProcessor(object):
         except Exception:
             return None
 
-    def ensure_label(self, service, label_name):
-        res = service.users().labels().list(userId="me").execute()
-        labels = res.get("labels", [])
-        for lbl in labels:
-            if lbl["name"].lower() == label_name.lower():
-                return lbl["id"]
+    def list_labels(self, service):
+        return self.execute(service.users().labels().list(userId="me"), "labels.list").get("labels", [])
+
+    def create_label(self, service, label_name):
         body = {"name": label_name, "labelListVisibility": "labelShow", "messageListVisibility": "show"}
-        created = service.users().labels().create(userId="me", body=body).execute()
-        return created["id"]
+        return self.execute(service.users().labels().create(userId="me", body=body), "labels.create")
+
+    def ensure_label(self, service, label_name):
+        return LabelRegistry(self, service).ensure(label_name)
 
-    def fetch_and_store(self, db_url="sqlite:///emails.db", max_results=1):
-        init_db(db_url)
+    def parse_message(self, msg):
+        headers = msg.get("payload", {}).get("headers", [])
+        header_map = {h["name"].lower(): h["value"] for h in headers}
+        return {
+            "message_id": msg["id"],
+            "thread_id": msg.get("threadId"),
+            "subject": header_map.get("subject", ""),
+            "sender": header_map.get("from", ""),
+            "to": header_map.get("to", ""),
+            "snippet": msg.get("snippet", ""),
+            "internal_date": self.iso_from_internal_date(msg.get("internalDate", "0")),
+            "is_read": "UNREAD" not in msg.get("labelIds", []),
+            "label_ids": msg.get("labelIds", []),
+        }
+
+    def list_message_ids(self, service, max_results=None, label_ids=("INBOX",)):
+        # follows nextPageToken until the mailbox (or max_results) is exhausted
+        ids = []
+        page_token = None
+        while max_results is None or len(ids) < max_results:
+            page_size = LIST_PAGE_LIMIT if max_results is None else min(LIST_PAGE_LIMIT, max_results - len(ids))
+            kwargs = {"userId": "me", "labelIds": list(label_ids), "maxResults": page_size}
+            if page_token:
+                kwargs["pageToken"] = page_token
+            results = self.execute(service.users().messages().list(**kwargs), "messages.list")
+            ids.extend(m["id"] for m in results.get("messages", []))
+            page_token = results.get("nextPageToken")
+            if not page_token:
+                break
+        return ids if max_results is None else ids[:max_results]
+
+    def history_changes(self, service, start_history_id):
+        # returns ({id: whether a change put it in INBOX}, deleted ids, latest historyId) since
+        # start_history_id; the caller keeps the INBOX ids and those it already stores
+        changed, deleted = {}, set()
+        latest = start_history_id
+        page_token = None
+        while True:
+            kwargs = {"userId": "me", "startHistoryId": start_history_id, "historyTypes": HISTORY_TYPES}
+            if page_token:
+                kwargs["pageToken"] = page_token
+            results = self.execute(service.users().history().list(**kwargs), "history.list")
+            for record in results.get("history", []):
+                for item in record.get("messagesAdded", []):
+                    msg = item["message"]
+                    changed[msg["id"]] = changed.get(msg["id"], False) or "INBOX" in msg.get("labelIds", [])
+                for key in ("labelsAdded", "labelsRemoved"):
+                    for item in record.get(key, []):
+                        msg = item["message"]
+                        changed[msg["id"]] = changed.get(msg["id"], False) or "INBOX" in item.get("labelIds", [])
+                for item in record.get("messagesDeleted", []):
+                    deleted.add(item["message"]["id"])
+            latest = results.get("historyId", latest)
+            page_token = results.get("nextPageToken")
+            if not page_token:
+                break
+        return changed, deleted, latest
+
+    def _known_ids(self, session, ids=None):
+        if ids is None:
+            return {row[0] for row in session.query(Email.message_id)}
+        ids = list(ids)
+        known = set()
+        for i in range(0, len(ids), SQL_IN_CHUNK):
+            query = session.query(Email.message_id).filter(Email.message_id.in_(ids[i:i + SQL_IN_CHUNK]))
+            known.update(row[0] for row in query)
+        return known
+
+    def _store_messages(self, session, service, ids, batch_size, workers, chunk_size, msg_format="metadata"):
+        # "metadata" downloads only the stored headers; "full" also keeps the compressed bodies
+        fetcher = BatchFetcher(service, http_pool=self.http_pool, batch_size=batch_size, workers=workers,
+                               msg_format=msg_format, scheduler=self.scheduler, metadata_headers=METADATA_HEADERS)
+        started = time.monotonic()
+        fetched = downloaded = 0
+        chunk, bodies = [], {}
+        debug = logger.isEnabledFor(logging.DEBUG)  # checked once, not per message
+        for msg in fetcher.fetch(ids):
+            fetched += 1
+            downloaded += response_size(msg)
+            row = self.parse_message(msg)
+            chunk.append(row)
+            if msg_format == "full":
+                bodies[msg["id"]] = extract_body(msg)
+            if debug:
+                logger.debug("Stored: %s", row["subject"])
+            if len(chunk) >= chunk_size:
+                save_bodies(session, bodies)
+                upsert_emails(session, chunk)
+                chunk, bodies = [], {}
+        save_bodies(session, bodies)
+        upsert_emails(session, chunk)
+        elapsed = time.monotonic() - started
+        gone, failed = set(), {}
+        for msg_id, err in fetcher.failed.items():
+            if getattr(getattr(err, "resp", None), "status", None) == 404:
+                gone.add(msg_id)  # deleted between listing and fetching
+            else:
+                failed[msg_id] = err
+                logger.warning("Failed to fetch %s, retrying next sync: %s", msg_id, err)
+        metrics.inc("gmail_bytes_downloaded_total", downloaded, format=msg_format)
+        if fetched and elapsed > 0:
+            logger.info("Fetched %d messages in %.2fs (%.1f msg/s)", fetched, elapsed, fetched / elapsed)
+        if fetched:
+            logger.info("Downloaded %d bytes with format=%s (%.0f bytes/message)", downloaded, msg_format,
+                        downloaded / fetched)
+        return gone, failed
+
+    def _delete_messages(self, session, ids):
+        if not ids:
+            return
+        with metrics.timer("db_write_seconds", op="delete_messages"):
+            ids = list(ids)
+            for i in range(0, len(ids), SQL_IN_CHUNK):
+                session.query(Email).filter(Email.message_id.in_(ids[i:i + SQL_IN_CHUNK])).delete(
+                    synchronize_session=False
+                )
+            delete_message_labels(session, ids)
+            delete_bodies(session, ids)
+            session.commit()
+        logger.info("Removed %d deleted messages", len(ids))
+
+    def _pending_ids(self, session):
+        return {row[0] for row in session.query(PendingFetch.message_id)}
+
+    def _save_pending(self, session, failed, done=None):
+        # failed fetches are queued for the next sync, since the saved historyId moves past them;
+        # done=None drops the whole queue (a full sync has just re-listed the mailbox)
+        if done is None:
+            session.query(PendingFetch).delete(synchronize_session=False)
+        else:
+            done = [i for i in done if i not in failed]
+            for i in range(0, len(done), SQL_IN_CHUNK):
+                session.query(PendingFetch).filter(PendingFetch.message_id.in_(done[i:i + SQL_IN_CHUNK])).delete(
+                    synchronize_session=False
+                )
+        now = datetime.utcnow()
+        for msg_id, err in failed.items():
+            session.merge(PendingFetch(message_id=msg_id, error=str(err)[:500], updated_at=now))
+        session.commit()
+
+    def _save_history_id(self, session, history_id):
+        session.merge(SyncState(account="me", history_id=str(history_id), updated_at=datetime.utcnow()))
+        session.commit()
+
+    def full_sync(self, session, service, max_results=None, batch_size=50, workers=4, chunk_size=500,
+                  msg_format="metadata"):
+        # take the historyId before listing so changes made during the sync are replayed next time
+        history_id = self.execute(service.users().getProfile(userId="me"), "getProfile").get("historyId")
+        ids = self.list_message_ids(service, max_results)
+        known_ids = self._known_ids(session, ids)
+        new_ids = [i for i in ids if i not in known_ids]
+        logger.info("Found %d messages, %d to fetch", len(ids), len(new_ids))
+        _, failed = self._store_messages(session, service, new_ids, batch_size, workers, chunk_size, msg_format)
+        self._save_pending(session, failed)
+        if history_id:
+            self._save_history_id(session, history_id)
+
+    def incremental_sync(self, session, service, start_history_id, batch_size=50, workers=4, chunk_size=500,
+                         msg_format="metadata"):
+        changed, deleted, latest = self.history_changes(service, start_history_id)
+        # only the ids history mentions are looked up, not every stored message
+        known_ids = self._known_ids(session, changed.keys() | deleted)
+        to_fetch = {msg_id for msg_id, inbox in changed.items() if inbox or msg_id in known_ids} - deleted
+        pending = self._pending_ids(session)
+        to_fetch |= pending - deleted
+        logger.info("History since %s: %d to fetch (%d retried), %d deleted", start_history_id, len(to_fetch),
+                    len(pending - deleted), len(deleted))
+        gone, failed = self._store_messages(session, service, sorted(to_fetch), batch_size, workers, chunk_size,
+                                            msg_format)
+        self._delete_messages(session, (deleted | gone) & known_ids)
+        self._save_pending(session, failed, to_fetch | deleted)
+        self._save_history_id(session, latest)
+
+    def fetch_and_store(self, db_url="sqlite:///emails.db", max_results=1, batch_size=50, workers=4, full=False,
+                        chunk_size=500, fts=False, service=None, msg_format="metadata"):
+        init_db(db_url, fts=fts)
         session = get_session(db_url)
-        service = self.get_gmail_service()
-
-        results = service.users().messages().list(userId="me", labelIds=["INBOX"], maxResults=max_results).execute()
-        messages = results.get("messages", [])
-        print(f"Found {len(messages)} messages to fetch")
-        for m in messages:
-            msg = service.users().messages().get(userId="me", id=m["id"], format="full").execute()
-            headers = msg.get("payload", {}).get("headers", [])
-            header_map = {h["name"].lower(): h["value"] for h in headers}
-            subject = header_map.get("subject", "")
-            sender = header_map.get("from", "")
-            to = header_map.get("to", "")
-            snippet = msg.get("snippet", "")
-            internal_date = self.iso_from_internal_date(msg.get("internalDate", "0"))
-            is_read = "UNREAD" not in msg.get("labelIds", [])
-            email = Email(
-                message_id=msg["id"],
-                thread_id=msg.get("threadId"),
-                subject=subject,
-                sender=sender,
-                to=to,
-                snippet=snippet,
-                internal_date=internal_date,
-                is_read=is_read,
-            )
+        service = service or self.get_gmail_service()
+
+        state = session.get(SyncState, "me")
+        if state is not None and state.history_id and not full:
             try:
-                session.add(email)
-                session.commit()
-                print("Stored:", subject)
-            except IntegrityError:
+                self.incremental_sync(session, service, state.history_id, batch_size, workers, chunk_size,
+                                      msg_format)
+                session.close()
+                return
+            except HttpError as err:
+                if err.resp.status != 404:
+                    raise
                 session.rollback()
-                print("Already stored:", subject)
+                logger.warning("Stored historyId has expired; falling back to a full sync")
+        self.full_sync(session, service, max_results, batch_size, workers, chunk_size, msg_format)
         session.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--db", default="sqlite:///emails.db")
-    parser.add_argument("--max", dest="max_results", type=int, default=100)
+    parser.add_argument("--max", dest="max_results", type=int, default=100, help="cap for a full sync (0 = whole inbox)")
+    parser.add_argument("--batch-size", type=int, default=50, help="messages per Gmail batch request (max 100)")
+    parser.add_argument("--workers", type=int, default=4, help="batch requests kept in flight concurrently")
+    parser.add_argument("--full", action="store_true", help="ignore the stored historyId and re-list the inbox")
+    parser.add_argument("--chunk-size", type=int, default=500, help="parsed messages written per database transaction")
+    parser.add_argument("--fts", action="store_true", help="maintain a SQLite FTS5 index for contains rules")
+    parser.add_argument("--quota", type=float, default=250, help="Gmail quota units to spend per second")
+    parser.add_argument("--format", dest="msg_format", choices=("metadata", "full"), default="metadata",
+                        help="metadata fetches headers only; full also stores compressed bodies")
+    add_cli_arguments(parser)
     args = parser.parse_args()
-    GmailProcessor().fetch_and_store(args.db, args.max_results)
+    with cli_run(args):
+        processor = GmailProcessor(scheduler=RequestScheduler(quota_per_second=args.quota))
+        processor.fetch_and_store(args.db, args.max_results or None, args.batch_size, args.workers, args.full,
+                                  args.chunk_size, args.fts, msg_format=args.msg_format)
@@ -0,0 +1,93 @@
+# incremental.py
+import datetime
+import hashlib
+import json
+from sqlalchemy import and_, or_
+from core.model import Email, RuleWatermark
+
+DAY_PREDICATES = ("less_than_days", "greater_than_days")
+
+
+def rule_hash(rule):
+    # any edit to a rule (conditions, predicate, actions or name) gives it a new hash
+    payload = json.dumps(rule, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def utc_to_local(value):
+    # internal_date is stored as naive local time; watermarks are naive UTC
+    return value.replace(tzinfo=datetime.timezone.utc).astimezone().replace(tzinfo=None)
+
+
+class EvaluationScope(object):
+    # Decides which emails a rule still has to see. A rule whose hash has a watermark only needs
+    # emails written since that run, plus emails whose internal_date lies where a
+    # less_than_days / greater_than_days boundary moved since then. New or edited rules see everything.
+
+    def __init__(self, rule_processor, session):
+        self.rp = rule_processor
+        self.session = session
+        self.started_at = datetime.datetime.utcnow()
+        self.local_now = datetime.datetime.now()
+        self.watermarks = {row.rule_hash: row.evaluated_at for row in session.query(RuleWatermark)}
+        self._resolved = {}  # id(rule) -> None (whole table) or (evaluated_at, day windows)
+
+    def _day_windows(self, rule, evaluated_at):
+        # (earliest, latest) internal_date ranges a moving day boundary crossed; None if unbounded
+        previous = utc_to_local(evaluated_at)
+        windows = []
+        for cond in rule.get("conditions", []):
+            try:
+                field = cond["field"].lower()
+                pred = self.rp.date_predicate_aliases.get(cond["predicate"].lower())
+            except (KeyError, TypeError, AttributeError):
+                continue
+            if field != "internal_date" or pred not in DAY_PREDICATES:
+                continue
+            try:
+                days = datetime.timedelta(days=int(cond.get("value")))
+            except (TypeError, ValueError, OverflowError):
+                return None
+            windows.append((previous - days, self.local_now - days))
+        return windows
+
+    def _resolve(self, rule):
+        key = id(rule)
+        if key not in self._resolved:
+            evaluated_at = self.watermarks.get(rule_hash(rule))
+            windows = self._day_windows(rule, evaluated_at) if evaluated_at is not None else None
+            self._resolved[key] = None if windows is None else (evaluated_at, windows)
+        return self._resolved[key]
+
+    def clause(self, rule):
+        # SQL filter limiting the rule to the emails it has not yet been evaluated against;
+        # None means the whole table
+        resolved = self._resolve(rule)
+        if resolved is None:
+            return None
+        evaluated_at, windows = resolved
+        parts = [Email.updated_at > evaluated_at]
+        parts += [and_(Email.internal_date >= lo, Email.internal_date <= hi) for lo, hi in windows]
+        return or_(*parts)
+
+    def contains(self, rule, row):
+        # Python twin of clause() for single-pass runs, where rows are loaded once for every rule
+        resolved = self._resolve(rule)
+        if resolved is None:
+            return True
+        evaluated_at, windows = resolved
+        updated_at = getattr(row, "updated_at", None)
+        if updated_at is not None and updated_at > evaluated_at:
+            return True
+        internal_date = getattr(row, "internal_date", None)
+        return internal_date is not None and any(lo <= internal_date <= hi for lo, hi in windows)
+
+    def commit(self, rules):
+        # advance every rule's watermark to the start of this run and forget rules that are gone
+        hashes = {rule_hash(rule) for rule in rules}
+        self.session.query(RuleWatermark).filter(RuleWatermark.rule_hash.notin_(hashes)).delete(
+            synchronize_session=False
+        )
+        for digest in hashes:
+            self.session.merge(RuleWatermark(rule_hash=digest, evaluated_at=self.started_at))
+        self.session.commit()
@@ -0,0 +1,78 @@
+# labels.py
+import datetime
+from core.model import Label
+
+LABEL_CACHE_TTL = datetime.timedelta(hours=1)
+
+
+class LabelRegistry(object):
+
+    def __init__(self, processor, service, session=None, ttl=LABEL_CACHE_TTL):
+        self.processor = processor
+        self.service = service
+        self.session = session
+        self.ttl = ttl
+        self.by_name = {}  # lowercase label name -> label id
+        self.loaded_at = None
+        self.synced = False  # True once this registry has listed labels from Gmail
+        self.api_calls = 0
+        if session is not None:
+            self._load()
+
+    def _load(self):
+        rows = self.session.query(Label).all()
+        if rows:
+            self.by_name = {row.name_lower: row.label_id for row in rows}
+            self.loaded_at = min(row.updated_at for row in rows)
+
+    def _expired(self):
+        return self.loaded_at is None or datetime.datetime.utcnow() - self.loaded_at > self.ttl
+
+    def _persist(self, labels, replace=False):
+        if self.session is None:
+            return
+        now = datetime.datetime.utcnow()
+        if replace:
+            self.session.query(Label).delete(synchronize_session=False)
+        for lbl in labels:
+            self.session.merge(Label(label_id=lbl["id"], name=lbl["name"], name_lower=lbl["name"].lower(),
+                                     updated_at=now))
+        self.session.commit()
+
+    def refresh(self):
+        labels = self.processor.list_labels(self.service)
+        self.api_calls += 1
+        self.by_name = {lbl["name"].lower(): lbl["id"] for lbl in labels}
+        self.loaded_at = datetime.datetime.utcnow()
+        self.synced = True
+        self._persist(labels, replace=True)
+
+    def get(self, label_name):
+        key = label_name.lower()
+        if self._expired() or (key not in self.by_name and not self.synced):
+            # after one listing in this run a miss means the label really does not exist
+            self.refresh()
+        return self.by_name.get(key)
+
+    def ensure(self, label_name):
+        label_id = self.get(label_name)
+        if label_id is not None:
+            return label_id
+        # Gmail nests "Finance/Groww" under "Finance"; create missing parents first
+        parts = label_name.split("/")
+        for depth in range(1, len(parts) + 1):
+            name = "/".join(parts[:depth])
+            label_id = self.get(name)
+            if label_id is None:
+                created = self.processor.create_label(self.service, name)
+                self.api_calls += 1
+                label_id = created["id"]
+                self.by_name[name.lower()] = label_id
+                self._persist([{"id": label_id, "name": name}])
+        return label_id
+
+    def invalidate(self, label_id):
+        # a 404 on a cached id means it was deleted or renamed; relist on the next lookup
+        self.by_name = {name: lid for name, lid in self.by_name.items() if lid != label_id}
+        self.loaded_at = None
+        self.synced = False
@@ -0,0 +1,134 @@
+# matcher.py
+from collections import deque
+
+
+class AhoCorasick(object):
+    # finds every needle occurring in a text with one left-to-right scan
+
+    def __init__(self, needles):
+        self.needles = list(needles)
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+        for index, needle in enumerate(self.needles):
+            self._insert(needle, index)
+        self._build()
+
+    def _insert(self, needle, index):
+        state = 0
+        for ch in needle:
+            nxt = self.goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[state][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(())
+            state = nxt
+        self.out[state] = self.out[state] + (index,)
+
+    def _build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                fallback = self.fail[state]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[nxt] = self.goto[fallback].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def find(self, text):
+        # returns the set of needle indexes found in text
+        found = set()
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+class RuleIndex(object):
+    # Compiles every rule once so a single pass over an email's fields answers all string
+    # conditions together: contains needles share one automaton per field, equals values
+    # live in hash sets. Other conditions are left to RuleProcessor.evaluate_condition, and
+    # Full Body conditions are kept apart so bodies are only fetched when they can matter.
+
+    def __init__(self, rule_processor, rules):
+        self.rp = rule_processor
+        self.needles = {}  # attr -> {needle: index}
+        self.equals = {}  # attr -> set of lowered values
+        self.rules = []
+        for rule in rules:
+            predicate = rule.get("predicate", "All").lower()
+            conditions = rule.get("conditions", [])
+            body = [cond for cond in conditions if rule_processor.reads_body([cond])]
+            checks = [self._compile(cond) for cond in conditions if not rule_processor.reads_body([cond])]
+            self.rules.append((rule, predicate, checks, body))
+        self.automata = {attr: AhoCorasick(needles) for attr, needles in self.needles.items()}
+
+    def _compile(self, cond):
+        try:
+            field = cond["field"].lower()
+            pred = cond["predicate"].lower()
+        except (KeyError, TypeError, AttributeError):
+            return ("python", cond)
+        val = cond.get("value")
+        if field not in self.rp.string_fields or (val is not None and not isinstance(val, str)):
+            return ("python", cond)
+        pred_key = self.rp.predicate_aliases.get(pred)
+        if not pred_key:
+            return ("const", False)
+        attr = self.rp.field_attr(field)
+        val_s = (val or "").lower()
+        if pred_key in ("contains", "does not contain"):
+            if not val_s:
+                return ("const", pred_key == "contains")
+            index = self.needles.setdefault(attr, {}).setdefault(val_s, len(self.needles[attr]))
+            return (pred_key, attr, index)
+        self.equals.setdefault(attr, set()).add(val_s)
+        return (pred_key, attr, val_s)
+
+    def field_matches(self, email_obj):
+        # one scan per field: {attr: (needle indexes found, lowered value if it is an equals target)}
+        hits = {}
+        for attr in set(self.automata) | set(self.equals):
+            text = (getattr(email_obj, attr, "") or "").lower()
+            found = self.automata[attr].find(text) if attr in self.automata else set()
+            hits[attr] = (found, text if text in self.equals.get(attr, ()) else None)
+        return hits
+
+    def _check(self, check, hits, email_obj):
+        kind = check[0]
+        if kind == "const":
+            return check[1]
+        if kind == "python":
+            return self.rp.evaluate_condition(email_obj, check[1])
+        found, equal_to = hits[check[1]]
+        if kind == "contains":
+            return check[2] in found
+        if kind == "does not contain":
+            return check[2] not in found
+        if kind == "equals":
+            return equal_to == check[2]
+        return equal_to != check[2]
+
+    def decide(self, email_obj):
+        # one verdict per rule from the conditions that don't read the body: True, False, or
+        # None when only the rule's body conditions can settle it
+        hits = self.field_matches(email_obj)
+        verdicts = []
+        for rule, predicate, checks, body in self.rules:
+            results = [self._check(check, hits, email_obj) for check in checks]
+            decided = all(results) if predicate == "all" else any(results)
+            verdicts.append(None if body and decided == (predicate == "all") else decided)
+        return verdicts
+
+    def matching_rules(self, email_obj):
+        return [rule for (rule, predicate, _, body), verdict in zip(self.rules, self.decide(email_obj))
+                if verdict or verdict is None and self.rp.rule_matches(email_obj, body, predicate)]
@@ -0,0 +1,189 @@
+# metrics.py
+import bisect
+import contextlib
+import cProfile
+import json
+import logging
+import threading
+import time
+
+try:
+    import pyinstrument
+except ImportError:  # optional; cProfile is always available
+    pyinstrument = None
+
+# seconds; wide enough for a single SQLite statement up to a throttled Gmail batch
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics(object):
+    # Process-wide counters and latency histograms, keyed by metric name and label values.
+    # Recording is a dict update under a lock, cheap enough for per-call and per-rule use.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # name -> {label key: value}
+        self.histograms = {}  # name -> {label key: Histogram}
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = _key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = _key(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = Histogram()
+            hist.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def counter_value(self, name, **labels):
+        return self.counters.get(name, {}).get(_key(labels), 0)
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+            for name, series in sorted(self.histograms.items()):
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, hist in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(hist.buckets + ("+Inf",), hist.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {hist.sum:.6f}")
+                    lines.append(f"{name}_count{_format_labels(key)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def to_json_lines(self):
+        lines = []
+        now = time.time()
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                for key, value in sorted(series.items()):
+                    lines.append(json.dumps({"ts": now, "metric": name, "type": "counter",
+                                             "labels": dict(key), "value": value}))
+            for name, series in sorted(self.histograms.items()):
+                for key, hist in sorted(series.items()):
+                    lines.append(json.dumps({"ts": now, "metric": name, "type": "histogram", "labels": dict(key),
+                                             "count": hist.count, "sum": round(hist.sum, 6),
+                                             "buckets": dict(zip([str(b) for b in hist.buckets] + ["+Inf"],
+                                                                 hist.counts))}))
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def write(self, path):
+        # .jsonl / .json get JSON lines; anything else the Prometheus text format
+        text = self.to_json_lines() if path.endswith((".jsonl", ".json")) else self.to_prometheus()
+        with open(path, "w") as f:
+            f.write(text)
+
+
+metrics = Metrics()
+metrics.describe("gmail_api_calls_total", "Gmail API calls by method and outcome")
+metrics.describe("gmail_api_retries_total", "Gmail API calls retried after a throttle or server error")
+metrics.describe("gmail_api_seconds", "Latency of Gmail API calls (a batch counts once)")
+metrics.describe("gmail_bytes_downloaded_total", "JSON bytes of fetched messages")
+metrics.describe("db_write_seconds", "Time spent in database writes")
+metrics.describe("db_rows_written_total", "Rows written to the database")
+metrics.describe("rule_eval_seconds", "Time spent evaluating a rule, including its SQL")
+metrics.describe("rule_matches_total", "Emails matched per rule")
+metrics.describe("daemon_cycle_seconds", "Duration of a daemon sync and rule cycle")
+
+
+@contextlib.contextmanager
+def profiled(path):
+    # cProfile stats (or a pyinstrument HTML report for .html paths) for the wrapped block
+    if path.endswith(".html") and pyinstrument is not None:
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(path, "w") as f:
+                f.write(profiler.output_html())
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        logging.getLogger(__name__).info("Profile written to %s (view with python -m pstats)", path)
+
+
+def add_cli_arguments(parser):
+    parser.add_argument("--log-level", default="INFO", choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        help="DEBUG also logs every stored message and modify call")
+    parser.add_argument("--metrics-out", help="write metrics on exit (.prom for Prometheus text, .jsonl for JSON lines)")
+    parser.add_argument("--profile", help="profile the run into this file (.html uses pyinstrument if installed)")
+
+
+@contextlib.contextmanager
+def cli_run(args):
+    # logging, optional profiling and the metrics export shared by the command line entry points
+    logging.basicConfig(level=getattr(logging, args.log_level), format=LOG_FORMAT)
+    with profiled(args.profile) if args.profile else contextlib.nullcontext():
+        try:
+            yield
+        finally:
+            if args.metrics_out:
+                metrics.write(args.metrics_out)
@@ -1,10 +1,15 @@
 # models.py
 from sqlalchemy import (
-    create_engine, Column, Integer, String, DateTime, Text, Boolean
+    create_engine, event, inspect, text, Column, Integer, String, DateTime, Text, Boolean, LargeBinary
 )
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.dialects import postgresql, sqlite
+import argparse
 import datetime
+import threading
+from core.metrics import metrics
 
 Base = declarative_base()
 
@@ -19,15 +24,313 @@ class Email(Base):
     snippet = Column(Text)
     internal_date = Column(DateTime)  # when received
     is_read = Column(Boolean, default=False)
+    updated_at = Column(DateTime, index=True)  # UTC time the row was last written by a sync
 
-def get_engine(db_url="sqlite:///emails.db"):
-    return create_engine(db_url, connect_args={"check_same_thread": False} if db_url.startswith("sqlite") else {})
+class SyncState(Base):
+    __tablename__ = "sync_state"
+    account = Column(String, primary_key=True)  # Gmail userId the state belongs to
+    history_id = Column(String)  # mailbox historyId as of the last completed sync
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class PendingFetch(Base):
+    __tablename__ = "pending_fetches"
+    message_id = Column(String, primary_key=True)  # Gmail message id whose fetch failed after retries
+    error = Column(String)  # last error, for diagnosis
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class Label(Base):
+    __tablename__ = "labels"
+    label_id = Column(String, primary_key=True)  # Gmail label id
+    name = Column(String)
+    name_lower = Column(String, index=True)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class MessageLabel(Base):
+    __tablename__ = "message_labels"
+    message_id = Column(String, primary_key=True)  # Gmail message id
+    label_id = Column(String, primary_key=True, index=True)  # Gmail label id the message carries
+
+class EmailBody(Base):
+    __tablename__ = "email_bodies"
+    message_id = Column(String, primary_key=True)  # Gmail message id
+    codec = Column(String)  # "zlib" or "zstd"
+    body = Column(LargeBinary)  # compressed UTF-8 text of the message body
+    size = Column(Integer)  # uncompressed length in bytes
+    fetched_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class RuleWatermark(Base):
+    __tablename__ = "rule_watermarks"
+    rule_hash = Column(String, primary_key=True)  # sha256 of the rule's JSON definition
+    evaluated_at = Column(DateTime)  # UTC start of the last run that evaluated the rule
+
+def _py_lower(value):
+    return value.lower() if value is not None else None
+
+# applied to every new SQLite connection: WAL lets rule runs read while a fetch writes,
+# busy_timeout waits out the remaining writer-writer overlap instead of "database is locked"
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA temp_store=MEMORY",
+)
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+
+_engines = {}
+_sessionmakers = {}
+_scoped_sessions = {}
+_initialized = set()
+_registry_lock = threading.RLock()
+
+def _on_sqlite_connect(dbapi_conn, connection_record):
+    # SQLite's lower() only folds ASCII; rule SQL needs the same folding as str.lower()
+    dbapi_conn.create_function("py_lower", 1, _py_lower, deterministic=True)
+    cursor = dbapi_conn.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+def _create_engine(db_url, pool_size, max_overflow):
+    if not db_url.startswith("sqlite"):
+        return create_engine(db_url, pool_size=pool_size or DEFAULT_POOL_SIZE,
+                             max_overflow=DEFAULT_MAX_OVERFLOW if max_overflow is None else max_overflow,
+                             pool_pre_ping=True)
+    kwargs = {"connect_args": {"check_same_thread": False}}
+    if db_url in ("sqlite://", "sqlite:///:memory:"):
+        kwargs["poolclass"] = StaticPool  # one shared connection, or every session sees an empty database
+    engine = create_engine(db_url, **kwargs)
+    event.listen(engine, "connect", _on_sqlite_connect)
+    return engine
+
+def get_engine(db_url="sqlite:///emails.db", pool_size=None, max_overflow=None):
+    # one engine (and connection pool) per URL for the whole process; pool sizing
+    # applies to server databases and only when the engine is first created
+    with _registry_lock:
+        engine = _engines.get(db_url)
+        if engine is None:
+            engine = _engines[db_url] = _create_engine(db_url, pool_size, max_overflow)
+        return engine
+
+def _sessionmaker(db_url):
+    with _registry_lock:
+        factory = _sessionmakers.get(db_url)
+        if factory is None:
+            factory = _sessionmakers[db_url] = sessionmaker(bind=get_engine(db_url))
+        return factory
 
 def get_session(db_url="sqlite:///emails.db"):
-    engine = get_engine(db_url)
-    Session = sessionmaker(bind=engine)
-    return Session()
+    return _sessionmaker(db_url)()
+
+def get_scoped_session(db_url="sqlite:///emails.db"):
+    # thread-local sessions for worker threads; call .remove() when a thread is done
+    with _registry_lock:
+        registry = _scoped_sessions.get(db_url)
+        if registry is None:
+            registry = _scoped_sessions[db_url] = scoped_session(_sessionmaker(db_url))
+        return registry
+
+def dispose_engines():
+    # drop every cached engine, e.g. in a forked worker or after a test removes its database
+    with _registry_lock:
+        for registry in _scoped_sessions.values():
+            registry.remove()
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+        _sessionmakers.clear()
+        _scoped_sessions.clear()
+        _initialized.clear()
 
-def init_db(db_url="sqlite:///emails.db"):
+def init_db(db_url="sqlite:///emails.db", fts=False):
     engine = get_engine(db_url)
-    Base.metadata.create_all(engine)
+    with _registry_lock:
+        if db_url not in _initialized:
+            Base.metadata.create_all(engine)
+            _add_missing_columns(engine)
+            _initialized.add(db_url)
+    if fts:
+        create_fts(engine)
+
+def _add_missing_columns(engine):
+    # create_all never alters existing tables; add columns introduced since the database was made
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {col["name"] for col in inspector.get_columns(table.name)}
+        missing = [col for col in table.columns if col.name not in existing]
+        if not missing:
+            continue
+        with engine.begin() as conn:
+            for col in missing:
+                col_type = col.type.compile(dialect=engine.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN "{col.name}" {col_type}'))
+        added = {col.name for col in missing}
+        for index in table.indexes:
+            if any(col.name in added for col in index.columns):
+                index.create(engine, checkfirst=True)
+
+# SQLite FTS5 shadow index over the text columns rules search with "contains". It indexes
+# py_lower() of each value case-sensitively, so its folding is exactly str.lower()'s (the
+# trigram tokenizer's own case folding differs outside ASCII, e.g. for "İ"). The table is
+# contentless, so the triggers need py_lower, which every engine connection registers.
+FTS_TABLE = "emails_fts"
+FTS_COLUMNS = ("subject", "sender", "snippet")
+FTS_TOKENIZE = "trigram case_sensitive 1"
+FTS_TRIGGERS = ("emails_fts_ai", "emails_fts_ad", "emails_fts_au")
+FTS_DDL = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(subject, sender, snippet, "
+    f"content='', tokenize='{FTS_TOKENIZE}')",
+    f"""CREATE TRIGGER IF NOT EXISTS emails_fts_ai AFTER INSERT ON emails BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, subject, sender, snippet)
+        VALUES (new.id, py_lower(new.subject), py_lower(new.sender), py_lower(new.snippet));
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS emails_fts_ad AFTER DELETE ON emails BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, subject, sender, snippet)
+        VALUES ('delete', old.id, py_lower(old.subject), py_lower(old.sender), py_lower(old.snippet));
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS emails_fts_au AFTER UPDATE OF subject, sender, snippet ON emails BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, subject, sender, snippet)
+        VALUES ('delete', old.id, py_lower(old.subject), py_lower(old.sender), py_lower(old.snippet));
+        INSERT INTO {FTS_TABLE}(rowid, subject, sender, snippet)
+        VALUES (new.id, py_lower(new.subject), py_lower(new.sender), py_lower(new.snippet));
+    END""",
+]
+FTS_FILL = (f"INSERT INTO {FTS_TABLE}(rowid, subject, sender, snippet) "
+            "SELECT id, py_lower(subject), py_lower(sender), py_lower(snippet) FROM emails")
+
+def _fts_sql(conn):
+    return conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                        {"name": FTS_TABLE}).scalar()
+
+def create_fts(engine, rebuild=False):
+    if engine.dialect.name != "sqlite":
+        return False
+    # the triggers keep the index in step with every insert, upsert and delete on emails
+    with engine.begin() as conn:
+        sql = _fts_sql(conn)
+        current = sql is not None and FTS_TOKENIZE in sql
+        if sql is not None and not current:
+            # an index from before the text was lowered: its folding differs from str.lower()
+            conn.execute(text(f"DROP TABLE {FTS_TABLE}"))
+        if not current:
+            for trigger in FTS_TRIGGERS:
+                conn.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+        for ddl in FTS_DDL:
+            conn.execute(text(ddl))
+        if rebuild or not current:
+            # rows stored before the index must be in it, or MATCH misses them and the update
+            # trigger's 'delete' of a never-indexed row corrupts the index
+            conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('delete-all')"))
+            conn.execute(text(FTS_FILL))
+    return True
+
+def has_fts(bind):
+    if bind.dialect.name != "sqlite":
+        return False
+    with bind.connect() as conn:
+        sql = _fts_sql(conn)
+    return sql is not None and FTS_TOKENIZE in sql
+
+def rebuild_fts(db_url="sqlite:///emails.db"):
+    # indexes rows stored before the FTS table existed (or repairs a drifted index)
+    init_db(db_url)
+    return create_fts(get_engine(db_url), rebuild=True)
+
+SQL_IN_CHUNK = 500  # ids per IN (...) list, well under SQLite's bound-parameter limit
+
+def load_message_labels(session, message_ids):
+    # message_id -> set of label ids, for the messages the mirror has labels for
+    labels = {}
+    ids = list(message_ids)
+    for i in range(0, len(ids), SQL_IN_CHUNK):
+        query = session.query(MessageLabel.message_id, MessageLabel.label_id).filter(
+            MessageLabel.message_id.in_(ids[i:i + SQL_IN_CHUNK])
+        )
+        for message_id, label_id in query:
+            labels.setdefault(message_id, set()).add(label_id)
+    return labels
+
+def delete_message_labels(session, message_ids):
+    ids = list(message_ids)
+    for i in range(0, len(ids), SQL_IN_CHUNK):
+        session.query(MessageLabel).filter(MessageLabel.message_id.in_(ids[i:i + SQL_IN_CHUNK])).delete(
+            synchronize_session=False
+        )
+
+def replace_message_labels(session, labels):
+    # labels maps message_id -> the full labelIds list Gmail returned; does not commit
+    delete_message_labels(session, labels)
+    rows = [{"message_id": message_id, "label_id": label_id}
+            for message_id, label_ids in labels.items() for label_id in set(label_ids)]
+    if rows:
+        session.execute(MessageLabel.__table__.insert(), rows)
+
+def apply_label_changes(session, message_ids, add_labels=(), remove_labels=()):
+    # mirror a modify Gmail confirmed; does not commit
+    ids = list(message_ids)
+    changed = set(add_labels) | set(remove_labels)
+    if not ids or not changed:
+        return
+    for i in range(0, len(ids), SQL_IN_CHUNK):
+        session.query(MessageLabel).filter(
+            MessageLabel.message_id.in_(ids[i:i + SQL_IN_CHUNK]), MessageLabel.label_id.in_(changed)
+        ).delete(synchronize_session=False)
+    rows = [{"message_id": message_id, "label_id": label_id} for message_id in ids for label_id in set(add_labels)]
+    if rows:
+        session.execute(MessageLabel.__table__.insert(), rows)
+
+# columns refreshed when a message we already store is fetched again
+UPSERT_COLUMNS = ("thread_id", "subject", "sender", "to", "snippet", "internal_date", "is_read", "updated_at")
+
+def upsert_emails(session, rows):
+    # rows are dicts keyed by Email column names, plus an optional "label_ids" list that
+    # replaces the message's rows in the label mirror; later rows win for a repeated message_id
+    now = datetime.datetime.utcnow()
+    rows = list({row["message_id"]: dict(row, updated_at=now) for row in rows}.values())
+    if not rows:
+        return 0
+    labels = {row["message_id"]: row.pop("label_ids") for row in rows if "label_ids" in row}
+    with metrics.timer("db_write_seconds", op="upsert_emails"):
+        _upsert_rows(session, rows, labels)
+    metrics.inc("db_rows_written_total", len(rows), table="emails")
+    return len(rows)
+
+def _upsert_rows(session, rows, labels):
+    table = Email.__table__
+    dialect = session.get_bind().dialect.name
+    try:
+        if dialect in ("sqlite", "postgresql"):
+            insert = sqlite.insert if dialect == "sqlite" else postgresql.insert
+            stmt = insert(table)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.message_id],
+                set_={col: stmt.excluded[col] for col in UPSERT_COLUMNS},
+            )
+            session.execute(stmt, rows)
+        else:
+            ids = [row["message_id"] for row in rows]
+            existing = dict(session.query(Email.message_id, Email.id).filter(Email.message_id.in_(ids)))
+            updates = [dict(row, id=existing[row["message_id"]]) for row in rows if row["message_id"] in existing]
+            inserts = [row for row in rows if row["message_id"] not in existing]
+            session.bulk_update_mappings(Email, updates)
+            session.bulk_insert_mappings(Email, inserts)
+        replace_message_labels(session, labels)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default="sqlite:///emails.db")
+    parser.add_argument("--rebuild-fts", action="store_true", help="create and fill the SQLite full-text index")
+    args = parser.parse_args()
+    if args.rebuild_fts:
+        if rebuild_fts(args.db):
+            print(f"Rebuilt {FTS_TABLE} for {args.db}")
+        else:
+            print("Full-text index is only supported on SQLite")
+    else:
+        init_db(args.db)
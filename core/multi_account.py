@@ -0,0 +1,157 @@
+# multi_account.py
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from core.gmail_service import GmailProcessor
+from core.metrics import LOG_FORMAT, add_cli_arguments, cli_run, metrics
+from core.model import dispose_engines
+from core.process_rules import RuleProcessor
+from core.scheduler import RequestScheduler, USER_QUOTA_PER_SECOND
+
+# settings an account inherits unless the manifest's "defaults" or the account override them
+ACCOUNT_DEFAULTS = {
+    "credentials": "core/credentials.json",
+    "rules": "core/rules.json",
+    "quota": USER_QUOTA_PER_SECOND,
+    "max": None,
+    "full": False,
+    "batch_size": 50,
+    "workers": 4,
+    "incremental": True,
+    "single_pass": False,
+}
+
+logger = logging.getLogger(__name__)
+
+
+def load_manifest(path):
+    # {"defaults": {...}, "accounts": [{"name": ..., "token": ..., "db": ..., ...}]}
+    with open(path, "r") as f:
+        manifest = json.load(f)
+    defaults = dict(ACCOUNT_DEFAULTS, **manifest.get("defaults", {}))
+    accounts = []
+    for entry in manifest.get("accounts", []):
+        account = dict(defaults, **entry)
+        if not account.get("name") or not account.get("token"):
+            raise ValueError(f"every account needs a name and a token file: {entry}")
+        account.setdefault("db", f"sqlite:///{account['name']}.db")
+        accounts.append(account)
+    names = [a["name"] for a in accounts]
+    dbs = [a["db"] for a in accounts]
+    if len(set(names)) != len(names):
+        raise ValueError("account names must be unique")
+    if len(set(dbs)) != len(dbs):
+        # sync state and label caches are per database, so two mailboxes cannot share one
+        raise ValueError("every account needs its own database")
+    return manifest.get("project_quota"), accounts
+
+
+def budget_quota(accounts, workers, project_quota=None):
+    # split the project's units/second between the accounts that can run at the same time
+    if not project_quota:
+        return accounts
+    share = project_quota / max(1, min(workers, len(accounts)))
+    return [dict(account, quota=min(account["quota"], share)) for account in accounts]
+
+
+def run_account(account, log_dir=None):
+    # runs in a worker process: sync one mailbox, then apply its rules
+    started = time.monotonic()
+    result = {"name": account["name"], "db": account["db"], "ok": False, "error": None, "pid": os.getpid()}
+    root = logging.getLogger()
+    handler = None
+    if log_dir:
+        # a worker process may run several accounts, so each gets its own handler for its run
+        handler = logging.FileHandler(os.path.join(log_dir, f"{account['name']}.log"))
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        root.addHandler(handler)
+        if root.level > logging.INFO:
+            root.setLevel(logging.INFO)
+    # in a pool worker the registry is the worker's own, so each account exports just its run;
+    # run in-process, the account's numbers stay in the caller's registry instead
+    worker = multiprocessing.parent_process() is not None
+    if worker:
+        metrics.reset()
+    try:
+        # engines inherited from a parent process must never be shared with it
+        dispose_engines()
+        if not os.path.exists(account["token"]):
+            raise RuntimeError(f"no token at {account['token']}; authorize it once with core.gmail_service")
+        gmail = GmailProcessor(account["credentials"], account["token"],
+                               scheduler=RequestScheduler(quota_per_second=account["quota"]))
+        service = gmail.get_gmail_service(interactive=False)
+        gmail.fetch_and_store(account["db"], account["max"] or None, account["batch_size"], account["workers"],
+                              account["full"], service=service)
+        synced = time.monotonic()
+        totals = RuleProcessor(gmail).run_rules(account["db"], account["rules"],
+                                                single_pass=account["single_pass"], service=service,
+                                                incremental=account["incremental"])
+        finished = time.monotonic()
+        result.update(ok=True, totals=totals, api=dict(gmail.scheduler.stats),
+                      sync_seconds=round(synced - started, 3), rules_seconds=round(finished - synced, 3))
+    except Exception as err:
+        result["error"] = f"{type(err).__name__}: {err}"
+        logger.exception("Account %s failed", account["name"])
+    finally:
+        dispose_engines()
+        if worker and log_dir:
+            metrics.write(os.path.join(log_dir, f"{account['name']}.prom"))
+        if handler is not None:
+            root.removeHandler(handler)
+            handler.close()
+    result["total_seconds"] = round(time.monotonic() - started, 3)
+    return result
+
+
+def run_accounts(accounts, workers=None, project_quota=None, log_dir=None, runner=run_account):
+    workers = workers or os.cpu_count() or 1
+    accounts = budget_quota(accounts, workers, project_quota)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+    if workers == 1 or len(accounts) <= 1:
+        return [runner(account, log_dir) for account in accounts]
+    # spawn, not fork: every worker starts without the parent's connections and threads
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    with ProcessPoolExecutor(max_workers=min(workers, len(accounts)), mp_context=context) as pool:
+        futures = {pool.submit(runner, account, log_dir): account["name"] for account in accounts}
+        for fut in as_completed(futures):
+            results[futures[fut]] = fut.result()
+            logger.info("Finished %s (%s)", futures[fut], "ok" if results[futures[fut]]["ok"] else "failed")
+    return [results[account["name"]] for account in accounts]
+
+
+def summarize(results, wall_seconds):
+    lines = [f"{'account':<24} {'status':<7} {'sync s':>8} {'rules s':>8} {'total s':>8} {'api calls':>9}"]
+    for r in results:
+        lines.append(f"{r['name']:<24} {'ok' if r['ok'] else 'failed':<7} {r.get('sync_seconds', 0):>8.2f} "
+                     f"{r.get('rules_seconds', 0):>8.2f} {r['total_seconds']:>8.2f} "
+                     f"{r.get('api', {}).get('calls', 0):>9}")
+        if r["error"]:
+            lines.append(f"    {r['error']}")
+    serial = sum(r["total_seconds"] for r in results)
+    lines.append(f"{len(results)} accounts in {wall_seconds:.2f}s wall time ({serial:.2f}s of account time)")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("manifest", help="JSON file listing the accounts to process")
+    parser.add_argument("--workers", type=int, default=None, help="processes to run (default: CPU count)")
+    parser.add_argument("--log-dir", help="write each account's log to <log-dir>/<name>.log and its metrics to <name>.prom")
+    parser.add_argument("--summary-out", help="also write the per-account results as JSON")
+    add_cli_arguments(parser)
+    args = parser.parse_args()
+    project_quota, accounts = load_manifest(args.manifest)
+    started = time.monotonic()
+    with cli_run(args):
+        results = run_accounts(accounts, args.workers, project_quota, args.log_dir)
+    wall = time.monotonic() - started
+    print(summarize(results, wall))
+    if args.summary_out:
+        with open(args.summary_out, "w") as f:
+            json.dump({"wall_seconds": round(wall, 3), "accounts": results}, f, indent=2)
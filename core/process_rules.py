@@ -1,31 +1,62 @@
 # process_rules.py
 import argparse
 import json
+import logging
 import os
 import pickle
+import sys
+import time
 from datetime import datetime, timedelta
 from dateutil import parser as dateparser
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from core.model import get_session, Email
-from sqlalchemy import or_
+from core.model import get_session, has_fts, Email
+from sqlalchemy import and_, or_
 from googleapiclient.errors import HttpError
 from core.gmail_service import GmailProcessor
+from core.rule_compiler import RuleCompiler
+from core.actions import ActionPlanner
+from core.labels import LabelRegistry
+from core.matcher import RuleIndex
+from core.incremental import EvaluationScope
+from core.bodies import BODY_ATTR, BodyStore
+from core.columnar import DEFAULT_SNAPSHOT_DIR, ColumnarEvaluator, ColumnarSnapshot
+from core.metrics import add_cli_arguments, cli_run, metrics
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 SCOPES = ["https://www.googleapis.com/auth/gmail.modify"]
 TOKEN_FILE = "token.json"
 CREDENTIALS_FILE = "google_credentials.json"
 
+logger = logging.getLogger(__name__)
+
+def peak_memory_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
 class RuleProcessor(object):
-    def __init__(self):
-        self.gmail_service = GmailProcessor()
+    def __init__(self, gmail_processor=None):
+        self.gmail_service = gmail_processor or GmailProcessor()
+        self._rules_cache = None  # (path, mtime, size, rules) of the last rules file read
+        self._index_cache = None  # (rules, RuleIndex) compiled for single-pass runs
+        self.body_store = None  # BodyStore of the current run, for rules on the full body
         self.field_mapping = {
             ("from", "sender"): "sender",
             ("subject",): "subject",
             ("message", "snippet", "body"): "snippet",
-            ("received", "received date", "received date/time", "internal_date"): "internal_date"
+            ("received", "received date", "received date/time", "internal_date"): "internal_date",
+            ("full body", "full_body", "body text"): BODY_ATTR,
         }
+        self.string_fields = ("from", "subject", "message", "snippet", "body", "sender",
+                              "full body", "full_body", "body text")
 
         self.condition_rule_map = {
             "contains": lambda target, val: val in target,
@@ -62,11 +93,20 @@ class RuleProcessor(object):
             "greater_than": "greater_than",
         }
 
-    def get_field_value(self, email_obj, field_name):
+    def field_attr(self, field_name):
         for keys, attr in self.field_mapping.items():
             if field_name.lower() in [k.lower() for k in keys]:
-                return getattr(email_obj, attr, "")  # safely get attribute
-        return ""
+                return attr
+        return None
+
+    def get_field_value(self, email_obj, field_name):
+        attr = self.field_attr(field_name)
+        if attr is None:
+            return ""
+        if attr == BODY_ATTR:
+            # not a column: the body is fetched on demand and kept out of the emails table
+            return self.body_store.get(email_obj.message_id) if self.body_store is not None else ""
+        return getattr(email_obj, attr, "")  # safely get attribute
 
 
     def evaluate_condition(self, email_obj, cond):
@@ -76,7 +116,7 @@ class RuleProcessor(object):
         # string fields: From, Subject, Message
         target = self.get_field_value(email_obj, field)
         # string preds
-        if field in ("from", "subject", "message", "snippet", "body", "sender"):
+        if field in self.string_fields:
                 val_s = (val or "").lower()
                 target_s = (target or "").lower()
                 pred_key = self.predicate_aliases.get(pred.lower())
@@ -98,64 +138,301 @@ class RuleProcessor(object):
         
         return False
 
-    def run_rules(self, db_url, rules_path):
-        service = GmailProcessor().get_gmail_service()
-        session = get_session(db_url)
+    def rule_matches(self, email_obj, conditions, predicate):
+        results = [self.evaluate_condition(email_obj, c) for c in conditions]
+        return all(results) if predicate == "all" else any(results)
+
+    def plan_actions(self, planner, email_obj, actions, label_ids):
+        for act in actions:
+            action_name = act.get("action")
+            if action_name == "mark_as_read":
+                # remove UNREAD label (Gmail uses 'UNREAD' system label)
+                planner.set_read(email_obj.message_id, email_obj.is_read, True)
+            elif action_name == "mark_as_unread":
+                planner.set_read(email_obj.message_id, email_obj.is_read, False)
+            elif action_name == "move_to_label":
+                label_name = act.get("label")
+                if not label_name:
+                    logger.warning("No label specified for move_to_label; skipping")
+                    continue
+                label_id = label_ids.get(label_name)
+                if label_id is None:
+                    continue  # label could not be resolved earlier in the run
+                planner.add(email_obj.message_id, add_labels=[label_id], remove_labels=["INBOX"])
+            else:
+                logger.warning("Unknown action: %s", action_name)
+
+    def resolve_labels(self, registry, rules, label_ids):
+        for rule in rules:
+            for act in rule.get("actions", []):
+                label_name = act.get("label")
+                if act.get("action") != "move_to_label" or not label_name or label_name in label_ids:
+                    continue
+                try:
+                    label_ids[label_name] = registry.ensure(label_name)
+                except HttpError as err:
+                    logger.warning("Gmail API error resolving label %s: %s", label_name, err)
+                    label_ids[label_name] = None
+
+    def apply_actions(self, planner, service, session, registry, rules, label_ids):
+        calls, confirmed, failed = planner.execute(self.gmail_service, service, session)
+        stale = [err for err in failed.values() if getattr(err.resp, "status", None) in (400, 404)]
+        if stale and label_ids:
+            # a cached label id may have been deleted in Gmail: relist once and retry with fresh ids
+            for label_id in set(label_ids.values()):
+                registry.invalidate(label_id)
+            fresh = {}
+            self.resolve_labels(registry, rules, fresh)
+            planner.requeue_failed({label_ids[name]: fresh.get(name) for name in label_ids if fresh.get(name)})
+            label_ids.update(fresh)
+            retry_calls, retry_confirmed, failed = planner.execute(self.gmail_service, service, session)
+            calls += retry_calls
+            confirmed += retry_confirmed
+        return calls, confirmed, failed
+
+    def load_rules(self, rules_path):
+        # re-read (and recompile) only when the file changed since the last call
+        stat = os.stat(rules_path)
+        key = (rules_path, stat.st_mtime_ns, stat.st_size)
+        if self._rules_cache is not None and self._rules_cache[:3] == key:
+            return self._rules_cache[3]
         with open(rules_path, "r") as f:
             rules_data = json.load(f)
-
         # rules_data expected to be a list of rules or object with "rules" key
         rules = rules_data.get("rules") if "rules" in rules_data else rules_data
+        self._rules_cache = key + (rules,)
+        return rules
+
+    def rule_index(self, rules):
+        if self._index_cache is None or self._index_cache[0] is not rules:
+            self._index_cache = (rules, RuleIndex(self, rules))
+        return self._index_cache[1]
+
+    def referenced_columns(self, rules):
+        # only the columns the rules read, plus what actions need
+        attrs = ["id", "message_id", "is_read"]
+        for rule in rules:
+            for cond in rule.get("conditions", []):
+                field = cond.get("field") if isinstance(cond, dict) else None
+                attr = self.field_attr(field) if isinstance(field, str) else None
+                if attr and attr != BODY_ATTR and attr not in attrs:
+                    attrs.append(attr)
+        return [getattr(Email, attr) for attr in attrs]
+
+    def reads_body(self, conditions):
+        for cond in conditions:
+            field = cond.get("field") if isinstance(cond, dict) else None
+            if isinstance(field, str) and self.field_attr(field) == BODY_ATTR:
+                return True
+        return False
+
+    def matching_rows(self, rows, residual, predicate):
+        # rows the residual conditions accept. Conditions that don't read the body go first,
+        # so bodies are fetched only for rows they leave undecided; a row whose body can't be
+        # fetched gets no verdict and is left out.
+        if not residual:
+            return rows
+        if self.body_store is None:
+            return [e for e in rows if self.rule_matches(e, residual, predicate)]
+        header = [cond for cond in residual if not self.reads_body([cond])]
+        body = [cond for cond in residual if self.reads_body([cond])]
+        verdicts = []
+        for e in rows:
+            decided = self.rule_matches(e, header, predicate)
+            verdicts.append(None if body and decided == (predicate == "all") else decided)
+        if None in verdicts:
+            self.body_store.prefetch(e.message_id for e, verdict in zip(rows, verdicts) if verdict is None)
+        return [e for e, verdict in zip(rows, verdicts)
+                if verdict or verdict is None and self.body_verdict(e, body, predicate)]
+
+    def body_verdict(self, email_obj, body, predicate):
+        if self.body_store is not None and email_obj.message_id in self.body_store.unavailable:
+            return None  # body unknown: no verdict, and the run keeps its watermarks
+        return self.rule_matches(email_obj, body, predicate)
+
+    def record_rule(self, name, count, seconds=None):
+        metrics.inc("rule_matches_total", count, rule=name)
+        if seconds is not None:
+            metrics.observe("rule_eval_seconds", seconds, rule=name)
+
+    def iter_chunks(self, session, columns, clause=None, chunk_size=1000):
+        # keyset pagination on the primary key: each chunk is its own short query, so actions
+        # can be committed between chunks without holding a cursor open
+        last_id = 0
+        while True:
+            query = session.query(*columns).filter(Email.id > last_id)
+            if clause is not None:
+                query = query.filter(clause)
+            rows = query.order_by(Email.id).limit(chunk_size).all()
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1].id
+
+    def match_per_rule(self, session, rules, planner, label_ids, flush, chunk_size=1000, scope=None):
+        bind = session.get_bind()
+        compiler = RuleCompiler(self, bind.dialect.name, fts=has_fts(bind))
         for rule in rules:
             name = rule.get("name", "<unnamed>")
-            conditions = rule.get("conditions", [])
             predicate = rule.get("predicate", "All").lower()  # All / Any per rule (default All)
             actions = rule.get("actions", [])
 
-            print(f"Applying rule: {name} ({predicate})")
-
-            # naive evaluate: fetch all emails and filter in python (could be optimized)
-            emails = session.query(Email).all()
-            matches = []
-            for e in emails:
-                results = [self.evaluate_condition(e, c) for c in conditions]
-                match = all(results) if predicate == "all" else any(results)
-                if match:
-                    matches.append(e)
-            print(f"  {len(matches)} matches")
-
-            for e in matches:
-                for act in actions:
-                    action_name = act.get("action")
-                    try:
-                        if action_name == "mark_as_read" and not e.is_read:
-                            # remove UNREAD label (Gmail uses 'UNREAD' system label)
-                            self.gmail_service.msg_mark_modify(service, e.message_id, remove_labels=["UNREAD"])
-                            e.is_read = True
-                            session.commit()
-                            print(f"Marked read: {e.subject}")
-                        elif action_name == "mark_as_unread" and e.is_read:
-                            self.gmail_service.msg_mark_modify(service, e.message_id, add_labels=["UNREAD"])
-                            e.is_read = False
-                            session.commit()
-                            print(f"Marked unread: {e.subject}")
-                        elif action_name == "move_to_label":
-                            label_name = act.get("label")
-                            if not label_name:
-                                print(" No label specified for move_to_label; skipping.")
-                                continue
-                            label_id = GmailProcessor().ensure_label(service, label_name)
-                            self.gmail_service.msg_mark_modify(service, e.message_id, add_labels=[label_id], remove_labels=["INBOX"])
-                            print(f"Moved message to {label_name}")
-                        else:
-                            print("Unknown action:", action_name)
-                    except HttpError as err:
-                        print("Gmail API error:", err)
+            logger.info("Applying rule: %s (%s)", name, predicate)
+
+            # the database narrows the rows; conditions SQL can't express are checked here
+            clause, residual = compiler.compile_rule(rule)
+            pending = scope.clause(rule) if scope is not None else None
+            if pending is not None:
+                # incremental run: only emails this version of the rule has not seen yet
+                clause = pending if clause is None else and_(clause, pending)
+            columns = self.referenced_columns([rule])
+            count = 0
+            elapsed = 0.0
+            started = time.perf_counter()
+            for rows in self.iter_chunks(session, columns, clause, chunk_size):
+                for e in self.matching_rows(rows, residual, predicate):
+                    count += 1
+                    self.plan_actions(planner, e, actions, label_ids)
+                # sending the actions is not part of the rule's evaluation time
+                elapsed += time.perf_counter() - started
+                flush()
+                started = time.perf_counter()
+            self.record_rule(name, count, elapsed + time.perf_counter() - started)
+            logger.info("  %d matches", count)
+
+    def match_single_pass(self, session, rules, planner, label_ids, flush, chunk_size=1000, scope=None):
+        # walk the table once and test every rule against each email
+        index = self.rule_index(rules)
+        counts = [0] * len(rules)
+        columns = self.referenced_columns(rules)
+        clause = None
+        if scope is not None:
+            columns += [col for col in (Email.updated_at, Email.internal_date) if col not in columns]
+            pending = [scope.clause(rule) for rule in rules]
+            if pending and all(p is not None for p in pending):
+                clause = or_(*pending)
+        for rows in self.iter_chunks(session, columns, clause, chunk_size):
+            verdicts = []
+            for e in rows:
+                row = index.decide(e)
+                if scope is not None:
+                    row = [verdict if scope.contains(rule, e) else False for rule, verdict in zip(rules, row)]
+                verdicts.append(row)
+            undecided = [e.message_id for e, row in zip(rows, verdicts) if None in row]
+            if undecided and self.body_store is not None:
+                # bodies only for emails where a body condition can still change a verdict
+                self.body_store.prefetch(undecided)
+            for e, row in zip(rows, verdicts):
+                for position, ((rule, predicate, _, body), verdict) in enumerate(zip(index.rules, row)):
+                    if verdict is None:
+                        verdict = self.body_verdict(e, body, predicate)
+                    if not verdict:
+                        continue
+                    counts[position] += 1
+                    self.plan_actions(planner, e, rule.get("actions", []), label_ids)
+            flush()
+        for rule, count in zip(rules, counts):
+            # rules share one walk, so only their match counts are recorded
+            self.record_rule(rule.get("name", "<unnamed>"), count)
+            logger.info("Applied rule: %s - %d matches", rule.get("name", "<unnamed>"), count)
+
+    def match_columnar(self, session, db_url, rules, planner, label_ids, flush, chunk_size=1000, scope=None,
+                       snapshot_dir=DEFAULT_SNAPSHOT_DIR):
+        # rules become vectorized masks over a NumPy snapshot; only matching rows are loaded
+        attrs = [col.key for col in self.referenced_columns(rules) if col.key not in ("id", "message_id", "is_read")]
+        snapshot = ColumnarSnapshot.load(session, db_url, attrs, snapshot_dir)
+        evaluator = ColumnarEvaluator(self, snapshot)
+        for rule in rules:
+            name = rule.get("name", "<unnamed>")
+            predicate = rule.get("predicate", "All").lower()
+            actions = rule.get("actions", [])
+            started = time.perf_counter()
+            mask, residual = evaluator.rule_mask(rule)
+            ids = snapshot.ids[mask].tolist()
+            columns = self.referenced_columns([rule])
+            if scope is not None:
+                columns += [col for col in (Email.updated_at, Email.internal_date) if col not in columns]
+            count = 0
+            elapsed = 0.0
+            for i in range(0, len(ids), chunk_size):
+                rows = session.query(*columns).filter(Email.id.in_(ids[i:i + chunk_size])).order_by(Email.id).all()
+                for e in self.matching_rows(rows, residual, predicate):
+                    if scope is not None and not scope.contains(rule, e):
+                        continue
+                    count += 1
+                    self.plan_actions(planner, e, actions, label_ids)
+                elapsed += time.perf_counter() - started
+                flush()
+                started = time.perf_counter()
+            self.record_rule(name, count, elapsed + time.perf_counter() - started)
+            logger.info("Applied rule: %s - %d matches", name, count)
+
+    def run_rules(self, db_url, rules_path, single_pass=False, chunk_size=1000, service=None, incremental=False,
+                  backend="sql", snapshot_dir=DEFAULT_SNAPSHOT_DIR):
+        service = service or self.gmail_service.get_gmail_service()
+        session = get_session(db_url)
+        rules = self.load_rules(rules_path)
+        planner = ActionPlanner()
+        registry = LabelRegistry(self.gmail_service, service, session)
+        label_ids = {}
+        self.resolve_labels(registry, rules, label_ids)
+        totals = {"calls": 0, "confirmed": 0, "failed": 0}
+
+        def flush(force=False):
+            # planned label changes go out once a chunk's worth has accumulated, so memory stays
+            # bounded while rules still share batchModify calls (one per identical delta)
+            if not planner.deltas or (not force and len(planner.deltas) < chunk_size):
+                return
+            calls, confirmed, failed = self.apply_actions(planner, service, session, registry, rules, label_ids)
+            totals["calls"] += calls
+            totals["confirmed"] += len(confirmed)
+            totals["failed"] += len(failed)
+
+        scope = EvaluationScope(self, session) if incremental else None
+        self.body_store = BodyStore(self.gmail_service, service, session)
+        if backend == "columnar":
+            self.match_columnar(session, db_url, rules, planner, label_ids, flush, chunk_size, scope, snapshot_dir)
+        elif single_pass:
+            self.match_single_pass(session, rules, planner, label_ids, flush, chunk_size, scope)
+        else:
+            self.match_per_rule(session, rules, planner, label_ids, flush, chunk_size, scope)
+        flush(force=True)
+        totals["unevaluated"] = len(self.body_store.unavailable)
+        if scope is not None and not totals["failed"] and not totals["unevaluated"]:
+            # with failed actions or unknown bodies the watermarks stay put so the next run
+            # sees those emails again
+            scope.commit(rules)
+        totals["avoided"] = planner.calls_avoided
+        if self.body_store.fetched:
+            logger.info("Fetched %d bodies (%d bytes)", self.body_store.fetched, self.body_store.bytes_downloaded)
+        if totals["unevaluated"]:
+            logger.warning("Skipped %d emails whose body could not be fetched; they are retried next run",
+                           totals["unevaluated"])
+        self.body_store = None
+        logger.info("Applied changes to %d messages in %d batchModify calls (%d failed, %d avoided as no-ops)",
+                    totals["confirmed"], totals["calls"], totals["failed"], totals["avoided"])
+        peak = peak_memory_mb()
+        if peak is not None:
+            logger.info("Peak memory: %.1f MB", peak)
         session.close()
+        return totals
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--db", default="sqlite:///emails.db")
     parser.add_argument("--rules", default="core/rules.json")
+    parser.add_argument("--single-pass", action="store_true",
+                        help="walk the emails once and evaluate every rule through the compiled rule index")
+    parser.add_argument("--chunk-size", type=int, default=1000,
+                        help="emails loaded per chunk; actions are sent after every chunk")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only evaluate emails that are new or changed since each rule last ran")
+    parser.add_argument("--backend", choices=("sql", "columnar"), default="sql",
+                        help="columnar evaluates rules as NumPy masks over a cached snapshot (needs numpy)")
+    parser.add_argument("--snapshot-dir", default=DEFAULT_SNAPSHOT_DIR, help="where columnar snapshots are cached")
+    add_cli_arguments(parser)
     args = parser.parse_args()
-    RuleProcessor().run_rules(args.db, args.rules)
+    with cli_run(args):
+        RuleProcessor().run_rules(args.db, args.rules, single_pass=args.single_pass, chunk_size=args.chunk_size,
+                                  incremental=args.incremental, backend=args.backend,
+                                  snapshot_dir=args.snapshot_dir)
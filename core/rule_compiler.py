@@ -0,0 +1,105 @@
+# rule_compiler.py
+from datetime import datetime, timedelta
+from dateutil import parser as dateparser
+from sqlalchemy import and_, or_, not_, func, true, false, select, table, column
+from core.model import Email, FTS_TABLE, FTS_COLUMNS
+from core.bodies import BODY_ATTR
+
+FTS_MIN_NEEDLE = 3  # the trigram tokenizer cannot index shorter needles
+fts_table = table(FTS_TABLE, column("rowid"), *[column(name) for name in FTS_COLUMNS])
+
+
+class RuleCompiler(object):
+    # A compiled condition selects exactly the rows RuleProcessor.evaluate_condition accepts.
+    # Conditions SQL cannot express compile to None and are left to the Python evaluator.
+
+    def __init__(self, rule_processor, dialect_name="sqlite", fts=False):
+        self.rp = rule_processor
+        self.dialect_name = dialect_name
+        self.fts = fts
+
+    def _lower(self, expr):
+        if self.dialect_name == "sqlite":
+            return func.py_lower(expr)  # registered on every SQLite connection by core.model
+        return func.lower(expr)
+
+    def _contains(self, attr, target, val_s):
+        expr = target.contains(val_s, autoescape=True)
+        if self.fts and attr in FTS_COLUMNS and len(val_s) >= FTS_MIN_NEEDLE:
+            # the full-text index (of py_lower'ed text) narrows the candidates; LIKE keeps the
+            # result identical to Python
+            phrase = '"' + val_s.replace('"', '""') + '"'
+            candidates = select(fts_table.c.rowid).where(fts_table.c[attr].op("MATCH")(phrase))
+            expr = and_(Email.id.in_(candidates), expr)
+        return expr
+
+    def compile_string_condition(self, field, pred, val):
+        if val is not None and not isinstance(val, str):
+            return None
+        pred_key = self.rp.predicate_aliases.get(pred)
+        if not pred_key:
+            return false()
+        attr = self.rp.field_attr(field)
+        target = self._lower(func.coalesce(getattr(Email, attr), ""))
+        val_s = (val or "").lower()
+        if pred_key == "contains":
+            return self._contains(attr, target, val_s)
+        if pred_key == "does not contain":
+            return not_(self._contains(attr, target, val_s))
+        if pred_key == "equals":
+            return target == val_s
+        if pred_key == "does not equal":
+            return target != val_s
+        return None
+
+    def compile_date_condition(self, pred, val):
+        pred_key = self.rp.date_predicate_aliases.get(pred)
+        if not pred_key:
+            return false()
+        internal_date = Email.internal_date
+        try:
+            if pred_key in ("less_than_days", "greater_than_days"):
+                boundary = datetime.now() - timedelta(days=int(val))
+            else:
+                boundary = dateparser.parse(val)
+        except (TypeError, ValueError, OverflowError, AttributeError):
+            return None
+        if boundary.tzinfo is not None:
+            # stored dates are naive; comparing them to an aware date raises in Python
+            return None
+        if pred_key in ("less_than_days", "greater_than"):
+            return and_(internal_date.isnot(None), internal_date > boundary)
+        return and_(internal_date.isnot(None), internal_date < boundary)
+
+    def compile_condition(self, cond):
+        try:
+            field = cond["field"].lower()
+            pred = cond["predicate"].lower()
+        except (KeyError, TypeError, AttributeError):
+            return None
+        val = cond.get("value")
+        if self.rp.field_attr(field) == BODY_ATTR:
+            return None  # bodies live outside the emails table and are matched in Python
+        if field in self.rp.string_fields:
+            return self.compile_string_condition(field, pred, val)
+        if field == "internal_date":
+            return self.compile_date_condition(pred, val)
+        return false()
+
+    def compile_rule(self, rule):
+        # returns (filter or None, conditions still to be checked in Python)
+        conditions = rule.get("conditions", [])
+        predicate = rule.get("predicate", "All").lower()
+        compiled, residual = [], []
+        for cond in conditions:
+            expr = self.compile_condition(cond)
+            if expr is None:
+                residual.append(cond)
+            else:
+                compiled.append(expr)
+        if predicate == "all":
+            return and_(true(), *compiled), residual
+        if residual:
+            # an Any rule with a Python-only condition can match any row
+            return None, conditions
+        return or_(false(), *compiled), []
@@ -0,0 +1,168 @@
+# scheduler.py
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from googleapiclient.errors import HttpError
+from core.metrics import metrics
+
+# Gmail quota units per call, https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    "getProfile": 1,
+    "history.list": 2,
+    "labels.list": 1,
+    "labels.get": 1,
+    "labels.create": 5,
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.modify": 5,
+    "messages.batchModify": 50,
+}
+DEFAULT_UNITS = 5
+USER_QUOTA_PER_SECOND = 250  # Gmail's per-user rate limit
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = (b"rateLimitExceeded", b"userRateLimitExceeded")
+
+
+def error_status(err):
+    try:
+        return int(getattr(getattr(err, "resp", None), "status", None))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_throttle(err):
+    status = error_status(err)
+    if status == 429:
+        return True
+    # Gmail also reports rate limiting as 403 with a rateLimitExceeded reason
+    content = getattr(err, "content", b"") or b""
+    return status == 403 and any(reason in content for reason in RATE_LIMIT_REASONS)
+
+
+def is_retryable(err):
+    return error_status(err) in RETRYABLE_STATUSES or is_throttle(err)
+
+
+def retry_after(err):
+    # seconds the server asked us to wait, if it sent a Retry-After header
+    resp = getattr(err, "resp", None)
+    value = resp.get("retry-after") if hasattr(resp, "get") else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self, units):
+        units = float(units)
+        # a call dearer than the bucket waits for a full one and is still charged in full;
+        # tokens go negative and later callers wait off the debt, so the rate holds
+        needed = min(units, self.capacity)
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= needed:
+                    self.tokens -= units
+                    return
+                wait = (needed - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+class RequestScheduler(object):
+    # Every Gmail call goes through execute(): quota units are drawn from a token bucket,
+    # in-flight calls are capped by an AIMD concurrency limit that halves on throttling,
+    # and throttled or 5xx calls are retried with jittered exponential backoff.
+
+    def __init__(self, quota_per_second=USER_QUOTA_PER_SECOND, max_concurrency=8, min_concurrency=1,
+                 max_retries=5, base_delay=1.0, max_delay=32.0, sleep=time.sleep, clock=time.monotonic):
+        self.bucket = TokenBucket(quota_per_second, clock=clock, sleep=sleep)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(max_concurrency)
+        self.active = 0
+        self.slots = threading.Condition()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.stats = {"calls": 0, "retries": 0, "throttled": 0, "units": 0}
+
+    def _acquire_slot(self, cost):
+        with self.slots:
+            while self.active >= max(self.min_concurrency, int(self.limit)):
+                self.slots.wait()
+            self.active += 1
+            self.stats["calls"] += 1
+            self.stats["units"] += cost
+
+    def _release_slot(self):
+        with self.slots:
+            self.active -= 1
+            self.slots.notify_all()
+
+    def on_success(self):
+        with self.slots:
+            # additive increase: roughly one more slot per window of successful calls
+            self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            self.slots.notify_all()
+
+    def on_throttle(self):
+        with self.slots:
+            self.limit = max(float(self.min_concurrency), self.limit / 2)
+            self.stats["throttled"] += 1
+
+    def backoff_delay(self, attempt, err=None):
+        server_wait = retry_after(err) if err is not None else None
+        if server_wait is not None:
+            return min(server_wait, self.max_delay * 4)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def execute(self, request, method, units=None, http=None):
+        cost = units if units is not None else QUOTA_UNITS.get(method, DEFAULT_UNITS)
+        attempt = 0
+        while True:
+            self.bucket.acquire(cost)
+            self._acquire_slot(cost)
+            started = time.perf_counter()
+            try:
+                result = request.execute(http=http) if http is not None else request.execute()
+            except HttpError as err:
+                metrics.observe("gmail_api_seconds", time.perf_counter() - started, method=method)
+                metrics.inc("gmail_api_calls_total", method=method, status=str(error_status(err)))
+                if not is_retryable(err) or attempt >= self.max_retries:
+                    raise
+                metrics.inc("gmail_api_retries_total", method=method)
+                if is_throttle(err):
+                    self.on_throttle()
+                delay = self.backoff_delay(attempt, err)
+            else:
+                metrics.observe("gmail_api_seconds", time.perf_counter() - started, method=method)
+                metrics.inc("gmail_api_calls_total", method=method, status="ok")
+                self.on_success()
+                return result
+            finally:
+                self._release_slot()
+            with self.slots:
+                self.stats["retries"] += 1
+            attempt += 1
+            self.sleep(delay)
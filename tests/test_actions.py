@@ -0,0 +1,84 @@
+import unittest
+from unittest.mock import MagicMock
+from googleapiclient.errors import HttpError
+from core.actions import ActionPlanner
+from core.model import init_db, get_session, dispose_engines, load_message_labels, replace_message_labels
+
+
+class TestActionPlanner(unittest.TestCase):
+
+    def setUp(self):
+        self.planner = ActionPlanner()
+        self.processor = MagicMock()
+
+    def test_later_action_overrides_earlier(self):
+        self.planner.add("m1", add_labels=["L1"], remove_labels=["INBOX"])
+        self.planner.add("m1", remove_labels=["L1"])
+        self.assertEqual(self.planner.deltas["m1"], (set(), {"INBOX", "L1"}))
+
+    def test_set_read_skips_no_op(self):
+        self.planner.set_read("m1", True, True)
+        self.planner.set_read("m2", False, True)
+        self.planner.set_read("m2", False, False)
+        self.planner.set_read("m3", False, True)
+        self.assertEqual(self.planner.groups(), {(frozenset(), frozenset({"UNREAD"})): ["m3"]})
+
+    def test_identical_deltas_share_batch_modify_calls(self):
+        for i in range(2500):
+            self.planner.add(f"m{i}", add_labels=["Label_1"], remove_labels=["INBOX"])
+        self.planner.add("other", remove_labels=["UNREAD"])
+        session = MagicMock()
+
+        calls, confirmed, failed = self.planner.execute(self.processor, "service", session)
+
+        self.assertEqual(calls, 4)
+        self.assertEqual(len(confirmed), 2501)
+        self.assertEqual(failed, {})
+        sizes = sorted(len(c.args[1]) for c in self.processor.batch_modify.call_args_list)
+        self.assertEqual(sizes, [1, 500, 1000, 1000])
+        session.commit.assert_called_once()
+        self.assertEqual(self.planner.deltas, {})
+
+    def test_failed_call_is_not_confirmed(self):
+        self.processor.batch_modify.side_effect = HttpError(MagicMock(status=500), b"boom")
+        self.planner.add("m1", remove_labels=["UNREAD"])
+        calls, confirmed, failed = self.planner.execute(self.processor, "service")
+        self.assertEqual(confirmed, [])
+        self.assertIn("m1", failed)
+
+    def test_requeue_failed_swaps_stale_label(self):
+        self.processor.batch_modify.side_effect = [HttpError(MagicMock(status=404), b"stale"), None]
+        self.planner.add("m1", add_labels=["Label_old"], remove_labels=["INBOX"])
+        self.planner.execute(self.processor, "service")
+        self.planner.requeue_failed({"Label_old": "Label_new"})
+        calls, confirmed, failed = self.planner.execute(self.processor, "service")
+        self.assertEqual(confirmed, ["m1"])
+        self.assertEqual(self.processor.batch_modify.call_args.kwargs["add_labels"], ["Label_new"])
+
+    def test_mirror_skips_no_op_modifies(self):
+        init_db("sqlite://")
+        session = get_session("sqlite://")
+        try:
+            replace_message_labels(session, {"done": ["Label_1"], "todo": ["INBOX"]})
+            for message_id in ("done", "todo", "unknown"):
+                self.planner.add(message_id, add_labels=["Label_1"], remove_labels=["INBOX"])
+
+            calls, confirmed, failed = self.planner.execute(self.processor, "service", session)
+
+            self.assertEqual(calls, 1)
+            self.assertEqual(self.processor.batch_modify.call_args.args[1], ["todo", "unknown"])
+            self.assertEqual(self.planner.calls_avoided, 0)
+            # only messages the mirror already tracks are updated from the confirmed call
+            self.assertEqual(load_message_labels(session, ["done", "todo", "unknown"]),
+                             {"done": {"Label_1"}, "todo": {"Label_1"}})
+
+            self.planner.add("todo", add_labels=["Label_1"], remove_labels=["INBOX"])
+            self.assertEqual(self.planner.execute(self.processor, "service", session)[0], 0)
+            self.assertEqual(self.planner.calls_avoided, 1)
+        finally:
+            session.close()
+            dispose_engines()
+
+
+if __name__ == "__main__":
+    unittest.main()
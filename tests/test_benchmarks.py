@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+from benchmarks.fake_gmail import FakeGmailService
+from benchmarks.mailbox import SyntheticMailbox, generate_rules
+from benchmarks.run import compare, run_benchmark
+from core.gmail_service import GmailProcessor
+from core.model import Email, PendingFetch, get_session, dispose_engines
+from core.scheduler import RequestScheduler
+
+
+class TestBenchmarkHarness(unittest.TestCase):
+
+    def test_mailbox_is_deterministic(self):
+        first, second = SyntheticMailbox(50, seed=3), SyntheticMailbox(50, seed=3)
+        msg_id = first.message_id(7)
+        self.assertEqual(first.message(msg_id), second.message(msg_id))
+        self.assertNotEqual(first.message(msg_id), SyntheticMailbox(50, seed=4).message(msg_id))
+        self.assertEqual(generate_rules(5, seed=2), generate_rules(5, seed=2))
+
+    def test_fake_service_pages_and_records_history(self):
+        fake = FakeGmailService(SyntheticMailbox(1200))
+        page = fake.users().messages().list(userId="me", maxResults=500).execute()
+        self.assertEqual(len(page["messages"]), 500)
+        self.assertEqual(page["nextPageToken"], "500")
+        start = fake.users().getProfile(userId="me").execute()["historyId"]
+        fake.deliver(2)
+        fake.users().messages().batchModify(userId="me", body={"ids": ["000000000000"],
+                                                                "removeLabelIds": ["INBOX"]}).execute()
+        history = fake.users().history().list(userId="me", startHistoryId=start).execute()["history"]
+        self.assertEqual(len(history), 3)
+        self.assertNotIn("INBOX", fake.mailbox.label_ids("000000000000"))
+
+    def test_end_to_end_run_survives_injected_faults(self):
+        fake = FakeGmailService(SyntheticMailbox(300), throttle_rate=0.05, error_rate=0.02)
+        with tempfile.TemporaryDirectory() as workdir:
+            result = run_benchmark(messages=300, rules=10, workers=2, deliver=20, base_delay=0.0, workdir=workdir,
+                                   fake=fake)
+            # a message that exhausted its retries is fetched by the next sync once the faults stop
+            fake.throttle_rate = fake.error_rate = 0.0
+            db_url = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+            GmailProcessor(scheduler=RequestScheduler(quota_per_second=1e9)).fetch_and_store(db_url, service=fake)
+            session = get_session(db_url)
+            self.assertEqual(session.query(Email).count(), 320)
+            self.assertEqual(session.query(PendingFetch).count(), 0)
+            session.close()
+            dispose_engines()
+        self.assertEqual(list(result["phases"]), ["full_sync", "rules", "incremental_sync", "incremental_rules"])
+        sync = result["phases"]["full_sync"]
+        self.assertGreaterEqual(sync["api_calls"]["messages.get"], 300)
+        self.assertGreater(result["scheduler"]["calls"], 0)
+        self.assertGreater(sync["db_statements"], 0)
+
+        slower = {"phases": {"rules": dict(result["phases"]["rules"], seconds=result["phases"]["rules"]["seconds"] * 2)}}
+        self.assertIn("REGRESSION", compare(slower, result)[0])
+
+    @unittest.skipUnless(os.environ.get("RUN_LARGE_BENCHMARKS"), "set RUN_LARGE_BENCHMARKS=1 (takes a few minutes)")
+    def test_full_sync_of_100k_messages(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            result = run_benchmark(messages=100000, rules=50, workdir=workdir)
+            session = get_session(f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+            self.assertEqual(session.query(Email).count(), 100000)
+            session.close()
+            dispose_engines()
+        self.assertEqual(result["phases"]["full_sync"]["api_calls"]["messages.get"], 100000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import base64
+import unittest
+from unittest.mock import MagicMock
+from core.bodies import BodyStore, compress, decompress, extract_body, save_bodies
+from core.model import EmailBody, init_db, get_session, dispose_engines
+from core.scheduler import RequestScheduler
+
+
+def encode(text):
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def full_message(msg_id, text):
+    return {"id": msg_id, "payload": {"mimeType": "multipart/alternative", "parts": [
+        {"mimeType": "text/plain", "body": {"data": encode(text)}},
+        {"mimeType": "text/html", "body": {"data": encode(f"<p>{text}</p>")}},
+    ]}}
+
+
+class FakeBatch(object):
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append(request_id)
+
+    def execute(self, http=None):
+        for request_id in self.requests:
+            self.callback(request_id, full_message(request_id, f"Body of {request_id}"), None)
+
+
+class TestBodies(unittest.TestCase):
+
+    def test_extract_prefers_plain_text(self):
+        self.assertEqual(extract_body(full_message("m1", "Your invoice é")), "Your invoice é")
+
+    def test_extract_falls_back_to_html(self):
+        msg = {"payload": {"mimeType": "text/html", "body": {"data": encode("<b>Hi</b>\n<i>there</i>")}}}
+        self.assertEqual(extract_body(msg), "Hi there")
+
+    def test_compress_round_trip(self):
+        text = "invoice " * 200
+        codec, data = compress(text, codec="zlib")
+        self.assertLess(len(data), len(text))
+        self.assertEqual(decompress(codec, data), text)
+
+
+class TestBodyStore(unittest.TestCase):
+
+    def setUp(self):
+        init_db("sqlite://")
+        self.session = get_session("sqlite://")
+        self.service = MagicMock()
+        self.service.new_batch_http_request.side_effect = lambda callback=None: FakeBatch(callback)
+        self.processor = MagicMock(scheduler=RequestScheduler(quota_per_second=100000))
+        self.processor.http_pool = None
+
+    def tearDown(self):
+        self.session.close()
+        dispose_engines()
+
+    def test_fetches_missing_bodies_once(self):
+        save_bodies(self.session, {"m0": "stored body"})
+        self.session.commit()
+        store = BodyStore(self.processor, self.service, self.session)
+        store.prefetch(["m0", "m1", "m2"])
+
+        self.assertEqual(store.get("m0"), "stored body")
+        self.assertEqual(store.get("m2"), "Body of m2")
+        self.assertEqual(store.fetched, 2)
+        self.assertEqual(self.service.new_batch_http_request.call_count, 1)
+        self.assertEqual(self.session.query(EmailBody).count(), 3)
+
+        again = BodyStore(self.processor, self.service, self.session)
+        self.assertEqual(again.get("m1"), "Body of m1")
+        self.assertEqual(again.fetched, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
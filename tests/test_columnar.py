@@ -0,0 +1,127 @@
+import os
+import random
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+from core.columnar import ColumnarEvaluator, ColumnarSnapshot, StringColumn, np
+from core.model import Email, init_db, get_session, upsert_emails, dispose_engines
+from core.process_rules import RuleProcessor
+
+WORDS = ["Invoice", "SIP", "groww", "Réunion", "ÉLODIE", "sale", "100%", "off_", "", "HappyFox"]
+FIELDS = ["From", "subject", "Message", "sender", "received", "Full Body"]
+PREDICATES = ["contains", "does not contain", "equals", "not equal", "bogus"]
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestColumnarBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_url = f"sqlite:///{os.path.join(self.tmpdir.name, 'emails.db')}"
+        self.snapshot_dir = os.path.join(self.tmpdir.name, "snapshots")
+        init_db(self.db_url)
+        self.session = get_session(self.db_url)
+        rng = random.Random(7)
+        now = datetime.now()
+        rows = []
+        for i in range(300):
+            rows.append({
+                "message_id": f"m{i}",
+                "sender": rng.choice([None, " ".join(rng.sample(WORDS, 2)) + "@example.com"]),
+                "subject": " ".join(rng.sample(WORDS, 3)),
+                "snippet": rng.choice([None, "", " ".join(rng.sample(WORDS, 4))]),
+                "internal_date": rng.choice([None, now - timedelta(days=rng.randint(0, 60), hours=rng.randint(0, 23))]),
+                "is_read": False,
+            })
+        upsert_emails(self.session, rows)
+        self.rp = RuleProcessor()
+        self.rng = rng
+
+    def tearDown(self):
+        self.session.close()
+        dispose_engines()
+        self.tmpdir.cleanup()
+
+    def random_condition(self):
+        if self.rng.random() < 0.3:
+            pred = self.rng.choice(["less_than_days", "gt_days", "greater_than", "lt", "nope"])
+            val = str(self.rng.randint(0, 40)) if "days" in pred else (datetime.now() - timedelta(days=10)).isoformat()
+            return {"field": "internal_date", "predicate": pred, "value": val}
+        return {"field": self.rng.choice(FIELDS[:-2]), "predicate": self.rng.choice(PREDICATES),
+                "value": self.rng.choice(WORDS).lower() if self.rng.random() < 0.5 else self.rng.choice(WORDS)}
+
+    def python_matches(self, rule):
+        predicate = rule.get("predicate", "All").lower()
+        return {e.id for e in self.session.query(Email) if self.rp.rule_matches(e, rule["conditions"], predicate)}
+
+    def test_masks_match_python(self):
+        snapshot = ColumnarSnapshot.load(self.session, self.db_url, ["sender", "subject", "snippet", "internal_date"],
+                                         self.snapshot_dir)
+        evaluator = ColumnarEvaluator(self.rp, snapshot)
+        for _ in range(100):
+            rule = {"predicate": self.rng.choice(["All", "Any"]),
+                    "conditions": [self.random_condition() for _ in range(self.rng.randint(1, 3))]}
+            mask, residual = evaluator.rule_mask(rule)
+            self.assertEqual(residual, [])
+            self.assertEqual(set(snapshot.ids[mask].tolist()), self.python_matches(rule), rule)
+
+    def test_snapshot_is_memory_mapped_until_the_data_changes(self):
+        first = ColumnarSnapshot.load(self.session, self.db_url, ["subject"], self.snapshot_dir)
+        second = ColumnarSnapshot.load(self.session, self.db_url, ["subject"], self.snapshot_dir)
+        self.assertIsInstance(second.columns["subject"].data, np.memmap)
+        self.assertEqual(second.key, first.key)
+
+        upsert_emails(self.session, [{"message_id": "m0", "subject": "Changed", "is_read": False}])
+        third = ColumnarSnapshot.load(self.session, self.db_url, ["subject"], self.snapshot_dir)
+        self.assertNotEqual(third.key, first.key)
+        self.assertIn("changed", third.columns["subject"].tolist())
+        directory = ColumnarSnapshot._directory(self.db_url, self.snapshot_dir)
+        self.assertTrue(all(name.startswith(third.key) for name in os.listdir(directory)))
+
+    def test_long_values_do_not_widen_every_row(self):
+        upsert_emails(self.session, [{"message_id": "long", "subject": "Ünïcode " + "x" * 5000 + " tail",
+                                      "is_read": False}])
+        snapshot = ColumnarSnapshot.load(self.session, self.db_url, ["subject"], self.snapshot_dir)
+        column = snapshot.columns["subject"]
+        self.assertLess(column.data.nbytes, 5000 + 301 * 40)
+        self.assertEqual(column.tolist()[-1], "ünïcode " + "x" * 5000 + " tail")
+        evaluator = ColumnarEvaluator(self.rp, snapshot)
+        for cond in ({"field": "subject", "predicate": "contains", "value": "X TAIL"},
+                     {"field": "subject", "predicate": "contains", "value": "Ünï"},
+                     {"field": "subject", "predicate": "equals", "value": "ünïcode " + "x" * 5000 + " tail"}):
+            rule = {"conditions": [cond]}
+            mask, _ = evaluator.rule_mask(rule)
+            self.assertEqual(set(snapshot.ids[mask].tolist()), self.python_matches(rule), cond)
+
+    def test_contains_matches_python_across_blocks(self):
+        values = [" ".join(self.rng.sample(WORDS, 3)).lower() for _ in range(500)] + ["", "x" * 3000 + "sip"]
+        self.rng.shuffle(values)
+        column = StringColumn.from_values(values)
+        for needle in ("s", "sip", "réunion", "ion sa", "x" * 40 + "s", "zzz"):
+            expected = [needle in value for value in values]
+            for block in (1, 7, 65536):  # matches near block edges and rows past the last one
+                self.assertEqual(column.contains(needle.encode("utf-8"), block).tolist(), expected, (needle, block))
+
+    def test_run_rules_backend_parity(self):
+        rules_path = os.path.join(self.tmpdir.name, "rules.json")
+        with open(rules_path, "w") as f:
+            f.write('{"rules": [{"name": "r", "predicate": "Any", "conditions": ['
+                    '{"field": "From", "predicate": "contains", "value": "groww"},'
+                    '{"field": "internal_date", "predicate": "less_than_days", "value": "5"}],'
+                    '"actions": [{"action": "mark_as_read"}]}]}')
+        modified = {}
+        for backend in ("sql", "columnar"):
+            rp = RuleProcessor()
+            rp.gmail_service = MagicMock()
+            rp.run_rules(self.db_url, rules_path, backend=backend, snapshot_dir=self.snapshot_dir)
+            modified[backend] = sorted(i for c in rp.gmail_service.batch_modify.call_args_list for i in c.args[1])
+            # put the read state back so the second backend plans the same changes
+            self.session.query(Email).update({"is_read": False})
+            self.session.commit()
+        self.assertTrue(modified["sql"])
+        self.assertEqual(modified["columnar"], modified["sql"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+import urllib.request
+from unittest.mock import MagicMock, patch
+from core.daemon import GmailDaemon
+from core.model import dispose_engines
+
+
+class TestGmailDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_url = f"sqlite:///{os.path.join(self.tmpdir.name, 'emails.db')}"
+        self.rules_path = os.path.join(self.tmpdir.name, "rules.json")
+        self.write_rules(1)
+        self.gmail = MagicMock()
+        self.gmail.get_gmail_service.return_value = "service"
+        self.daemon = GmailDaemon(self.db_url, self.rules_path, interval=60, gmail_processor=self.gmail)
+        self.daemon.rules.run_rules = MagicMock()
+
+    def tearDown(self):
+        self.daemon.stop()
+        dispose_engines()
+        self.tmpdir.cleanup()
+
+    def write_rules(self, count):
+        rules = [{"name": f"r{i}", "conditions": [], "actions": []} for i in range(count)]
+        with open(self.rules_path, "w") as f:
+            json.dump({"rules": rules}, f)
+
+    def test_cycles_reuse_one_service(self):
+        self.daemon.start()
+        self.daemon.run_cycle()
+        cycle = self.daemon.run_cycle()
+
+        self.gmail.get_gmail_service.assert_called_once()
+        for call in self.gmail.fetch_and_store.call_args_list:
+            self.assertEqual(call.kwargs["service"], "service")
+        for call in self.daemon.rules.run_rules.call_args_list:
+            self.assertEqual(call.kwargs["service"], "service")
+            self.assertTrue(call.kwargs["incremental"])
+        self.assertEqual(self.daemon.cycles, 2)
+        self.assertIn("total_seconds", cycle)
+
+    def test_rules_reload_when_file_changes(self):
+        self.daemon.start()
+        first = self.daemon.rules.load_rules(self.rules_path)
+        self.assertIs(self.daemon.rules.load_rules(self.rules_path), first)
+        time.sleep(0.01)
+        self.write_rules(3)
+        self.daemon.run_cycle()
+        self.assertEqual(len(self.daemon._loaded_rules), 3)
+
+    @patch("core.daemon.init_db")
+    def test_http_trigger(self, mock_init_db):
+        self.daemon.port = 0
+        self.daemon.start()
+        url = f"http://127.0.0.1:{self.daemon.port}"
+        request = urllib.request.Request(url + "/sync", data=b"{}", method="POST")
+        with urllib.request.urlopen(request) as resp:
+            self.assertEqual(resp.status, 202)
+        self.assertTrue(self.daemon._wake.is_set())
+        with urllib.request.urlopen(url + "/status") as resp:
+            self.assertEqual(json.load(resp), {"cycles": 0, "last_cycle": None})
+
+
+if __name__ == "__main__":
+    unittest.main()
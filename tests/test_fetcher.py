@@ -0,0 +1,115 @@
+import unittest
+from unittest.mock import MagicMock, patch
+from core.fetcher import BatchFetcher, HttpPool
+from core.scheduler import RequestScheduler
+
+
+class FakeHttpError(Exception):
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.resp = MagicMock(status=status)
+
+
+class FakeService(object):
+    # answers messages().get() inside batches, failing ids listed in `failures` a number of times
+    def __init__(self, failures=None):
+        self.failures = dict(failures or {})
+        self.batches = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def get(self, userId, id, format, metadataHeaders=None):
+        self.requested = (format, metadataHeaders)
+        return id
+
+    def new_batch_http_request(self, callback=None):
+        service = self
+
+        class Batch(object):
+            def __init__(self):
+                self.ids = []
+
+            def add(self, request, request_id=None):
+                self.ids.append(request_id)
+
+            def execute(self, http=None):
+                service.batches.append(list(self.ids))
+                for msg_id in self.ids:
+                    status, remaining = service.failures.get(msg_id, (None, 0))
+                    if remaining:
+                        service.failures[msg_id] = (status, remaining - 1)
+                        callback(msg_id, None, FakeHttpError(status))
+                    else:
+                        callback(msg_id, {"id": msg_id}, None)
+
+        return Batch()
+
+
+class TestBatchFetcher(unittest.TestCase):
+
+    def test_batch_size_limit(self):
+        with self.assertRaises(ValueError):
+            BatchFetcher(FakeService(), batch_size=101)
+
+    def test_fetch_groups_ids_into_batches(self):
+        service = FakeService()
+        fetcher = BatchFetcher(service, batch_size=2, workers=1)
+        ids = [f"m{i}" for i in range(5)]
+        result = [m["id"] for m in fetcher.fetch(ids)]
+        self.assertEqual(result, ids)
+        self.assertEqual(service.batches, [["m0", "m1"], ["m2", "m3"], ["m4"]])
+
+    @patch("core.fetcher.time.sleep")
+    def test_retries_only_failed_messages(self, mock_sleep):
+        service = FakeService(failures={"m1": (429, 2)})
+        fetcher = BatchFetcher(service, batch_size=3, workers=1)
+        result = sorted(m["id"] for m in fetcher.fetch(["m0", "m1", "m2"]))
+        self.assertEqual(result, ["m0", "m1", "m2"])
+        self.assertEqual(service.batches, [["m0", "m1", "m2"], ["m1"], ["m1"]])
+        self.assertEqual(fetcher.failed, {})
+        self.assertEqual(fetcher.scheduler.stats["throttled"], 2)
+
+    @patch("core.fetcher.time.sleep")
+    def test_non_retryable_failure_is_reported(self, mock_sleep):
+        service = FakeService(failures={"m1": (404, 1)})
+        fetcher = BatchFetcher(service, batch_size=2, workers=1)
+        result = [m["id"] for m in fetcher.fetch(["m0", "m1"])]
+        self.assertEqual(result, ["m0"])
+        self.assertIn("m1", fetcher.failed)
+        mock_sleep.assert_not_called()
+
+    def test_metadata_format_limits_headers(self):
+        service = FakeService()
+        fetcher = BatchFetcher(service, msg_format="metadata", metadata_headers=("Subject", "From"))
+        list(fetcher.fetch(["m0"]))
+        self.assertEqual(service.requested, ("metadata", ["Subject", "From"]))
+
+    def test_concurrent_fetch_returns_every_message(self):
+        service = FakeService()
+        scheduler = RequestScheduler(quota_per_second=100000)
+        fetcher = BatchFetcher(service, http_factory=object, batch_size=10, workers=4, scheduler=scheduler)
+        ids = [f"m{i}" for i in range(250)]
+        result = sorted(m["id"] for m in fetcher.fetch(ids))
+        self.assertEqual(result, sorted(ids))
+        self.assertEqual(len(service.batches), 25)
+        self.assertEqual(scheduler.stats["units"], 250 * 5)
+
+    def test_pool_keeps_connections_across_fetchers(self):
+        service = FakeService()
+        factory = MagicMock(side_effect=lambda: object())
+        pool = HttpPool(factory)
+        scheduler = RequestScheduler(quota_per_second=100000)
+        for _ in range(3):
+            fetcher = BatchFetcher(service, http_pool=pool, batch_size=10, workers=4, scheduler=scheduler)
+            self.assertEqual(len(list(fetcher.fetch([f"m{i}" for i in range(100)]))), 100)
+        # one connection per concurrent worker at most, reused by every later fetcher
+        self.assertLessEqual(factory.call_count, 4)
+        self.assertEqual(len(pool.idle), factory.call_count)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,15 +3,54 @@ from unittest.mock import MagicMock, patch, mock_open
 from datetime import datetime
 import pickle
 import os
+import tempfile
+from googleapiclient.errors import HttpError
+from benchmarks.fake_gmail import FakeGmailService, FakeRequest, _http_error
+from benchmarks.mailbox import SyntheticMailbox
 from core.gmail_service import GmailProcessor
+from core.model import Email, dispose_engines, get_session, init_db, upsert_emails
+from core.scheduler import RequestScheduler
+
+
+class FakeBatch(object):
+    # stands in for BatchHttpRequest: runs each queued request and reports through the callback
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        for request_id, request in self.requests:
+            self.callback(request_id, request.execute(), None)
+
+
+class FlakyGmailService(FakeGmailService):
+    # every get of a message in broken fails with a 500 until the test clears it
+
+    def __init__(self, mailbox):
+        super().__init__(mailbox)
+        self.broken = set()
+
+    def _get(self, userId="me", id=None, format="full", metadataHeaders=None):
+        if id not in self.broken:
+            return super()._get(userId, id, format, metadataHeaders)
+
+        def fail():
+            raise _http_error(500, "backendError")
+        return FakeRequest(self, "messages.get", fail)
 
 
 class TestGmailProcessor(unittest.TestCase):
 
     def setUp(self):
+        # a temporary token path, so the OAuth tests never leave a token file in the tree
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
         self.gp = GmailProcessor(
             credentials_file="core/credentials.json",
-            token_file="core/token.pickle"
+            token_file=os.path.join(self.tmpdir.name, "token.pickle")
         )
 
     def test_iso_from_internal_date_valid(self):
@@ -26,7 +65,8 @@ class TestGmailProcessor(unittest.TestCase):
     @patch("core.gmail_service.build")
     @patch("core.gmail_service.pickle.load")
     @patch("core.gmail_service.os.path.exists", return_value=True)
-    def test_get_gmail_service_with_existing_token(self, mock_exists, mock_pickle, mock_build):
+    @patch("builtins.open", new_callable=mock_open)
+    def test_get_gmail_service_with_existing_token(self, mock_file, mock_exists, mock_pickle, mock_build):
         creds_mock = MagicMock()
         creds_mock.valid = True
         mock_pickle.return_value = creds_mock
@@ -50,6 +90,17 @@ class TestGmailProcessor(unittest.TestCase):
         self.assertEqual(result, "gmail_service")
         mock_flow.assert_called_once()
 
+    @patch("core.gmail_service.pickle.load")
+    @patch("core.gmail_service.os.path.exists", return_value=True)
+    @patch("builtins.open", new_callable=mock_open)
+    @patch("core.gmail_service.InstalledAppFlow.from_client_secrets_file")
+    def test_get_gmail_service_non_interactive_never_prompts(self, mock_flow, mock_file, mock_exists, mock_pickle):
+        mock_pickle.return_value = MagicMock(valid=False, expired=True, refresh_token=None)
+
+        with self.assertRaises(RuntimeError):
+            self.gp.get_gmail_service(interactive=False)
+        mock_flow.assert_not_called()
+
     def test_msg_mark_modify_add_and_remove(self):
         service = MagicMock()
         messages_mock = service.users().messages()
@@ -79,11 +130,13 @@ class TestGmailProcessor(unittest.TestCase):
         result = self.gp.ensure_label(service, "Custom")
         self.assertEqual(result, "NEW_LABEL")
 
+    @patch("core.gmail_service.upsert_emails")
     @patch("core.gmail_service.init_db")
     @patch("core.gmail_service.get_session")
     @patch.object(GmailProcessor, "get_gmail_service")
-    def test_fetch_and_store_new_email(self, mock_get_service, mock_get_session, mock_init_db):
+    def test_fetch_and_store_new_email(self, mock_get_service, mock_get_session, mock_init_db, mock_upsert):
         service = MagicMock()
+        service.new_batch_http_request.side_effect = lambda callback=None: FakeBatch(callback)
         mock_get_service.return_value = service
 
         service.users().messages().list().execute.return_value = {
@@ -103,19 +156,25 @@ class TestGmailProcessor(unittest.TestCase):
         }
 
         fake_session = MagicMock()
+        fake_session.get.return_value = None  # no previous sync recorded
         mock_get_session.return_value = fake_session
 
         self.gp.fetch_and_store("sqlite:///emails.db", max_results=1)
 
         mock_init_db.assert_called_once()
-        fake_session.add.assert_called()
+        rows = [row for call in mock_upsert.call_args_list for row in call.args[1]]
+        self.assertEqual([r["message_id"] for r in rows], ["msg123"])
+        self.assertEqual(rows[0]["subject"], "Test Mail")
+        self.assertTrue(rows[0]["is_read"])
         fake_session.commit.assert_called()
 
+    @patch("core.gmail_service.upsert_emails")
     @patch("core.gmail_service.init_db")
     @patch("core.gmail_service.get_session")
     @patch.object(GmailProcessor, "get_gmail_service")
-    def test_fetch_and_store_duplicate_email(self, mock_get_service, mock_get_session, mock_init_db):
+    def test_fetch_and_store_duplicate_email(self, mock_get_service, mock_get_session, mock_init_db, mock_upsert):
         service = MagicMock()
+        service.new_batch_http_request.side_effect = lambda callback=None: FakeBatch(callback)
         mock_get_service.return_value = service
         service.users().messages().list().execute.return_value = {
             "messages": [{"id": "msg123"}]
@@ -130,13 +189,155 @@ class TestGmailProcessor(unittest.TestCase):
         }
 
         fake_session = MagicMock()
-        fake_session.add.side_effect = Exception("IntegrityError")
+        fake_session.get.return_value = None
+        # msg123 is already in the emails table
+        fake_session.query.return_value.filter.return_value.__iter__.return_value = iter([("msg123",)])
+        mock_get_session.return_value = fake_session
+
+        self.gp.fetch_and_store("sqlite:///emails.db", max_results=1)
+
+        service.new_batch_http_request.assert_not_called()
+        fake_session.add.assert_not_called()
+        fake_session.rollback.assert_not_called()
+
+    def test_list_message_ids_follows_page_token(self):
+        service = MagicMock()
+        service.users().messages().list().execute.side_effect = [
+            {"messages": [{"id": "a"}, {"id": "b"}], "nextPageToken": "p2"},
+            {"messages": [{"id": "c"}]},
+        ]
+        self.assertEqual(self.gp.list_message_ids(service), ["a", "b", "c"])
+        service.users().messages().list.assert_called_with(
+            userId="me", labelIds=["INBOX"], maxResults=500, pageToken="p2"
+        )
+
+    def test_list_message_ids_respects_max_results(self):
+        service = MagicMock()
+        service.users().messages().list().execute.return_value = {
+            "messages": [{"id": "a"}, {"id": "b"}], "nextPageToken": "p2"
+        }
+        self.assertEqual(self.gp.list_message_ids(service, max_results=2), ["a", "b"])
+
+    def test_history_changes(self):
+        service = MagicMock()
+        service.users().history().list().execute.return_value = {
+            "history": [
+                {"messagesAdded": [{"message": {"id": "new", "labelIds": ["INBOX", "UNREAD"]}}]},
+                {"messagesAdded": [{"message": {"id": "sent", "labelIds": ["SENT"]}}]},
+                {"labelsRemoved": [{"message": {"id": "known"}, "labelIds": ["UNREAD"]}]},
+                {"labelsAdded": [{"message": {"id": "other"}, "labelIds": ["STARRED"]}]},
+                {"messagesDeleted": [{"message": {"id": "gone"}}]},
+            ],
+            "historyId": "200",
+        }
+        changed, deleted, latest = self.gp.history_changes(service, "100")
+        self.assertEqual(changed, {"new": True, "sent": False, "known": False, "other": False})
+        self.assertEqual(deleted, {"gone"})
+        self.assertEqual(latest, "200")
+
+    def test_incremental_sync_looks_up_only_the_ids_history_mentions(self):
+        service = MagicMock()
+        service.users().history().list().execute.return_value = {
+            "history": [
+                {"messagesAdded": [{"message": {"id": "new", "labelIds": ["INBOX"]}}]},
+                {"messagesAdded": [{"message": {"id": "sent", "labelIds": ["SENT"]}}]},
+                {"labelsRemoved": [{"message": {"id": "known"}, "labelIds": ["UNREAD"]}]},
+                {"messagesDeleted": [{"message": {"id": "gone"}}]},
+            ],
+            "historyId": "200",
+        }
+        db_url = f"sqlite:///{os.path.join(self.tmpdir.name, 'emails.db')}"
+        init_db(db_url)
+        self.addCleanup(dispose_engines)
+        session = get_session(db_url)
+        upsert_emails(session, [{"message_id": "known"}, {"message_id": "gone"}, {"message_id": "idle"}])
+        self.gp._known_ids = MagicMock(wraps=self.gp._known_ids)
+        self.gp._store_messages = MagicMock(return_value=(set(), {}))
+
+        self.gp.incremental_sync(session, service, "100")
+
+        self.gp._known_ids.assert_called_once_with(session, {"new", "sent", "known", "gone"})
+        self.assertEqual(self.gp._store_messages.call_args.args[2], ["known", "new"])
+        self.assertEqual({row[0] for row in session.query(Email.message_id)}, {"known", "idle"})
+        session.close()
+
+    def test_id_lookups_and_deletes_stay_under_the_sqlite_variable_limit(self):
+        db_url = f"sqlite:///{os.path.join(self.tmpdir.name, 'emails.db')}"
+        init_db(db_url)
+        self.addCleanup(dispose_engines)
+        session = get_session(db_url)
+        upsert_emails(session, [{"message_id": "a"}, {"message_id": "b"}])
+        ids = [f"m{i}" for i in range(300000)] + ["a", "b"]  # more than any SQLite build binds at once
+
+        self.assertEqual(self.gp._known_ids(session, ids), {"a", "b"})
+        self.gp._delete_messages(session, ids)
+        self.assertEqual(self.gp._known_ids(session), set())
+        session.close()
+
+    def test_syncs_reuse_fetch_connections(self):
+        fake = FakeGmailService(SyntheticMailbox(200))
+        db_url = f"sqlite:///{os.path.join(self.tmpdir.name, 'emails.db')}"
+        self.addCleanup(dispose_engines)
+        with patch.object(GmailProcessor, "new_http", side_effect=lambda: object()) as new_http:
+            gp = GmailProcessor(scheduler=RequestScheduler(quota_per_second=1e9))
+            gp.fetch_and_store(db_url, None, batch_size=10, workers=4, service=fake)
+            opened = new_http.call_count
+            fake.deliver(50)
+            gp.fetch_and_store(db_url, None, batch_size=10, workers=4, service=fake)
+        self.assertGreater(opened, 0)
+        self.assertEqual(new_http.call_count, opened)  # the second sync only reused them
+
+    def test_failed_fetch_is_retried_on_the_next_sync(self):
+        fake = FlakyGmailService(SyntheticMailbox(20))
+        broken = fake.mailbox.message_id(5)
+        fake.broken.add(broken)
+        gp = GmailProcessor(scheduler=RequestScheduler(quota_per_second=1e9, base_delay=0.0))
+        db_url = f"sqlite:///{os.path.join(self.tmpdir.name, 'emails.db')}"
+        self.addCleanup(dispose_engines)
+
+        gp.fetch_and_store(db_url, None, service=fake)
+        session = get_session(db_url)
+        self.assertEqual(len(gp._known_ids(session)), 19)
+        self.assertEqual(gp._pending_ids(session), {broken})
+
+        fake.broken.clear()  # the fault clears; nothing about the message shows up in history
+        gp.fetch_and_store(db_url, None, service=fake)
+        self.assertEqual(len(gp._known_ids(session)), 20)
+        self.assertEqual(gp._pending_ids(session), set())
+        session.close()
+
+    @patch("core.gmail_service.init_db")
+    @patch("core.gmail_service.get_session")
+    @patch.object(GmailProcessor, "get_gmail_service")
+    @patch.object(GmailProcessor, "full_sync")
+    @patch.object(GmailProcessor, "incremental_sync")
+    def test_fetch_and_store_expired_history_falls_back(self, mock_incremental, mock_full, mock_get_service,
+                                                       mock_get_session, mock_init_db):
+        fake_session = MagicMock()
+        fake_session.get.return_value = MagicMock(history_id="100")
+        mock_get_session.return_value = fake_session
+        mock_incremental.side_effect = HttpError(MagicMock(status=404), b"historyId expired")
+
+        self.gp.fetch_and_store("sqlite:///emails.db", max_results=None)
+
+        mock_incremental.assert_called_once()
+        mock_full.assert_called_once()
+
+    @patch("core.gmail_service.init_db")
+    @patch("core.gmail_service.get_session")
+    @patch.object(GmailProcessor, "get_gmail_service")
+    @patch.object(GmailProcessor, "full_sync")
+    @patch.object(GmailProcessor, "incremental_sync")
+    def test_fetch_and_store_uses_history(self, mock_incremental, mock_full, mock_get_service,
+                                          mock_get_session, mock_init_db):
+        fake_session = MagicMock()
+        fake_session.get.return_value = MagicMock(history_id="100")
         mock_get_session.return_value = fake_session
 
-        with patch("core.gmail_service.IntegrityError", Exception):
-            self.gp.fetch_and_store("sqlite:///emails.db", max_results=1)
+        self.gp.fetch_and_store("sqlite:///emails.db")
 
-        fake_session.rollback.assert_called()
+        mock_incremental.assert_called_once()
+        mock_full.assert_not_called()
 
 
 if __name__ == "__main__":
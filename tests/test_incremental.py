@@ -0,0 +1,132 @@
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+from googleapiclient.errors import HttpError
+from sqlalchemy import inspect
+from core.incremental import EvaluationScope, rule_hash
+from core.model import Email, RuleWatermark, init_db, get_engine, get_session, upsert_emails, dispose_engines
+from core.process_rules import RuleProcessor
+
+
+class TestIncrementalRules(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_url = f"sqlite:///{os.path.join(self.tmpdir.name, 'emails.db')}"
+        init_db(self.db_url)
+        self.store([self.row("g0"), self.row("g1")])
+        self.rules_path = os.path.join(self.tmpdir.name, "rules.json")
+        self.write_rules("groww")
+        self.rp = RuleProcessor()
+        self.rp.gmail_service = MagicMock()
+        self.rp.gmail_service.list_labels.return_value = [{"id": "Label_1", "name": "Finance"}]
+
+    def tearDown(self):
+        dispose_engines()
+        self.tmpdir.cleanup()
+
+    def row(self, message_id, days_old=0, sender="noreply@groww.in"):
+        return {"message_id": message_id, "sender": sender, "subject": "SIP",
+                "internal_date": datetime.now() - timedelta(days=days_old), "is_read": False}
+
+    def store(self, rows):
+        session = get_session(self.db_url)
+        upsert_emails(session, rows)
+        session.close()
+
+    def write_rules(self, needle, extra=None):
+        conditions = [{"field": "From", "predicate": "contains", "value": needle}] + (extra or [])
+        with open(self.rules_path, "w") as f:
+            json.dump({"rules": [{"name": "Label Groww", "conditions": conditions,
+                                  "actions": [{"action": "move_to_label", "label": "Finance"}]}]}, f)
+
+    def modified(self):
+        ids = sorted(i for c in self.rp.gmail_service.batch_modify.call_args_list for i in c.args[1])
+        self.rp.gmail_service.batch_modify.reset_mock()
+        return ids
+
+    def test_second_run_only_sees_new_emails(self):
+        self.rp.run_rules(self.db_url, self.rules_path, incremental=True)
+        self.assertEqual(self.modified(), ["g0", "g1"])
+
+        self.rp.run_rules(self.db_url, self.rules_path, incremental=True)
+        self.assertEqual(self.modified(), [])
+
+        self.store([self.row("g2"), self.row("g0")])
+        self.rp.run_rules(self.db_url, self.rules_path, incremental=True)
+        self.assertEqual(self.modified(), ["g0", "g2"])
+
+    def test_single_pass_only_sees_new_emails(self):
+        self.rp.run_rules(self.db_url, self.rules_path, single_pass=True, incremental=True)
+        self.assertEqual(self.modified(), ["g0", "g1"])
+
+        self.store([self.row("g2")])
+        self.rp.run_rules(self.db_url, self.rules_path, single_pass=True, incremental=True)
+        self.assertEqual(self.modified(), ["g2"])
+
+    def test_edited_rule_sees_everything_again(self):
+        self.rp.run_rules(self.db_url, self.rules_path, incremental=True)
+        self.modified()
+        self.write_rules("groww.in")
+        os.utime(self.rules_path, ns=(0, 0))  # make sure the rules cache notices the edit
+
+        self.rp.run_rules(self.db_url, self.rules_path, incremental=True)
+        self.assertEqual(self.modified(), ["g0", "g1"])
+        session = get_session(self.db_url)
+        self.assertEqual(session.query(RuleWatermark).count(), 1)
+        session.close()
+
+    def test_failed_actions_keep_the_watermark(self):
+        self.rp.gmail_service.batch_modify.side_effect = HttpError(MagicMock(status=500), b"boom")
+        self.rp.run_rules(self.db_url, self.rules_path, incremental=True)
+        self.rp.gmail_service.batch_modify.side_effect = None
+        self.modified()
+
+        self.rp.run_rules(self.db_url, self.rules_path, incremental=True)
+        self.assertEqual(self.modified(), ["g0", "g1"])
+
+    def test_day_boundary_window(self):
+        rule = {"name": "old", "conditions": [
+            {"field": "internal_date", "predicate": "greater_than_days", "value": "2"}], "actions": []}
+        session = get_session(self.db_url)
+        scope = EvaluationScope(self.rp, session)
+        scope.watermarks[rule_hash(rule)] = scope.started_at - timedelta(days=1)
+        evaluated = scope.started_at - timedelta(days=2)
+
+        # became older than two days since the last run, so it must be looked at again
+        crossed = Email(updated_at=evaluated, internal_date=scope.local_now - timedelta(days=2, hours=12))
+        # was already older than two days last time
+        settled = Email(updated_at=evaluated, internal_date=scope.local_now - timedelta(days=4))
+        self.assertTrue(scope.contains(rule, crossed))
+        self.assertFalse(scope.contains(rule, settled))
+        self.assertTrue(scope.contains({"name": "new", "conditions": [], "actions": []}, settled))
+        session.close()
+
+
+class TestAddMissingColumns(unittest.TestCase):
+
+    def test_old_database_gets_updated_at(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "old.db")
+            conn = sqlite3.connect(path)
+            conn.execute("CREATE TABLE emails (id INTEGER PRIMARY KEY, message_id VARCHAR, thread_id VARCHAR, "
+                         "subject VARCHAR, sender VARCHAR, \"to\" VARCHAR, snippet TEXT, "
+                         "internal_date DATETIME, is_read BOOLEAN)")
+            conn.commit()
+            conn.close()
+            db_url = f"sqlite:///{path}"
+            try:
+                init_db(db_url)
+                inspector = inspect(get_engine(db_url))
+                self.assertIn("updated_at", {c["name"] for c in inspector.get_columns("emails")})
+                self.assertIn("ix_emails_updated_at", {i["name"] for i in inspector.get_indexes("emails")})
+            finally:
+                dispose_engines()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import datetime
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+from core.labels import LabelRegistry
+from core.model import Label, init_db, get_session, dispose_engines
+
+
+class TestLabelRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.processor = MagicMock()
+        self.processor.list_labels.return_value = [
+            {"id": "INBOX", "name": "INBOX"},
+            {"id": "Label_1", "name": "Reports"},
+        ]
+        self.processor.create_label.side_effect = lambda service, name: {"id": "id:" + name, "name": name}
+
+    def test_lookup_is_case_insensitive_and_lists_once(self):
+        registry = LabelRegistry(self.processor, "service")
+        self.assertEqual(registry.ensure("reports"), "Label_1")
+        self.assertEqual(registry.ensure("REPORTS"), "Label_1")
+        self.processor.list_labels.assert_called_once()
+
+    def test_creates_missing_parents(self):
+        registry = LabelRegistry(self.processor, "service")
+        self.assertEqual(registry.ensure("Finance/Groww"), "id:Finance/Groww")
+        self.assertEqual(registry.ensure("Finance/Zerodha"), "id:Finance/Zerodha")
+        created = [c.args[1] for c in self.processor.create_label.call_args_list]
+        self.assertEqual(created, ["Finance", "Finance/Groww", "Finance/Zerodha"])
+        self.processor.list_labels.assert_called_once()
+
+    def test_invalidate_forces_relist(self):
+        registry = LabelRegistry(self.processor, "service")
+        registry.ensure("Reports")
+        registry.invalidate("Label_1")
+        registry.ensure("Reports")
+        self.assertEqual(self.processor.list_labels.call_count, 2)
+
+    def test_persisted_labels_are_used_until_ttl(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_url = f"sqlite:///{os.path.join(tmpdir, 'emails.db')}"
+            init_db(db_url)
+            session = get_session(db_url)
+            LabelRegistry(self.processor, "service", session).ensure("Reports")
+
+            registry = LabelRegistry(self.processor, "service", session)
+            self.assertEqual(registry.ensure("Reports"), "Label_1")
+            self.processor.list_labels.assert_called_once()
+
+            session.query(Label).update({"updated_at": datetime.datetime.utcnow() - datetime.timedelta(days=1)})
+            session.commit()
+            registry = LabelRegistry(self.processor, "service", session)
+            registry.ensure("Reports")
+            self.assertEqual(self.processor.list_labels.call_count, 2)
+            session.close()
+            dispose_engines()
+
+
+if __name__ == "__main__":
+    unittest.main()
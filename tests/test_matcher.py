@@ -0,0 +1,67 @@
+import random
+import unittest
+from datetime import datetime, timedelta
+from core.matcher import AhoCorasick, RuleIndex
+from core.model import Email
+from core.process_rules import RuleProcessor
+
+
+class TestAhoCorasick(unittest.TestCase):
+
+    def test_overlapping_needles(self):
+        ac = AhoCorasick(["he", "she", "his", "hers"])
+        self.assertEqual(ac.find("ushers"), {0, 1, 3})
+        self.assertEqual(ac.find("history"), {2})
+        self.assertEqual(ac.find(""), set())
+
+    def test_matches_substring_search(self):
+        rnd = random.Random(7)
+        for _ in range(500):
+            needles = list({"".join(rnd.choice("ab") for _ in range(rnd.randint(1, 4))) for _ in range(5)})
+            text = "".join(rnd.choice("abc") for _ in range(rnd.randint(0, 20)))
+            expected = {i for i, needle in enumerate(needles) if needle in text}
+            self.assertEqual(AhoCorasick(needles).find(text), expected)
+
+
+class TestRuleIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.rp = RuleProcessor()
+        self.emails = [
+            Email(message_id="1", sender="noreply@Groww.in", subject="SIP reminder", snippet="Pay now",
+                  internal_date=datetime.now() - timedelta(days=2)),
+            Email(message_id="2", sender="boss@work.com", subject="Quarterly report", snippet=None,
+                  internal_date=datetime.now() - timedelta(days=40)),
+            Email(message_id="3", sender=None, subject="", snippet="groww statement", internal_date=None),
+        ]
+        self.rules = [
+            {"name": "groww", "conditions": [{"field": "From", "predicate": "contains", "value": "groww"}]},
+            {"name": "not groww", "conditions": [{"field": "from", "predicate": "does not contain", "value": "GROWW"}]},
+            {"name": "boss", "conditions": [{"field": "from", "predicate": "equals", "value": "Boss@work.com"}]},
+            {"name": "not boss", "conditions": [{"field": "from", "predicate": "not equal", "value": "boss@work.com"}]},
+            {"name": "any", "predicate": "Any", "conditions": [
+                {"field": "subject", "predicate": "contains", "value": "report"},
+                {"field": "message", "predicate": "contains", "value": "statement"}]},
+            {"name": "recent sip", "conditions": [
+                {"field": "subject", "predicate": "contains", "value": "sip"},
+                {"field": "internal_date", "predicate": "less_than_days", "value": 7}]},
+            {"name": "empty", "conditions": [{"field": "subject", "predicate": "contains", "value": ""}]},
+            {"name": "bad predicate", "conditions": [{"field": "subject", "predicate": "regex", "value": "x"}]},
+            {"name": "no conditions", "conditions": []},
+        ]
+
+    def test_same_matches_as_evaluate_condition(self):
+        index = RuleIndex(self.rp, self.rules)
+        for email in self.emails:
+            expected = [r["name"] for r in self.rules
+                        if self.rp.rule_matches(email, r["conditions"], r.get("predicate", "All").lower())]
+            self.assertEqual([r["name"] for r in index.matching_rules(email)], expected, email.message_id)
+
+    def test_needles_are_shared_per_field(self):
+        index = RuleIndex(self.rp, self.rules)
+        self.assertEqual(set(index.needles["sender"]), {"groww"})
+        self.assertEqual(index.equals["sender"], {"boss@work.com"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+import pstats
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+from benchmarks.fake_gmail import FakeGmailService
+from benchmarks.mailbox import SyntheticMailbox
+from core.gmail_service import GmailProcessor
+from core.metrics import Metrics, metrics, profiled
+from core.model import dispose_engines
+from core.process_rules import RuleProcessor
+from core.scheduler import RequestScheduler
+from tests.test_scheduler import FakeClock, http_error
+
+
+class TestMetricsExport(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.describe("calls_total", "Calls made")
+        self.metrics.inc("calls_total", method="get")
+        self.metrics.inc("calls_total", 2, method="get")
+        self.metrics.inc("calls_total", method='say "hi"')
+        for value in (0.002, 0.02, 50.0):
+            self.metrics.observe("latency_seconds", value, method="get")
+
+    def test_prometheus_text(self):
+        text = self.metrics.to_prometheus()
+        self.assertIn("# HELP calls_total Calls made", text)
+        self.assertIn('calls_total{method="get"} 3', text)
+        self.assertIn('calls_total{method="say \\"hi\\""} 1', text)
+        # buckets are cumulative and end with +Inf
+        self.assertIn('latency_seconds_bucket{method="get",le="0.005"} 1', text)
+        self.assertIn('latency_seconds_bucket{method="get",le="0.025"} 2', text)
+        self.assertIn('latency_seconds_bucket{method="get",le="30.0"} 2', text)
+        self.assertIn('latency_seconds_bucket{method="get",le="+Inf"} 3', text)
+        self.assertIn('latency_seconds_count{method="get"} 3', text)
+
+    def test_json_lines(self):
+        records = [json.loads(line) for line in self.metrics.to_json_lines().splitlines()]
+        counter = next(r for r in records if r["metric"] == "calls_total" and r["labels"] == {"method": "get"})
+        self.assertEqual(counter["value"], 3)
+        histogram = next(r for r in records if r["metric"] == "latency_seconds")
+        self.assertEqual(histogram["count"], 3)
+        self.assertEqual(histogram["buckets"]["+Inf"], 1)
+
+    def test_write_picks_format_from_extension(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.metrics.write(os.path.join(tmp, "run.jsonl"))
+            self.metrics.write(os.path.join(tmp, "run.prom"))
+            with open(os.path.join(tmp, "run.jsonl")) as f:
+                json.loads(f.readline())
+            with open(os.path.join(tmp, "run.prom")) as f:
+                self.assertTrue(f.readline().startswith("# HELP"))
+
+    def test_profiled_writes_cprofile_stats(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "run.prof")
+            with profiled(path):
+                sum(range(1000))
+            self.assertGreater(pstats.Stats(path).total_calls, 0)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_scheduler_records_calls_and_retries(self):
+        clock = FakeClock()
+        scheduler = RequestScheduler(sleep=clock.sleep, clock=clock)
+        request = MagicMock()
+        request.execute.side_effect = [http_error(503), {"ok": True}]
+        scheduler.execute(request, "messages.get")
+        self.assertEqual(metrics.counter_value("gmail_api_calls_total", method="messages.get", status="503"), 1)
+        self.assertEqual(metrics.counter_value("gmail_api_calls_total", method="messages.get", status="ok"), 1)
+        self.assertEqual(metrics.counter_value("gmail_api_retries_total", method="messages.get"), 1)
+        self.assertEqual(metrics.histograms["gmail_api_seconds"][(("method", "messages.get"),)].count, 2)
+
+    def test_sync_and_rules_are_instrumented_and_stored_messages_log_at_debug(self):
+        fake = FakeGmailService(SyntheticMailbox(30))
+        gmail = GmailProcessor(scheduler=RequestScheduler(quota_per_second=1e9))
+        with tempfile.TemporaryDirectory() as tmp:
+            db_url = f"sqlite:///{os.path.join(tmp, 'emails.db')}"
+            rules_path = os.path.join(tmp, "rules.json")
+            with open(rules_path, "w") as f:
+                json.dump({"rules": [{"name": "everything", "predicate": "All", "actions": [],
+                                      "conditions": [{"field": "Subject", "predicate": "does not contain",
+                                                      "value": "zzzz"}]}]}, f)
+            try:
+                with self.assertLogs("core.gmail_service", level=logging.INFO) as info:
+                    gmail.fetch_and_store(db_url, None, full=True, service=fake)
+                self.assertFalse(any("Stored:" in line for line in info.output))
+                fake.deliver(1)
+                with self.assertLogs("core.gmail_service", level=logging.DEBUG) as debug:
+                    gmail.fetch_and_store(db_url, None, service=fake)
+                self.assertTrue(any("Stored:" in line for line in debug.output))
+                RuleProcessor(gmail).run_rules(db_url, rules_path, service=fake)
+            finally:
+                dispose_engines()
+        self.assertEqual(metrics.counter_value("db_rows_written_total", table="emails"), 31)
+        self.assertGreater(metrics.counter_value("gmail_bytes_downloaded_total", format="metadata"), 0)
+        self.assertEqual(metrics.counter_value("rule_matches_total", rule="everything"), 31)
+        self.assertEqual(metrics.histograms["rule_eval_seconds"][(("rule", "everything"),)].count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
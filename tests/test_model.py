@@ -0,0 +1,138 @@
+import os
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+from sqlalchemy import text
+from core.model import (
+    Email, init_db, get_engine, get_session, get_scoped_session, upsert_emails, dispose_engines,
+    load_message_labels
+)
+
+
+def make_row(message_id, subject="Hello", is_read=False):
+    return {
+        "message_id": message_id,
+        "thread_id": "t-" + message_id,
+        "subject": subject,
+        "sender": "sender@example.com",
+        "to": "you@example.com",
+        "snippet": "snippet",
+        "internal_date": datetime(2025, 1, 1, 10, 0),
+        "is_read": is_read,
+    }
+
+
+class TestUpsertEmails(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.db_url = f"sqlite:///{self.path}"
+        init_db(self.db_url)
+        self.session = get_session(self.db_url)
+
+    def tearDown(self):
+        self.session.close()
+        dispose_engines()
+        os.remove(self.path)
+
+    def test_inserts_new_rows(self):
+        self.assertEqual(upsert_emails(self.session, [make_row("a"), make_row("b")]), 2)
+        self.assertEqual(self.session.query(Email).count(), 2)
+
+    def test_updates_existing_rows_in_place(self):
+        upsert_emails(self.session, [make_row("a", is_read=False)])
+        original_id = self.session.query(Email.id).filter_by(message_id="a").scalar()
+        upsert_emails(self.session, [make_row("a", subject="Changed", is_read=True), make_row("b")])
+        self.session.expire_all()
+        email = self.session.query(Email).filter_by(message_id="a").one()
+        self.assertEqual(email.id, original_id)
+        self.assertTrue(email.is_read)
+        self.assertEqual(email.subject, "Changed")
+        self.assertEqual(self.session.query(Email).count(), 2)
+
+    def test_repeated_message_in_one_batch(self):
+        upsert_emails(self.session, [make_row("a"), make_row("a", is_read=True)])
+        self.assertTrue(self.session.query(Email.is_read).filter_by(message_id="a").scalar())
+
+    def test_empty_batch(self):
+        self.assertEqual(upsert_emails(self.session, []), 0)
+
+    def test_label_ids_replace_the_mirror(self):
+        upsert_emails(self.session, [dict(make_row("a"), label_ids=["INBOX", "UNREAD"]), make_row("b")])
+        upsert_emails(self.session, [dict(make_row("a"), label_ids=["Label_1"])])
+        self.assertEqual(load_message_labels(self.session, ["a", "b"]), {"a": {"Label_1"}})
+
+
+class TestEngineRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_url = f"sqlite:///{os.path.join(self.tmpdir.name, 'emails.db')}"
+
+    def tearDown(self):
+        dispose_engines()
+        self.tmpdir.cleanup()
+
+    def test_engine_is_shared_per_url(self):
+        self.assertIs(get_engine(self.db_url), get_engine(self.db_url))
+        self.assertIs(get_session(self.db_url).get_bind(), get_engine(self.db_url))
+
+    def test_sqlite_pragmas(self):
+        with get_engine(self.db_url).connect() as conn:
+            self.assertEqual(conn.execute(text("PRAGMA journal_mode")).scalar(), "wal")
+            self.assertEqual(conn.execute(text("PRAGMA synchronous")).scalar(), 1)
+            self.assertEqual(conn.execute(text("PRAGMA busy_timeout")).scalar(), 5000)
+
+    def test_in_memory_database_is_shared(self):
+        init_db("sqlite://")
+        session = get_session("sqlite://")
+        upsert_emails(session, [make_row("a")])
+        session.close()
+        self.assertEqual(get_session("sqlite://").query(Email).count(), 1)
+
+    def test_scoped_sessions_are_per_thread(self):
+        registry = get_scoped_session(self.db_url)
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(registry()))
+        thread.start()
+        thread.join()
+        self.assertIs(registry(), registry())
+        self.assertIsNot(sessions[0], registry())
+
+    def test_concurrent_writer_and_reader(self):
+        init_db(self.db_url)
+        registry = get_scoped_session(self.db_url)
+        errors = []
+
+        def write():
+            try:
+                for i in range(50):
+                    upsert_emails(registry(), [make_row(f"w{i}-{j}") for j in range(20)])
+            except Exception as err:
+                errors.append(err)
+            finally:
+                registry.remove()
+
+        def read():
+            try:
+                for _ in range(50):
+                    registry().query(Email).count()
+                    registry().rollback()
+            except Exception as err:
+                errors.append(err)
+            finally:
+                registry.remove()
+
+        threads = [threading.Thread(target=write), threading.Thread(target=write), threading.Thread(target=read)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(get_session(self.db_url).query(Email).count(), 1000)
+
+
+if __name__ == "__main__":
+    unittest.main()
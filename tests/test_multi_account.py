@@ -0,0 +1,78 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from core.multi_account import budget_quota, load_manifest, run_account, run_accounts, summarize
+
+
+def report_pid(account, log_dir=None):
+    return {"name": account["name"], "ok": True, "error": None, "pid": os.getpid(), "total_seconds": 0.0}
+
+
+class TestMultiAccount(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_manifest(self, manifest):
+        path = os.path.join(self.tmpdir.name, "accounts.json")
+        with open(path, "w") as f:
+            json.dump(manifest, f)
+        return path
+
+    def test_manifest_defaults_and_validation(self):
+        path = self.write_manifest({"project_quota": 300, "defaults": {"rules": "team.json"}, "accounts": [
+            {"name": "alice", "token": "alice.pickle"},
+            {"name": "bob", "token": "bob.pickle", "db": "postgresql://db/bob", "quota": 100},
+        ]})
+        project_quota, accounts = load_manifest(path)
+        self.assertEqual(project_quota, 300)
+        self.assertEqual([a["db"] for a in accounts], ["sqlite:///alice.db", "postgresql://db/bob"])
+        self.assertEqual({a["rules"] for a in accounts}, {"team.json"})
+
+        budgeted = budget_quota(accounts, workers=4, project_quota=project_quota)
+        self.assertEqual([a["quota"] for a in budgeted], [150, 100])
+
+        shared = self.write_manifest({"accounts": [{"name": "a", "token": "a", "db": "sqlite:///x.db"},
+                                                   {"name": "b", "token": "b", "db": "sqlite:///x.db"}]})
+        with self.assertRaises(ValueError):
+            load_manifest(shared)
+
+    @patch("core.multi_account.RuleProcessor")
+    @patch("core.multi_account.GmailProcessor")
+    def test_run_account_reports_timings(self, mock_gmail, mock_rules):
+        token = os.path.join(self.tmpdir.name, "alice.pickle")
+        open(token, "w").close()
+        mock_gmail.return_value.scheduler.stats = {"calls": 3}
+        mock_rules.return_value.run_rules.return_value = {"calls": 1}
+        _, accounts = load_manifest(self.write_manifest({"accounts": [
+            {"name": "alice", "token": token, "quota": 80}]}))
+
+        result = run_account(accounts[0], log_dir=self.tmpdir.name)
+
+        self.assertTrue(result["ok"], result["error"])
+        self.assertEqual(result["api"], {"calls": 3})
+        self.assertEqual(mock_gmail.call_args.kwargs["scheduler"].bucket.rate, 80)
+        mock_gmail.return_value.get_gmail_service.assert_called_once_with(interactive=False)
+        self.assertIn("sync_seconds", result)
+
+    def test_missing_token_fails_without_prompting(self):
+        _, accounts = load_manifest(self.write_manifest({"accounts": [{"name": "bob", "token": "missing.pickle"}]}))
+        result = run_account(accounts[0])
+        self.assertFalse(result["ok"])
+        self.assertIn("missing.pickle", result["error"])
+        self.assertIn("failed", summarize([result], 0.1))
+
+    def test_accounts_fan_out_across_processes(self):
+        accounts = [{"name": f"acct{i}", "quota": 250} for i in range(4)]
+        results = run_accounts(accounts, workers=2, runner=report_pid)
+        self.assertEqual([r["name"] for r in results], ["acct0", "acct1", "acct2", "acct3"])
+        self.assertNotIn(os.getpid(), {r["pid"] for r in results})
+
+
+if __name__ == "__main__":
+    unittest.main()
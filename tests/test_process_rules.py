@@ -2,8 +2,28 @@ import unittest
 from unittest.mock import MagicMock, patch
 from datetime import datetime, timedelta
 import json
+import os
+import tempfile
+import httplib2
 from core.process_rules import RuleProcessor
-from core.model import Email
+from googleapiclient.errors import HttpError
+from core.model import Email, RuleWatermark, init_db, get_session, dispose_engines, replace_message_labels
+from core.scheduler import RequestScheduler
+from core.bodies import save_bodies
+
+
+class FailingBatch(object):
+    # every message.get in the batch comes back as a server error
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append(request_id)
+
+    def execute(self, http=None):
+        for request_id in self.requests:
+            self.callback(request_id, None, HttpError(httplib2.Response({"status": 500}), b"backendError"))
 
 
 class TestRuleProcessor(unittest.TestCase):
@@ -46,5 +66,168 @@ class TestRuleProcessor(unittest.TestCase):
         cond = {"field": "internal_date", "predicate": "greater_than_days", "value": 4}
         self.assertFalse(self.rp.evaluate_condition(self.email, cond))
 
+
+class TestRunRules(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_url = f"sqlite:///{os.path.join(self.tmpdir.name, 'emails.db')}"
+        init_db(self.db_url)
+        session = get_session(self.db_url)
+        for i in range(3):
+            session.add(Email(message_id=f"g{i}", sender="noreply@groww.in", subject=f"SIP {i}",
+                              internal_date=datetime.now(), is_read=(i == 0)))
+        session.add(Email(message_id="x", sender="friend@example.com", subject="Hi", is_read=False))
+        session.commit()
+        session.close()
+        self.rules_path = os.path.join(self.tmpdir.name, "rules.json")
+        with open(self.rules_path, "w") as f:
+            json.dump({"rules": [
+                {"name": "Move Groww", "conditions": [{"field": "From", "predicate": "contains", "value": "groww.in"}],
+                 "actions": [{"action": "move_to_label", "label": "Finance/Groww"}]},
+                {"name": "Read Groww", "conditions": [{"field": "From", "predicate": "contains", "value": "groww"}],
+                 "actions": [{"action": "mark_as_read"}]},
+            ]}, f)
+        self.rp = RuleProcessor()
+        self.rp.gmail_service = MagicMock()
+        self.rp.gmail_service.list_labels.return_value = [{"id": "Label_1", "name": "Finance"}]
+        self.rp.gmail_service.create_label.return_value = {"id": "Label_7", "name": "Finance/Groww"}
+
+    def tearDown(self):
+        dispose_engines()
+        self.tmpdir.cleanup()
+
+    def test_actions_are_coalesced_into_batch_modify(self):
+        self.rp.run_rules(self.db_url, self.rules_path)
+
+        gmail = self.rp.gmail_service
+        gmail.list_labels.assert_called_once()
+        gmail.create_label.assert_called_once_with(gmail.get_gmail_service(), "Finance/Groww")
+        gmail.msg_mark_modify.assert_not_called()
+        calls = {tuple(c.args[1]): c.kwargs for c in gmail.batch_modify.call_args_list}
+        self.assertEqual(calls, {
+            ("g0",): {"add_labels": ["Label_7"], "remove_labels": ["INBOX"]},
+            ("g1", "g2"): {"add_labels": ["Label_7"], "remove_labels": ["INBOX", "UNREAD"]},
+        })
+        session = get_session(self.db_url)
+        read = dict(session.query(Email.message_id, Email.is_read))
+        session.close()
+        self.assertEqual(read, {"g0": True, "g1": True, "g2": True, "x": False})
+
+    def test_label_mirror_avoids_repeat_modifies(self):
+        session = get_session(self.db_url)
+        replace_message_labels(session, {"g0": ["INBOX"], "g1": ["INBOX", "UNREAD"], "g2": ["INBOX", "UNREAD"]})
+        session.commit()
+        session.close()
+        first = self.rp.run_rules(self.db_url, self.rules_path)
+        second = self.rp.run_rules(self.db_url, self.rules_path)
+        # all three now share one (already applied) delta, so a single call is skipped
+
+        self.assertEqual((first["calls"], first["avoided"]), (2, 0))
+        self.assertEqual((second["calls"], second["avoided"]), (0, 1))
+        self.assertEqual(self.rp.gmail_service.batch_modify.call_count, 2)
+
+    def test_full_body_rule_reads_stored_bodies(self):
+        session = get_session(self.db_url)
+        save_bodies(session, {"g0": "Monthly statement", "g1": "Your invoice is attached", "x": "invoice?"})
+        session.commit()
+        session.close()
+        with open(self.rules_path, "w") as f:
+            json.dump({"rules": [{"name": "Invoices", "predicate": "All", "conditions": [
+                {"field": "From", "predicate": "contains", "value": "groww"},
+                {"field": "Full Body", "predicate": "contains", "value": "INVOICE"}],
+                "actions": [{"action": "mark_as_read"}]}]}, f)
+
+        for single_pass in (False, True):
+            self.rp.gmail_service.batch_modify.reset_mock()
+            self.rp.run_rules(self.db_url, self.rules_path, single_pass=single_pass)
+
+            # x is not from groww; g2 has no stored body and the mocked scheduler returns none
+            calls = [c.args[1] for c in self.rp.gmail_service.batch_modify.call_args_list]
+            self.assertEqual(calls, [["g1"]])
+            session = get_session(self.db_url)
+            session.query(Email).filter_by(message_id="g1").update({"is_read": False})
+            session.commit()
+            session.close()
+
+    def test_unfetchable_body_is_not_treated_as_empty(self):
+        with open(self.rules_path, "w") as f:
+            json.dump({"rules": [{"name": "No unsubscribe link", "predicate": "All", "conditions": [
+                {"field": "From", "predicate": "contains", "value": "groww"},
+                {"field": "Full Body", "predicate": "does not contain", "value": "unsubscribe"}],
+                "actions": [{"action": "mark_as_read"}]}]}, f)
+        service = MagicMock()
+        service.new_batch_http_request.side_effect = lambda callback=None: FailingBatch(callback)
+        self.rp.gmail_service.scheduler = RequestScheduler(quota_per_second=100000, base_delay=0.0)
+
+        for single_pass in (False, True):
+            totals = self.rp.run_rules(self.db_url, self.rules_path, single_pass=single_pass, service=service,
+                                       incremental=True)
+
+            self.assertEqual(totals["unevaluated"], 3)  # x is not from groww, so its body isn't fetched
+            self.rp.gmail_service.batch_modify.assert_not_called()
+            session = get_session(self.db_url)
+            self.assertEqual(session.query(RuleWatermark).count(), 0)
+            session.close()
+
+    def test_any_rule_fetches_only_bodies_that_can_decide(self):
+        with open(self.rules_path, "w") as f:
+            json.dump({"rules": [{"name": "Groww or invoice", "predicate": "Any", "conditions": [
+                {"field": "From", "predicate": "contains", "value": "groww"},
+                {"field": "Full Body", "predicate": "contains", "value": "invoice"}],
+                "actions": [{"action": "mark_as_read"}]}]}, f)
+        service = MagicMock()
+        service.new_batch_http_request.side_effect = lambda callback=None: FailingBatch(callback)
+        self.rp.gmail_service.scheduler = RequestScheduler(quota_per_second=100000, base_delay=0.0)
+
+        for single_pass in (False, True):
+            self.rp.gmail_service.batch_modify.reset_mock()
+            with self.assertLogs("core.bodies", level="WARNING") as logs:
+                totals = self.rp.run_rules(self.db_url, self.rules_path, single_pass=single_pass, service=service)
+
+            # the groww emails match on From alone; only x's body is asked for
+            self.assertEqual(len(logs.output), 1)
+            self.assertIn("body of x", logs.output[0])
+            self.assertEqual(totals["unevaluated"], 1)
+            modified = sorted(i for c in self.rp.gmail_service.batch_modify.call_args_list for i in c.args[1])
+            self.assertEqual(modified, ["g1", "g2"])
+            session = get_session(self.db_url)
+            session.query(Email).filter(Email.message_id.in_(modified)).update({"is_read": False})
+            session.commit()
+            session.close()
+
+    def test_single_pass_matches_per_rule(self):
+        self.rp.run_rules(self.db_url, self.rules_path, single_pass=True)
+
+        calls = {tuple(c.args[1]): c.kwargs for c in self.rp.gmail_service.batch_modify.call_args_list}
+        self.assertEqual(calls, {
+            ("g0",): {"add_labels": ["Label_7"], "remove_labels": ["INBOX"]},
+            ("g1", "g2"): {"add_labels": ["Label_7"], "remove_labels": ["INBOX", "UNREAD"]},
+        })
+
+    def test_small_chunks_flush_as_they_go(self):
+        self.rp.run_rules(self.db_url, self.rules_path, chunk_size=1)
+
+        # one message per flush, so the two rules no longer share calls
+        modified = sorted(i for c in self.rp.gmail_service.batch_modify.call_args_list for i in c.args[1])
+        self.assertEqual(modified, ["g0", "g1", "g1", "g2", "g2"])
+        session = get_session(self.db_url)
+        read = dict(session.query(Email.message_id, Email.is_read))
+        session.close()
+        self.assertEqual(read, {"g0": True, "g1": True, "g2": True, "x": False})
+
+    def test_referenced_columns(self):
+        rules = self.rp.load_rules(self.rules_path)
+        names = [c.key for c in self.rp.referenced_columns(rules)]
+        self.assertEqual(names, ["id", "message_id", "is_read", "sender"])
+
+    def test_label_registry_is_reused_across_runs(self):
+        self.rp.run_rules(self.db_url, self.rules_path)
+        self.rp.run_rules(self.db_url, self.rules_path)
+        gmail = self.rp.gmail_service
+        gmail.list_labels.assert_called_once()
+        gmail.create_label.assert_called_once()
+
+
 if __name__ == "__main__":
     unittest.main()
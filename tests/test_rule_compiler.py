@@ -0,0 +1,181 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from core.model import Email, init_db, get_session, has_fts, rebuild_fts, upsert_emails, dispose_engines
+from core.process_rules import RuleProcessor
+from core.rule_compiler import RuleCompiler
+
+
+class TestRuleCompiler(unittest.TestCase):
+    fts = False
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        db_url = f"sqlite:///{self.path}"
+        self.db_url = db_url
+        init_db(db_url, fts=self.fts)
+        self.session = get_session(db_url)
+        now = datetime.now()
+        self.session.add_all([
+            Email(message_id="1", sender="Poorvi@Example.com", subject="HappyFox Assignment",
+                  snippet="Please find the assignment details", internal_date=now - timedelta(days=3)),
+            Email(message_id="2", sender="noreply@groww.in", subject="100% off_sale",
+                  snippet="Your SIP is due", internal_date=now - timedelta(days=30)),
+            Email(message_id="3", sender="ÉLODIE <elodie@exemple.fr>", subject="Réunion",
+                  snippet=None, internal_date=None),
+            Email(message_id="4", sender=None, subject="", snippet="", internal_date=datetime(2024, 6, 1)),
+        ])
+        self.session.commit()
+        self.rp = RuleProcessor()
+        self.compiler = RuleCompiler(self.rp, "sqlite", fts=self.fts)
+
+    def tearDown(self):
+        self.session.close()
+        dispose_engines()
+        os.remove(self.path)
+
+    def python_matches(self, rule):
+        predicate = rule.get("predicate", "All").lower()
+        return {e.message_id for e in self.session.query(Email)
+                if self.rp.rule_matches(e, rule["conditions"], predicate)}
+
+    def sql_matches(self, rule):
+        clause, residual = self.compiler.compile_rule(rule)
+        self.assertEqual(residual, [])
+        return {e.message_id for e in self.session.query(Email).filter(clause)}
+
+    def assert_same_matches(self, conditions, predicate="All"):
+        rule = {"conditions": conditions, "predicate": predicate}
+        self.assertEqual(self.sql_matches(rule), self.python_matches(rule), conditions)
+
+    def test_string_predicates_match_python(self):
+        cases = [
+            {"field": "From", "predicate": "contains", "value": "EXAMPLE"},
+            {"field": "from", "predicate": "does not contain", "value": "groww"},
+            {"field": "sender", "predicate": "equals", "value": "noreply@GROWW.in"},
+            {"field": "Subject", "predicate": "not equal", "value": "happyfox assignment"},
+            {"field": "subject", "predicate": "contains", "value": "% off_"},
+            {"field": "subject", "predicate": "contains", "value": "_"},
+            {"field": "message", "predicate": "contains", "value": ""},
+            {"field": "body", "predicate": "does not contain", "value": "sip"},
+            {"field": "from", "predicate": "contains", "value": "élodie"},
+            {"field": "subject", "predicate": "equals", "value": None},
+            {"field": "subject", "predicate": "starts with", "value": "x"},
+            {"field": "to", "predicate": "contains", "value": "x"},
+        ]
+        for cond in cases:
+            self.assert_same_matches([cond])
+
+    def test_non_ascii_folding_matches_python(self):
+        self.session.add(Email(message_id="5", subject="İstanbul trip", sender="Straße <ops@example.com>"))
+        self.session.add(Email(message_id="6", subject="ABİ report", snippet="KELVIN \u212a scale"))
+        self.session.commit()
+        cases = [
+            {"field": "subject", "predicate": "contains", "value": "İst"},
+            {"field": "subject", "predicate": "contains", "value": "abi"},
+            {"field": "subject", "predicate": "contains", "value": "ABİ REP"},
+            {"field": "snippet", "predicate": "contains", "value": "n k sc"},
+            {"field": "subject", "predicate": "does not contain", "value": "İst"},
+            {"field": "from", "predicate": "contains", "value": "STRASSE"},
+            {"field": "from", "predicate": "contains", "value": "straße"},
+        ]
+        for cond in cases:
+            self.assert_same_matches([cond])
+        self.assertEqual(self.sql_matches({"conditions": cases[:1]}), {"5"})
+
+    def test_date_predicates_match_python(self):
+        cases = [
+            {"field": "internal_date", "predicate": "less_than_days", "value": 5},
+            {"field": "internal_date", "predicate": "gt_days", "value": "10"},
+            {"field": "internal_date", "predicate": "lt", "value": "2025-01-01"},
+            {"field": "internal_date", "predicate": "greater_than", "value": "2025-01-01"},
+            {"field": "received", "predicate": "less_than_days", "value": 5},
+            {"field": "internal_date", "predicate": "between", "value": 5},
+        ]
+        for cond in cases:
+            self.assert_same_matches([cond])
+
+    def test_all_and_any(self):
+        conditions = [
+            {"field": "from", "predicate": "contains", "value": "groww"},
+            {"field": "subject", "predicate": "contains", "value": "happyfox"},
+        ]
+        self.assert_same_matches(conditions, "All")
+        self.assert_same_matches(conditions, "Any")
+        self.assert_same_matches([], "All")
+        self.assert_same_matches([], "Any")
+
+    def test_uncompilable_condition_is_left_to_python(self):
+        cond = {"field": "internal_date", "predicate": "lt", "value": "2025-01-01T00:00:00+05:30"}
+        other = {"field": "from", "predicate": "contains", "value": "groww"}
+        clause, residual = self.compiler.compile_rule({"conditions": [other, cond], "predicate": "All"})
+        self.assertEqual(residual, [cond])
+        clause, residual = self.compiler.compile_rule({"conditions": [other, cond], "predicate": "Any"})
+        self.assertIsNone(clause)
+        self.assertEqual(residual, [other, cond])
+
+
+class TestRuleCompilerFts(TestRuleCompiler):
+    fts = True
+
+    def fts_ids(self, column, phrase):
+        sql = text(f"SELECT rowid FROM emails_fts WHERE emails_fts.{column} MATCH :q")
+        return {row[0] for row in self.session.execute(sql, {"q": phrase})}
+
+    def test_index_is_present(self):
+        self.assertTrue(has_fts(self.session.get_bind()))
+
+    def test_contains_uses_index(self):
+        clause, residual = self.compiler.compile_rule(
+            {"conditions": [{"field": "subject", "predicate": "contains", "value": "assign"}]})
+        self.assertIn("emails_fts", str(clause.compile()))
+
+    def test_triggers_follow_writes(self):
+        upsert_emails(self.session, [{"message_id": "1", "subject": "Renamed subject", "is_read": True}])
+        self.assertEqual(self.fts_ids("subject", '"renamed"'), {1})
+        self.assertEqual(self.fts_ids("subject", '"happyfox"'), set())
+        self.session.query(Email).filter_by(message_id="1").delete()
+        self.session.commit()
+        self.assertEqual(self.fts_ids("subject", '"renamed"'), set())
+
+    def test_enabling_fts_on_a_populated_database(self):
+        path = self.path + ".plain.db"
+        self.addCleanup(os.remove, path)
+        db_url = f"sqlite:///{path}"
+        init_db(db_url)
+        session = get_session(db_url)
+        upsert_emails(session, [{"message_id": f"i{i}", "subject": f"Invoice {i}", "is_read": False}
+                                for i in range(5)])
+        init_db(db_url, fts=True)  # the engine is already initialized; only the index is created
+        rule = {"conditions": [{"field": "subject", "predicate": "contains", "value": "invoice"}]}
+        clause, _ = RuleCompiler(self.rp, "sqlite", fts=True).compile_rule(rule)
+        self.assertEqual(session.query(Email).filter(clause).count(), 5)
+        upsert_emails(session, [{"message_id": "i0", "subject": "Renamed", "is_read": True}])
+        self.assertEqual(session.query(Email).filter(clause).count(), 4)
+        session.close()
+
+    def test_index_from_an_older_schema_is_replaced(self):
+        self.session.execute(text("DROP TABLE emails_fts"))
+        self.session.execute(text("CREATE VIRTUAL TABLE emails_fts USING fts5(subject, sender, snippet, "
+                                  "content='emails', content_rowid='id', tokenize='trigram')"))
+        self.session.commit()
+        self.assertFalse(has_fts(self.session.get_bind()))  # not trusted: it folds case its own way
+        init_db(self.db_url, fts=True)
+        self.assertTrue(has_fts(self.session.get_bind()))
+        self.assertEqual(self.fts_ids("subject", '"réunion"'), {3})
+
+    def test_rebuild_indexes_existing_rows(self):
+        self.session.execute(text("DROP TABLE emails_fts"))
+        self.session.execute(text("DROP TRIGGER emails_fts_ai"))
+        self.session.execute(text("DROP TRIGGER emails_fts_ad"))
+        self.session.execute(text("DROP TRIGGER emails_fts_au"))
+        self.session.commit()
+        self.assertTrue(rebuild_fts(self.db_url))
+        self.assertEqual(self.fts_ids("sender", '"groww"'), {2})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+from unittest.mock import MagicMock
+from googleapiclient.errors import HttpError
+from core.scheduler import RequestScheduler, TokenBucket, is_throttle, retry_after
+
+
+def http_error(status, headers=None, content=b""):
+    resp = MagicMock(status=status)
+    resp.get.side_effect = (headers or {}).get
+    return HttpError(resp, content)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_waits_for_refill(self):
+        clock = FakeClock()
+        bucket = TokenBucket(250, clock=clock, sleep=clock.sleep)
+        bucket.acquire(250)
+        bucket.acquire(50)
+        self.assertAlmostEqual(sum(clock.sleeps), 0.2)
+
+    def test_calls_dearer_than_the_bucket_are_charged_in_full(self):
+        clock = FakeClock()
+        bucket = TokenBucket(250, clock=clock, sleep=clock.sleep)
+        for _ in range(10):
+            bucket.acquire(500)  # a 100-message batch of messages.get
+        # after the first batch each one waits off 500 units at 250/s, not a 250-unit bucket
+        self.assertAlmostEqual(clock.now, 9 * 500 / 250)
+
+
+class TestRequestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = RequestScheduler(max_concurrency=8, sleep=self.clock.sleep, clock=self.clock)
+
+    def test_retries_throttled_call_honouring_retry_after(self):
+        request = MagicMock()
+        request.execute.side_effect = [http_error(429, {"retry-after": "3"}), {"ok": True}]
+        self.assertEqual(self.scheduler.execute(request, "messages.get"), {"ok": True})
+        self.assertEqual(self.clock.sleeps, [3.0])
+        self.assertEqual(self.scheduler.stats["retries"], 1)
+        self.assertLess(self.scheduler.limit, 8)
+
+    def test_server_errors_back_off_exponentially(self):
+        request = MagicMock()
+        request.execute.side_effect = [http_error(503), http_error(500), {"ok": True}]
+        self.scheduler.execute(request, "messages.list")
+        self.assertEqual(len(self.clock.sleeps), 2)
+        self.assertLessEqual(self.clock.sleeps[0], 1.0)
+        self.assertLessEqual(self.clock.sleeps[1], 2.0)
+
+    def test_client_errors_are_not_retried(self):
+        request = MagicMock()
+        request.execute.side_effect = http_error(404)
+        with self.assertRaises(HttpError):
+            self.scheduler.execute(request, "messages.get")
+        self.assertEqual(request.execute.call_count, 1)
+
+    def test_gives_up_after_max_retries(self):
+        scheduler = RequestScheduler(max_retries=2, sleep=self.clock.sleep, clock=self.clock)
+        request = MagicMock()
+        request.execute.side_effect = http_error(500)
+        with self.assertRaises(HttpError):
+            scheduler.execute(request, "messages.get")
+        self.assertEqual(request.execute.call_count, 3)
+
+    def test_aimd_concurrency(self):
+        self.scheduler.on_throttle()
+        self.scheduler.on_throttle()
+        self.assertEqual(self.scheduler.limit, 2.0)
+        for _ in range(20):
+            self.scheduler.on_success()
+        self.assertGreater(self.scheduler.limit, 2.0)
+        self.assertLessEqual(self.scheduler.limit, 8.0)
+
+    def test_quota_units_are_charged_per_method(self):
+        request = MagicMock()
+        self.scheduler.execute(request, "messages.batchModify")
+        self.scheduler.execute(request, "labels.list")
+        self.assertEqual(self.scheduler.stats["units"], 51)
+
+    def test_rate_limit_403_counts_as_throttle(self):
+        self.assertTrue(is_throttle(http_error(403, content=b'{"reason": "userRateLimitExceeded"}')))
+        self.assertFalse(is_throttle(http_error(403, content=b'{"reason": "insufficientPermissions"}')))
+        self.assertIsNone(retry_after(http_error(429)))
+
+
+if __name__ == "__main__":
+    unittest.main()